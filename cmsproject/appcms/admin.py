@@ -1,3 +1,23 @@
 from django.contrib import admin
 
+from .models import Manager, Media, Supervisor
+
 # Register your models here.
+
+
+# __str__ on these models follows foreign keys, so the changelists join them up front
+@admin.register(Manager)
+class ManagerAdmin(admin.ModelAdmin):
+    list_select_related = ('user',)
+
+
+@admin.register(Supervisor)
+class SupervisorAdmin(admin.ModelAdmin):
+    list_select_related = ('user',)
+
+
+@admin.register(Media)
+class MediaAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'description', 'created_at')
+    list_select_related = ('project', 'supervisor__user')
+    raw_id_fields = ('project', 'supervisor', 'manager')
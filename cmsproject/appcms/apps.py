@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class AppcmsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'appcms'
+
+    def ready(self):
+        from . import signals, sqlite  # noqa: F401  Connect the receivers
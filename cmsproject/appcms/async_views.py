@@ -0,0 +1,246 @@
+"""
+Native async views for the I/O-heavy endpoints, for ASGI deployments.
+
+Under ASGI, Django receives a request body without holding a thread, so a
+slow mobile upload only costs a coroutine until it has fully arrived. These
+views keep the rest of the request off the thread pool too: tokens resolve
+through the in-process cache, queries use the async ORM, and an upload is
+copied into storage on a worker thread, leaving a single short write on the
+database thread. They are mounted under /async/ beside the DRF views they
+mirror, take the same parameters and return the same JSON.
+
+DRF views are synchronous, so these are plain Django views that reuse the
+viewsets' querysets, permissions, serializers and pagination.
+"""
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions, status
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from .authentication import CachedTokenAuthentication, get_principal
+from .models import Document, Manager, Media, Project, Supervisor
+from .storage import ContentAddressedStorage
+from .views import (
+    DocumentViewSet, MediaViewSet, ProjectViewSet, ResourceViewSet, TaskViewSet, WorkerViewSet,
+    set_validators, validators_etag,
+)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi')
+
+
+def json_response(data, status=status.HTTP_200_OK):
+    # DRF's renderer, so the bytes match what the DRF views send
+    return HttpResponse(JSONRenderer().render(data), status=status, content_type='application/json')
+
+
+async def authenticate(request):
+    """ The user for the request's `Authorization: Token <key>` header; AnonymousUser without one """
+    auth = CachedTokenAuthentication()
+    header = request.headers.get('Authorization', '').split()
+    if not header or header[0].lower() != auth.keyword.lower():
+        return AnonymousUser()
+    if len(header) != 2:
+        raise exceptions.AuthenticationFailed('Invalid token header.')
+    user, _ = await sync_to_async(auth.authenticate_credentials)(header[1])
+    return user
+
+
+async def read_form(request):
+    """ (POST, FILES) of a multipart request, parsed on a worker thread since it reads the spooled body """
+    http_request = request._request
+    return await sync_to_async(lambda: (http_request.POST, http_request.FILES), thread_sensitive=False)()
+
+
+async def store_upload(field, upload):
+    """
+    Save `upload` for the file `field` and return its storage name. The copy
+    runs on a worker thread; only the Blob row is written on the database thread.
+    """
+    storage = field.storage
+    name = field.generate_filename(None, upload.name)
+    if isinstance(storage, ContentAddressedStorage):
+        spooled = await sync_to_async(storage.spool, thread_sensitive=False)(upload)
+        return await sync_to_async(storage.commit)(name, *spooled)
+    return await sync_to_async(storage.save)(name, upload)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAPIView(View):
+    """ Token authentication, DRF permission classes and DRF-style error bodies, for async handlers """
+    permission_classes = [IsAuthenticated]
+
+    async def dispatch(self, request, *args, **kwargs):
+        # A DRF Request for query_params and the serializer context; its body is never parsed
+        request = Request(request)
+        try:
+            request.user = await authenticate(request._request)
+            await sync_to_async(self.check_permissions)(request)
+            return await super().dispatch(request, *args, **kwargs)
+        except exceptions.APIException as e:
+            response = json_response({"detail": e.detail}, status=e.status_code)
+            if isinstance(e, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+                response['WWW-Authenticate'] = CachedTokenAuthentication.keyword
+            return response
+
+    def get_permission_view(self):
+        """ The view object permission classes are checked against """
+        return self
+
+    def check_permissions(self, request):
+        # Runs on the database thread: a principal may need loading
+        for permission in self.permission_classes:
+            if not permission().has_permission(request, self.get_permission_view()):
+                if not request.user.is_authenticated:
+                    raise exceptions.NotAuthenticated()
+                raise exceptions.PermissionDenied()
+
+
+# Lists
+class AsyncListView(AsyncAPIView):
+    """ A viewset's list endpoint: conditional GET, sparse fieldsets and keyset pages, read with the async ORM """
+    viewset_class = None
+
+    def setup(self, request, *args, **kwargs):
+        super().setup(request, *args, **kwargs)
+        self.permission_classes = self.viewset_class.permission_classes
+
+    def get_permission_view(self):
+        return self.viewset
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.viewset = self.viewset_class(action='list', args=args, kwargs=kwargs, format_kwarg=None)
+        return await super().dispatch(request, *args, **kwargs)
+
+    async def get(self, request):
+        viewset = self.viewset
+        viewset.request = request
+
+        etag = validators_etag(request, await sync_to_async(viewset.list_validators)(request))
+        response = get_conditional_response(request, etag=etag)
+        if response is not None:
+            return response
+
+        queryset = viewset.filter_queryset(viewset.get_queryset())
+        paginator = viewset.paginator
+        if paginator is None:
+            data = viewset.get_serializer([row async for row in queryset], many=True).data
+        else:
+            rows = await paginator.apaginate_queryset(queryset, request, view=viewset)
+            data = paginator.get_paginated_response(viewset.get_serializer(rows, many=True).data).data
+        return set_validators(json_response(data), etag)
+
+
+# Profile
+class AsyncManagerProfileView(AsyncAPIView):
+    async def get(self, request):
+        principal = await sync_to_async(get_principal)(request)
+        manager = await Manager.objects.filter(pk=principal.manager_id).afirst() if principal.manager_id else None
+        if manager is None:
+            return json_response({"error": "Manager profile not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        return json_response({
+            "username": request.user.username,
+            "role": principal.role,
+            "department": manager.department,
+            "phone_number": manager.phone_number,
+        })
+
+
+# Uploads
+class AsyncMediaUploadView(AsyncAPIView):
+    async def post(self, request):
+        data, files = await read_form(request)
+        media_file = files.get('file')
+        if not media_file:
+            return json_response({"error": "Media file is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if media_file.name.lower().endswith(IMAGE_EXTENSIONS):
+            field = 'image'
+        elif media_file.name.lower().endswith(VIDEO_EXTENSIONS):
+            field = 'video'
+        else:
+            return json_response(
+                {"error": "Invalid file format. Only image and video files are allowed."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            ids = {name: int(data.get(name)) for name in ('project', 'supervisor', 'manager')}
+        except (TypeError, ValueError):
+            ids = None
+        if ids is None or not (
+            await Project.objects.filter(pk=ids['project']).aexists()
+            and await Supervisor.objects.filter(pk=ids['supervisor']).aexists()
+            and await Manager.objects.filter(pk=ids['manager']).aexists()
+        ):
+            return json_response({"error": "Invalid project, supervisor, or manager ID."}, status=status.HTTP_400_BAD_REQUEST)
+
+        name = await store_upload(Media._meta.get_field(field), media_file)
+        media = await Media.objects.acreate(
+            project_id=ids['project'],
+            supervisor_id=ids['supervisor'],
+            manager_id=ids['manager'],
+            description=data.get('description', ''),
+            **{field: name},
+        )
+        return json_response({
+            "message": "Media uploaded successfully.",
+            "media_id": media.id,
+        }, status=status.HTTP_201_CREATED)
+
+
+class AsyncDocumentUploadView(AsyncAPIView):
+    async def post(self, request):
+        principal = await sync_to_async(get_principal)(request)
+        if principal.role != 'manager':
+            return json_response({"detail": "You must be a manager to upload documents."}, status=status.HTTP_403_FORBIDDEN)
+
+        data, files = await read_form(request)
+        project_id = data.get('project')
+        if not project_id:
+            return json_response({"detail": "Project ID is required."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            project = await Project.objects.filter(pk=int(project_id)).values('id', 'supervisor_id').afirst()
+        except ValueError:
+            project = None
+        if project is None:
+            return json_response({"detail": "Project not found."}, status=status.HTTP_404_NOT_FOUND)
+        if principal.supervisor_id is not None and project['supervisor_id'] == principal.supervisor_id:
+            return json_response({"detail": "Supervisors cannot upload documents for this project."}, status=status.HTTP_400_BAD_REQUEST)
+
+        upload = files.get('file')
+        document_type = data.get('document_type', '')
+        if not upload:
+            return json_response({"detail": "File is required."}, status=status.HTTP_400_BAD_REQUEST)
+        if document_type not in dict(Document.DOCUMENT_TYPE_CHOICES):
+            return json_response({"detail": "Invalid document type."}, status=status.HTTP_400_BAD_REQUEST)
+
+        name = await store_upload(Document._meta.get_field('file'), upload)
+        document = await Document.objects.acreate(
+            project_id=project['id'],
+            title=data.get('title') or upload.name,
+            document_type=document_type,
+            file=name,
+        )
+        return json_response({
+            "message": "Document uploaded successfully.",
+            "document_id": document.id,
+        }, status=status.HTTP_201_CREATED)
+
+
+LIST_VIEWSETS = {
+    'projects': ProjectViewSet,
+    'tasks': TaskViewSet,
+    'resources': ResourceViewSet,
+    'workers': WorkerViewSet,
+    'documents': DocumentViewSet,
+    'media': MediaViewSet,
+}
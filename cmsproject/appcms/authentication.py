@@ -0,0 +1,156 @@
+"""
+Token authentication with an in-process cache.
+
+DRF's TokenAuthentication joins Token and User on every request. Here a
+bounded LRU keeps token -> user for CMS_AUTH_CACHE_TTL seconds, so a warm
+request costs one read from the shared Django cache instead of a database
+query. That read is the user's version stamp: deleting a token, or saving or
+deleting a user (deactivation, role change), writes a new stamp through
+`invalidate_user()`, and every process's entries for that user stop
+matching. The TTL bounds how long a process could serve a change it missed
+(e.g. if the shared cache was flushed).
+
+The cached user carries its `Principal` (role, groups and profile ids), so
+permission checks on a warm request don't query either; `get_principal()`
+is how permission classes and views read it.
+"""
+import copy
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, transaction
+from rest_framework.authentication import TokenAuthentication
+
+from . import metrics
+from .cache import LRUCache
+from .models import User
+
+hits = metrics.counter('auth.token.hits', 'Tokens resolved from the in-process cache')
+misses = metrics.counter('auth.token.misses', 'Tokens resolved from the database')
+invalidations = metrics.counter('auth.token.invalidations', 'Users whose cached tokens were invalidated')
+latency = metrics.timer('auth.token.latency', 'Time to resolve a token to a user')
+
+_local = None
+
+
+def _entries():
+    global _local
+    if _local is None:
+        _local = LRUCache(getattr(settings, 'CMS_AUTH_CACHE_ENTRIES', 4096))
+    return _local
+
+
+def _shared():
+    return caches[getattr(settings, 'CMS_OBJECT_CACHE', 'default')]
+
+
+def _version_key(user_id):
+    # Namespaced by database, like the object cache
+    database = str(connections['default'].settings_dict['NAME'])
+    return f"appcms:auth:{hashlib.md5(database.encode()).hexdigest()[:8]}:user:{user_id}"
+
+
+def _user_version(user_id):
+    key = _version_key(user_id)
+    version = _shared().get(key)
+    if version is None:
+        _shared().add(key, uuid.uuid4().hex, timeout=None)
+        version = _shared().get(key)
+    return version
+
+
+def invalidate_user(user_id):
+    """ Drop every cached token of `user_id` in every process: now, and again once the transaction commits """
+    def bump():
+        _shared().set(_version_key(user_id), uuid.uuid4().hex, timeout=None)
+        invalidations.inc()
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def clear():
+    _entries().clear()
+
+
+def _detached(user):
+    # A copy per request, so one request can't leak cached relations or edits into another
+    user = copy.copy(user)
+    user._state = copy.copy(user._state)
+    user._state.fields_cache = {}
+    return user
+
+
+class Principal:
+    """ Who is making a request: role, group names and profile ids """
+    __slots__ = ('user_id', 'role', 'groups', 'manager_id', 'supervisor_id')
+
+    def __init__(self, user_id=None, role=None, groups=frozenset(), manager_id=None, supervisor_id=None):
+        self.user_id = user_id
+        self.role = role
+        self.groups = frozenset(groups)
+        self.manager_id = manager_id
+        self.supervisor_id = supervisor_id
+
+    @classmethod
+    def load(cls, user_id):
+        """ Resolve a user in one query: a row per group, joined to both profiles """
+        rows = list(
+            User.objects.filter(pk=user_id)
+            .values_list('role', 'groups__name', 'manager_profile__id', 'supervisor_profile__id')
+        )
+        if not rows:
+            return cls()
+        role, _, manager_id, supervisor_id = rows[0]
+        return cls(user_id, role, {row[1] for row in rows if row[1]}, manager_id, supervisor_id)
+
+    def in_group(self, name):
+        return name in self.groups
+
+    def __repr__(self):
+        return f"<Principal user={self.user_id} role={self.role} groups={sorted(self.groups)}>"
+
+
+ANONYMOUS = Principal()
+
+
+def get_principal(request):
+    """ The request's Principal, resolved at most once per cached token (or per request otherwise) """
+    user = request.user
+    if not user or not user.is_authenticated:
+        return ANONYMOUS
+    principal = getattr(user, 'principal', None)
+    if principal is None:
+        principal = user.principal = Principal.load(user.pk)
+    return principal
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        with latency.time():
+            entry = _entries().get(key)
+            if entry is not None:
+                expires, version, user, token = entry
+                if expires > time.monotonic() and version == _user_version(user.pk):
+                    hits.inc()
+                    return _detached(user), token
+
+            misses.inc()
+            ttl = getattr(settings, 'CMS_AUTH_CACHE_TTL', 60)
+            # The stamp is read before the user is loaded, so an invalidation that lands
+            # in between leaves the new entry already stale instead of stamped as current
+            user_id = None
+            if ttl:
+                user_id = entry[2].pk if entry is not None else (
+                    self.get_model().objects.filter(key=key).values_list('user_id', flat=True).first()
+                )
+            version = _user_version(user_id) if user_id is not None else None
+
+            user, token = super().authenticate_credentials(key)
+            user.principal = Principal.load(user.pk)
+            if version is not None and user.pk == user_id:
+                _entries().set(key, (time.monotonic() + ttl, version, user, token))
+            return _detached(user), token
@@ -0,0 +1,202 @@
+"""
+Worker availability: which workers are free on which days.
+
+`Worker.is_working` says nothing about dates, so the days each worker is
+booked are kept in `WorkerAvailability`: one row per worker and calendar
+year holding a bitmap, with a bit per day that is set while any of the
+worker's tasks runs (start_date to end_date inclusive). A year takes 46
+bytes, and a worker with no row for a year is free all that year.
+
+Whether a worker is free for a date range is then one AND of its bitmap
+with the range's mask on a Python int, well under a microsecond, so
+checking thousands of workers costs milliseconds, most of them spent
+reading the rows.
+
+Rows are refreshed by the Task signals (see signals.py) in the writing
+transaction. The years a write touches are recomputed for the workers it
+involves, from their tasks (an indexed query on task_worker_start_idx), so
+overlapping tasks need no reference counts. Writes that send no signals
+(bulk_create) call `tasks_changed()` themselves, and `manage.py
+rebuild_worker_availability` recomputes everything.
+
+`free_workers()` backs /workers/available/, which suggests the working
+workers (`is_working`) free for a range, least booked first. `assign()`
+backs /tasks/<pk>/assign/, which assigns a given working worker, or the
+best suggestion, if they are free for the task's days.
+"""
+import datetime
+import heapq
+from collections import Counter, defaultdict, namedtuple
+
+from django.apps import apps as global_apps
+from django.db import transaction
+
+from . import metrics, sqlite
+
+BITMAP_BYTES = 46  # 366 days
+MAX_LIMIT = 100
+
+refreshed = metrics.counter('availability.refreshed', 'Worker-year bitmaps recomputed after task writes')
+queries = metrics.timer('availability.queries', 'Free-worker lookups')
+
+# What one task contributes to its worker's bitmaps
+Booking = namedtuple('Booking', 'worker_id start end')
+
+
+def _model(name):
+    return global_apps.get_model('appcms', name)
+
+
+def booking(task):
+    """ The task's Booking, with its dates parsed (they may still be strings before a refresh from the database) """
+    field = task._meta.get_field
+    return Booking(task.worker_id, field('start_date').to_python(task.start_date), field('end_date').to_python(task.end_date))
+
+
+# Bitmaps
+
+def years(start, end):
+    return range(start.year, end.year + 1)
+
+
+def span_mask(year, start, end):
+    """ The bits of the days from `start` to `end` (inclusive) that fall in `year` """
+    january_1st = datetime.date(year, 1, 1)
+    first, last = max(start, january_1st), min(end, datetime.date(year, 12, 31))
+    if first > last:
+        return 0
+    return ((1 << ((last - first).days + 1)) - 1) << (first - january_1st).days
+
+
+def bitmap(intervals, year):
+    """ The days of `year` booked by any of the (start, end) `intervals` """
+    bits = 0
+    for start, end in intervals:
+        bits |= span_mask(year, start, end)
+    return bits
+
+
+def _intervals(Task, worker_id, year, exclude_task_id=None):
+    tasks = Task.objects.filter(
+        worker_id=worker_id, start_date__lte=datetime.date(year, 12, 31), end_date__gte=datetime.date(year, 1, 1),
+    )
+    if exclude_task_id is not None:
+        tasks = tasks.exclude(pk=exclude_task_id)
+    return tasks.order_by().values_list('start_date', 'end_date')
+
+
+# Maintenance
+
+def tasks_changed(changes):
+    """ Refresh the bitmaps touched by task writes given as (old Booking or None, new Booking or None) pairs """
+    touched = defaultdict(set)
+    for old, new in changes:
+        if old == new:
+            continue
+        for state in (old, new):
+            if state is not None and state.worker_id is not None:
+                touched[state.worker_id].update(years(state.start, state.end))
+    for worker_id in sorted(touched):
+        refresh(worker_id, sorted(touched[worker_id]))
+
+
+def refresh(worker_id, stale_years):
+    """ Recompute one worker's bitmaps for `stale_years` from its tasks """
+    Task, WorkerAvailability = _model('Task'), _model('WorkerAvailability')
+    for year in stale_years:
+        bits = bitmap(_intervals(Task, worker_id, year), year)
+        rows = WorkerAvailability.objects.filter(worker_id=worker_id, year=year)
+        if not bits:
+            rows.delete()
+        elif not rows.update(busy=bits.to_bytes(BITMAP_BYTES, 'little')):
+            WorkerAvailability.objects.create(worker_id=worker_id, year=year, busy=bits.to_bytes(BITMAP_BYTES, 'little'))
+        refreshed.inc()
+
+
+def rebuild(apps=global_apps):
+    """ Recompute every bitmap from the tasks; returns the number of worker-year rows written """
+    Task, WorkerAvailability = apps.get_model('appcms', 'Task'), apps.get_model('appcms', 'WorkerAvailability')
+    bitmaps = defaultdict(int)
+    tasks = Task.objects.filter(worker__isnull=False).order_by().values_list('worker_id', 'start_date', 'end_date')
+    for worker_id, start, end in tasks.iterator(chunk_size=10000):
+        for year in years(start, end):
+            bitmaps[worker_id, year] |= span_mask(year, start, end)
+    with transaction.atomic():
+        WorkerAvailability.objects.all().delete()
+        WorkerAvailability.objects.bulk_create([
+            WorkerAvailability(worker_id=worker_id, year=year, busy=bits.to_bytes(BITMAP_BYTES, 'little'))
+            for (worker_id, year), bits in sorted(bitmaps.items())
+        ], batch_size=1000)
+    return len(bitmaps)
+
+
+# Queries
+
+def bookings(start, end, exclude_task=None):
+    """
+    (ids of the workers booked on some day from `start` to `end`, {worker id:
+    days booked in the years of that range}). The days of `exclude_task`
+    itself don't count, so its own worker can be offered again.
+    """
+    Task, WorkerAvailability = _model('Task'), _model('WorkerAvailability')
+    masks = {year: span_mask(year, start, end) for year in years(start, end)}
+    rows = WorkerAvailability.objects.filter(year__in=list(masks)).values_list('worker_id', 'year', 'busy')
+
+    excluded = getattr(exclude_task, 'worker_id', None)
+    if excluded is not None:
+        own = {year: bitmap(_intervals(Task, excluded, year, exclude_task.pk), year) for year in masks}
+    busy, load = set(), Counter()
+    for worker_id, year, data in rows:
+        bits = own[year] if worker_id == excluded else int.from_bytes(data, 'little')
+        if bits & masks[year]:
+            busy.add(worker_id)
+        load[worker_id] += bits.bit_count()
+    return busy, load
+
+
+def free_workers(start, end, limit=20, exclude_task=None):
+    """ Working workers free on every day from `start` to `end`, least booked in those years first: dicts of id, name, booked_days """
+    with queries.time():
+        busy, load = bookings(start, end, exclude_task)
+        free = [
+            {'id': pk, 'name': name, 'booked_days': load.get(pk, 0)}
+            for pk, name in _model('Worker').objects.filter(is_working=True).order_by('pk').values_list('pk', 'name')
+            if pk not in busy
+        ]
+    return heapq.nsmallest(min(limit, MAX_LIMIT), free, key=lambda worker: (worker['booked_days'], worker['id']))
+
+
+def is_free(worker_id, start, end, exclude_task=None):
+    busy, _ = bookings(start, end, exclude_task)
+    return worker_id not in busy
+
+
+def assign(task_id, worker_id=None):
+    """
+    Assign a worker to the task: `worker_id` if working and free for the
+    task's days, else the least booked free worker. Raises ValueError when
+    the worker isn't working or is booked, or nobody is free, and
+    Worker.DoesNotExist for an unknown id.
+    The check and the write share one transaction (on SQLite one holding
+    the write lock from BEGIN IMMEDIATE), so two concurrent assignments
+    can't book a worker's days twice.
+    """
+    Task, Worker = _model('Task'), _model('Worker')
+    with sqlite.write_transaction():
+        task = Task.objects.select_for_update().get(pk=task_id)
+        if worker_id is None:
+            free = free_workers(task.start_date, task.end_date, limit=1, exclude_task=task)
+            if not free:
+                raise ValueError(f"No worker is free from {task.start_date} to {task.end_date}.")
+            worker_id = free[0]['id']
+        else:
+            is_working = Worker.objects.filter(pk=worker_id).values_list('is_working', flat=True).first()
+            if is_working is None:
+                raise Worker.DoesNotExist(f"Worker {worker_id} does not exist.")
+            if not is_working:
+                raise ValueError(f"Worker {worker_id} is not working.")
+            if not is_free(worker_id, task.start_date, task.end_date, exclude_task=task):
+                raise ValueError(f"Worker {worker_id} is booked between {task.start_date} and {task.end_date}.")
+        task.worker_id = worker_id
+        task.save(update_fields=['worker', 'updated_at'])
+    return task
@@ -0,0 +1,163 @@
+"""
+Read-through object cache for the read-heavy viewsets.
+
+Two tiers sit in front of the database: a bounded in-process LRU, and the
+Django cache named by `settings.CMS_OBJECT_CACHE` (shared between the
+processes on a host). Entries are stamped with a version token held in the
+shared tier; invalidating an object or a model's lists writes a fresh token,
+so a stale entry in any process's LRU is simply never matched again.
+
+Readers capture the token *before* loading from the database, and writers
+replace it only after their transaction commits, so a reader racing a writer
+can at worst store an entry that is already invalid.
+"""
+import copy
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, transaction
+
+from . import metrics, routers
+
+local_hits = metrics.counter('cache.object.local_hits', 'Served from the in-process LRU')
+shared_hits = metrics.counter('cache.object.shared_hits', 'Served from the shared cache tier')
+misses = metrics.counter('cache.object.misses', 'Loaded from the database')
+evictions = metrics.counter('cache.object.evictions', 'Dropped from the in-process LRU to make room')
+invalidations = metrics.counter('cache.object.invalidations', 'Objects and list generations invalidated')
+
+
+class LRUCache:
+    """ A small thread-safe least-recently-used map """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return None
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                evictions.inc()
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ObjectCache:
+    def __init__(self, alias=None, max_entries=None, timeout=None):
+        self.alias = alias or getattr(settings, 'CMS_OBJECT_CACHE', 'default')
+        self.timeout = timeout or getattr(settings, 'CMS_OBJECT_CACHE_TIMEOUT', 300)
+        self.local = LRUCache(max_entries or getattr(settings, 'CMS_OBJECT_CACHE_LOCAL_ENTRIES', 1024))
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    # Keys
+
+    @staticmethod
+    def _label(model):
+        # Namespaced by database so two databases (e.g. a test run) never share entries
+        database = str(connections['default'].settings_dict['NAME'])
+        return f"{hashlib.md5(database.encode()).hexdigest()[:8]}:{model._meta.label_lower}"
+
+    def _object_key(self, model, pk):
+        return f"appcms:obj:{self._label(model)}:{pk}"
+
+    def _list_key(self, model, variant):
+        return f"appcms:list:{self._label(model)}:{variant}"
+
+    def _token_key(self, key):
+        return f"{key}:token"
+
+    # Reads
+
+    def get_object(self, model, pk, loader):
+        """ The instance for `pk`, calling `loader()` on a miss """
+        return copy.copy(self._read_through(self._object_key(model, pk), self._token_key(self._object_key(model, pk)), loader))
+
+    def get_list(self, model, variant, loader):
+        """ Cached result of `loader()` for one list variant (e.g. the request URL) """
+        generation = self._generation_key(model)
+        return copy.deepcopy(self._read_through(self._list_key(model, variant), generation, loader))
+
+    def _read_through(self, key, token_key, loader):
+        token = self.shared.get(token_key)
+        if token is None:
+            token = uuid.uuid4().hex
+            # Another process may have set one first; whichever won is the current token
+            self.shared.add(token_key, token, timeout=None)
+            token = self.shared.get(token_key, token)
+
+        entry = self.local.get(key)
+        if entry is not None and entry[0] == token:
+            local_hits.inc()
+            return entry[1]
+
+        entry = self.shared.get(key)
+        if entry is not None and entry[0] == token:
+            shared_hits.inc()
+            self.local.set(key, entry)
+            return entry[1]
+
+        misses.inc()
+        # From the primary: a lagging replica would store old data under the new token
+        with routers.pin_to_primary():
+            value = loader()
+        entry = (token, value)
+        self.shared.set(key, entry, timeout=self.timeout)
+        self.local.set(key, entry)
+        return value
+
+    # Invalidation
+
+    def _generation_key(self, model):
+        return f"appcms:gen:{self._label(model)}"
+
+    def invalidate(self, model, pk=None):
+        """
+        Invalidate one object (if `pk` is given) and every cached list of
+        `model`: now, so this transaction's own reads miss, and again once it
+        commits, so nothing read in between survives.
+        """
+        def bump():
+            keys = [self._generation_key(model)]
+            if pk is not None:
+                object_key = self._object_key(model, pk)
+                keys.append(self._token_key(object_key))
+                self.local.delete(object_key)
+            self.shared.set_many({key: uuid.uuid4().hex for key in keys}, timeout=None)
+            invalidations.inc(len(keys))
+
+        bump()
+        transaction.on_commit(bump)
+
+    def clear(self):
+        self.local.clear()
+        self.shared.clear()
+
+
+object_cache = ObjectCache()
@@ -0,0 +1,186 @@
+"""
+Image derivatives for Media and Task photos.
+
+After an image is saved, `schedule()` queues it (once the transaction
+commits) on a process pool, so uploads return without waiting on Pillow.
+A worker writes a thumbnail and a medium-size copy next to the original,
+with the EXIF orientation applied and all metadata stripped, plus a JSON
+sidecar holding the extracted EXIF. When it finishes, the derivative names
+are stored on the row in `image_variants`, keyed by the original they were
+made from, and the serializers expose them as URLs.
+
+The rendering functions below only use Pillow and the filesystem, so the
+pool's processes never touch Django or the database.
+"""
+import json
+import logging
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+from PIL import ExifTags, Image, ImageOps
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Name: bounding box. Images are scaled down to fit, never up.
+SIZES = {
+    'thumb': (200, 200),
+    'medium': (800, 800),
+}
+JPEG_QUALITY = 85
+
+generated = metrics.counter('derivatives.generated', 'Images whose derivatives were written')
+failed = metrics.counter('derivatives.failed', 'Images whose derivatives could not be written')
+queued = metrics.counter('derivatives.queued', 'Images handed to the process pool')
+
+_executor = None
+
+
+# Rendering (runs in the pool)
+
+def variant_name(name, variant):
+    """ Storage name of a derivative, next to the original `name` """
+    stem, _ = os.path.splitext(name)
+    extension = '.json' if variant == 'exif' else '.jpg'
+    return f'{stem}.{variant}{extension}'
+
+
+def render(source_path, source_name):
+    """
+    Write every derivative of the image at `source_path` and return
+    {variant: storage name}. Raises on unreadable images.
+    """
+    directory = os.path.dirname(source_path)
+    variants = {}
+    with Image.open(source_path) as image:
+        exif = extract_exif(image)
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        for variant, box in SIZES.items():
+            scaled = image.copy()
+            scaled.thumbnail(box)
+            name = variant_name(source_name, variant)
+            # Saved without exif=/icc_profile=, so none of the original's metadata is carried over
+            _write(os.path.join(directory, os.path.basename(name)), lambda f: scaled.save(f, 'JPEG', quality=JPEG_QUALITY, optimize=True))
+            variants[variant] = name
+
+    name = variant_name(source_name, 'exif')
+    _write(os.path.join(directory, os.path.basename(name)), lambda f: f.write(json.dumps(exif, sort_keys=True).encode()))
+    variants['exif'] = name
+    return variants
+
+
+def extract_exif(image):
+    """ EXIF tags (including the GPS block) as a JSON-friendly dict """
+    exif = image.getexif()
+    blocks = ((ExifTags.IFD.Exif, ExifTags.TAGS), (ExifTags.IFD.GPSInfo, ExifTags.GPSTAGS))
+    # The top level only holds pointers to the nested blocks; inline them instead
+    data = {
+        ExifTags.TAGS.get(tag, str(tag)): _json_value(value)
+        for tag, value in exif.items()
+        if tag not in dict(blocks)
+    }
+    for ifd, names in blocks:
+        block = exif.get_ifd(ifd)
+        if block:
+            data[ifd.name] = {names.get(tag, str(tag)): _json_value(value) for tag, value in block.items()}
+    return data
+
+
+def _json_value(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace').rstrip('\x00')
+    if isinstance(value, (tuple, list)):
+        return [_json_value(item) for item in value]
+    if isinstance(value, (int, float, str)) or value is None:
+        return value
+    try:
+        return float(value)  # IFDRational
+    except (TypeError, ValueError, ZeroDivisionError):
+        return str(value)
+
+
+def _write(path, writer):
+    # Write beside the target and rename, so readers never see a partial file
+    partial = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(partial, 'wb') as f:
+            writer(f)
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+# Scheduling (runs in the web process)
+
+def needs_derivatives(instance):
+    return bool(instance.image) and instance.image_variants.get('source') != instance.image.name
+
+
+def schedule(instance):
+    """ Produce derivatives for `instance.image` once the current transaction commits """
+    model, pk, name = type(instance), instance.pk, instance.image.name
+    try:
+        path = instance.image.path
+    except NotImplementedError:
+        logger.warning("Storage for %s has no local paths; skipping derivatives.", name)
+        return
+    transaction.on_commit(lambda: _submit(model, pk, path, name))
+
+
+def _submit(model, pk, path, name):
+    workers = getattr(settings, 'CMS_DERIVATIVE_WORKERS', 2)
+    if not workers:
+        # Inline mode (tests, management commands)
+        try:
+            variants = render(path, name)
+        except Exception:
+            failed.inc()
+            logger.exception("Could not render derivatives for %s", name)
+            return
+        store(model, pk, name, variants)
+        return
+
+    future = _get_executor(workers).submit(render, path, name)
+    queued.inc()
+    future.add_done_callback(lambda done: _finished(done, model, pk, name))
+
+
+def _get_executor(workers):
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=workers)
+    return _executor
+
+
+def _finished(future, model, pk, name):
+    # Called on the pool's result thread, which opens its own database connection
+    try:
+        variants = future.result()
+    except Exception:
+        failed.inc()
+        logger.exception("Could not render derivatives for %s", name)
+        return
+    try:
+        store(model, pk, name, variants)
+    finally:
+        connection.close()
+
+
+def store(model, pk, name, variants):
+    """ Record rendered `variants` on the row, unless its image has changed since """
+    instance = model._default_manager.filter(pk=pk).first()
+    if instance is None or instance.image.name != name:
+        # Deleted, or given a new image that has its own derivatives coming
+        return
+    instance.image_variants = {'source': name, **variants}
+    # A regular save, so caches, validators and the sync feed see the new URLs
+    instance.save(update_fields=['image_variants', 'updated_at'])
+    generated.inc()
@@ -0,0 +1,160 @@
+"""
+Serving uploaded files with HTTP range support.
+
+`serve()` answers a GET for one stored file. Whole files are returned as a
+FileResponse over the open file, so WSGI servers with a `wsgi.file_wrapper`
+(gunicorn, uWSGI) send them with sendfile(2) rather than copying them
+through Python. A single `Range: bytes=...` is answered with 206 and only
+those bytes, sent the same way, and `If-Range` falls back to the whole file when the client's
+copy is stale. With `settings.CMS_FILE_OFFLOAD` set, the response carries no
+body at all and the front-end server sends the file itself:
+
+    'x-accel'     nginx: X-Accel-Redirect to CMS_FILE_OFFLOAD_PREFIX + name
+                  (an `internal` location aliased to MEDIA_ROOT)
+    'x-sendfile'  Apache mod_xsendfile / lighttpd: X-Sendfile with the path
+
+Both servers handle Range themselves in that mode.
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+from . import metrics
+
+served = metrics.counter('files.served', 'Whole files streamed by the app')
+ranges = metrics.counter('files.ranges', 'Partial (206) responses')
+offloaded = metrics.counter('files.offloaded', 'Files handed to the front-end server')
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeFile:
+    """
+    Read-only view of `length` bytes of `file` from `start`. Its fileno() is
+    the file's, positioned at `start`: a WSGI file_wrapper sends from the
+    current position up to Content-Length (PEP 3333), so gunicorn and uWSGI
+    sendfile(2) the range too; read() serves everything else.
+    """
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.remaining = length
+        file.seek(start)
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """
+    (start, end) inclusive for a single-range `Range` header, None to send
+    the whole file (absent, malformed or multi-range), or False when the
+    range can't be satisfied.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if not length:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        return False
+    return start, end
+
+
+def file_etag(stat):
+    return f'"{int(stat.st_mtime):x}-{stat.st_size:x}"'
+
+
+def serve(request, storage, name, download=False):
+    """
+    Response for the file `name` in `storage`, honouring Range, If-Range and
+    conditional headers. Raises FileNotFoundError if it isn't there.
+    """
+    path = storage.path(name)
+    stat = os.stat(path)
+    etag = file_etag(stat)
+    last_modified = int(stat.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return response
+
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    offload = getattr(settings, 'CMS_FILE_OFFLOAD', None)
+    if offload:
+        response = HttpResponse(content_type=content_type)
+        if offload == 'x-accel':
+            prefix = getattr(settings, 'CMS_FILE_OFFLOAD_PREFIX', '/protected-media/')
+            response['X-Accel-Redirect'] = quote(prefix.rstrip('/') + '/' + name)
+        else:
+            response['X-Sendfile'] = path
+        offloaded.inc()
+        return _finish(response, name, etag, last_modified, download)
+
+    byte_range = parse_range(request.headers.get('Range'), stat.st_size)
+    if byte_range is not None and not _if_range_matches(request, etag, last_modified):
+        byte_range = None
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{stat.st_size}'
+        return response
+
+    file = open(path, 'rb')
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+        served.inc()
+    else:
+        start, end = byte_range
+        response = FileResponse(RangeFile(file, start, end - start + 1), status=206, content_type=content_type)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+        ranges.inc()
+    return _finish(response, name, etag, last_modified, download)
+
+
+def _if_range_matches(request, etag, last_modified):
+    """ False when If-Range names another version of the file, so it must be sent whole """
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    if value.startswith('"') or value.startswith('W/'):
+        return value == etag  # Weak validators never match (RFC 9110 13.1.5)
+    return parse_http_date_safe(value) == last_modified
+
+
+def _finish(response, name, etag, last_modified, download):
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = 'private, no-cache'
+    disposition = 'attachment' if download else 'inline'
+    response['Content-Disposition'] = f"{disposition}; filename*=UTF-8''{quote(os.path.basename(name))}"
+    return response
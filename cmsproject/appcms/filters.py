@@ -0,0 +1,131 @@
+"""
+Query-string filtering and ordering for the list endpoints.
+
+A viewset lists the parameters it accepts in `filter_fields`, mapping each
+to a model lookup (`{'project': 'project', 'start_date_after':
+'start_date__gte'}`); values are parsed by the model field, and a value that
+doesn't parse is a 400. `ordering_fields` whitelists what `?ordering=` may
+name (with an optional leading '-'); the chosen field becomes the leading
+keyset pagination key, with the primary key as the tie-breaker.
+
+Every combination of filters and orderings a viewset accepts is served by
+one of its model's indexes (see Meta.indexes); the test suite checks the
+query plans. One-sided date ranges are closed so SQLite's planner picks the
+index for them too.
+"""
+import datetime
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import models
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+ORDERING_PARAM = 'ordering'
+LOWER_BOUNDS = ('gte', 'gt')
+UPPER_BOUNDS = ('lte', 'lt')
+EARLIEST = datetime.date(1, 1, 1)
+LATEST = datetime.date(9999, 12, 31)
+
+
+def parse_filter(model, lookup, value):
+    """
+    (lookup, value) with `value` parsed by the field behind `lookup`; raises
+    ValidationError if it doesn't parse. A plain date bounding a datetime
+    field covers that whole day.
+    """
+    field = model._meta.get_field(lookup.split('__')[0])
+    if field.is_relation:
+        field = field.target_field
+    parsed = field.to_python(value)
+    if field.choices:
+        field.validate(parsed, None)
+    if isinstance(field, models.DateTimeField):
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        if lookup.endswith('__lte') and parse_date(value) is not None:
+            return lookup[:-len('__lte')] + '__lt', parsed + datetime.timedelta(days=1)
+    return lookup, parsed
+
+
+class FieldFilterBackend(BaseFilterBackend):
+    """ Applies the `filter_fields` parameters present in the query string """
+
+    def filter_queryset(self, request, queryset, view):
+        filter_fields = getattr(view, 'filter_fields', {})
+        filters, errors = {}, {}
+        for param, lookup in filter_fields.items():
+            value = request.query_params.get(param)
+            if value in (None, ''):
+                continue
+            try:
+                lookup, value = parse_filter(queryset.model, lookup, value)
+            except DjangoValidationError as e:
+                errors[param] = e.messages
+                continue
+            filters[lookup] = value
+        if errors:
+            raise ValidationError(errors)
+        return queryset.filter(**close_ranges(queryset.model, filters))
+
+
+def close_ranges(model, filters):
+    """
+    Give a one-sided date range its other bound. Without histograms SQLite's
+    planner guesses an open range matches a quarter of the table and scans
+    it; a closed range counts as selective and is read from the index.
+    """
+    closed = dict(filters)
+    for lookup in filters:
+        name, _, operator = lookup.rpartition('__')
+        if operator not in LOWER_BOUNDS + UPPER_BOUNDS or not isinstance(model._meta.get_field(name), models.DateField):
+            continue
+        lower = operator in LOWER_BOUNDS
+        if any(f'{name}__{other}' in filters for other in (UPPER_BOUNDS if lower else LOWER_BOUNDS)):
+            continue
+        bound = LATEST if lower else EARLIEST
+        if isinstance(model._meta.get_field(name), models.DateTimeField):
+            bound = datetime.datetime.combine(bound, datetime.time(), tzinfo=datetime.timezone.utc)
+        closed[f'{name}__lte' if lower else f'{name}__gte'] = bound
+    return closed
+
+
+def keyset_ordering(view):
+    """
+    The keyset ordering for the view's current request: ?ordering= when the
+    view whitelists it, else the view's `keyset_ordering`.
+    """
+    request = getattr(view, 'request', None)
+    requested = request.query_params.get(ORDERING_PARAM) if request is not None else None
+    if not requested:
+        return getattr(view, 'keyset_ordering', None)
+
+    field = requested.lstrip('-')
+    if field not in getattr(view, 'ordering_fields', ()):
+        allowed = ', '.join(getattr(view, 'ordering_fields', ())) or 'none'
+        raise ValidationError({ORDERING_PARAM: [f"Cannot order by '{field}'. Allowed: {allowed}."]})
+    descending = requested.startswith('-')
+    if field in ('id', 'pk'):
+        return (requested,)
+    return (requested, '-id' if descending else 'id')
+
+
+class KeysetOrderingFilter(BaseFilterBackend):
+    """
+    Validates ?ordering=. The ordering itself is applied by KeysetPagination,
+    which reads it through keyset_ordering() so cursors follow the same keys.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        ordering = keyset_ordering(view)
+        if ordering and view.paginator is None:
+            queryset = queryset.order_by(*ordering)
+        return queryset
+
+
+def date_range(field, name=None):
+    """ filter_fields entries for an inclusive ?<name>_after= / ?<name>_before= range on `field` """
+    name = name or field
+    return {f'{name}_after': f'{field}__gte', f'{name}_before': f'{field}__lte'}
+
@@ -0,0 +1,233 @@
+"""
+Inventory engine for Resource stock.
+
+Stock is kept as an append-only ledger. `Resource.quantity` is a snapshot
+balance as of movement `Resource.snapshot_through`, and the live balance is
+that snapshot plus the sum of every `ResourceMovement` recorded since. Every
+reduce, restore and task change inserts movements instead of rewriting the
+resource row; `compact()` periodically folds old movements into a new
+snapshot so balances stay cheap to compute.
+
+A reduction is a single guarded statement,
+
+    INSERT INTO movement (...) SELECT ... FROM resource
+    WHERE id = ? AND <snapshot + movements since> + delta >= 0
+
+so stock can never go negative and no lock is held across round trips. On
+SQLite the transaction is a `sqlite.write_transaction()`, taking the
+database write lock at BEGIN IMMEDIATE, which alone serializes reductions,
+and is retried if that times out. Backends with row locks need the resource
+row locked first as well, see `_lock()`.
+"""
+from datetime import timedelta
+
+from django.db import connections, router
+from django.db.models import Count, F, Max, Min, Sum
+from django.utils import timezone
+
+from . import metrics, sqlite
+from .models import Resource, ResourceMovement, ResourceSnapshot
+from .signals import resource_balance_changed
+
+# Movements newer than this are never folded, so a transaction that committed
+# late with a lower id can't slip underneath a snapshot.
+COMPACTION_HORIZON = timedelta(minutes=1)
+
+applied = metrics.counter('inventory.applied', 'Stock changes that were applied')
+rejected = metrics.counter('inventory.rejected', 'Reductions refused for insufficient stock')
+contended = metrics.counter(
+    'inventory.contended',
+    'Reductions refused although the caller last saw enough stock (lost a race)',
+)
+compacted = metrics.counter('inventory.compacted', 'Movements folded into snapshots')
+
+
+class InsufficientQuantity(ValueError):
+    """ Raised when a reduction would take a resource below zero """
+
+    def __init__(self, resource_id, available, requested):
+        self.resource_id = resource_id
+        self.available = available
+        self.requested = requested
+        super().__init__(f"Insufficient quantity. Available: {available}, Requested: {requested}")
+
+
+def reduce(resource_id, amount, expected=None, reason=ResourceMovement.REDUCE, task_id=None):
+    """
+    Take `amount` from a resource and return its new balance.
+
+    `expected` is the balance the caller last saw; when the reduction is
+    refused even though that looked sufficient, it is counted as contention.
+    """
+    _check_amount(amount)
+    return record(resource_id, [(-amount, reason, task_id)], expected=expected)
+
+
+def restore(resource_id, amount, reason=ResourceMovement.RESTORE, task_id=None):
+    """ Give `amount` back to a resource and return its new balance """
+    _check_amount(amount)
+    return record(resource_id, [(amount, reason, task_id)])
+
+
+def adjust(resource_id, delta, expected=None, reason=ResourceMovement.ADJUST, task_id=None):
+    """ Record a signed change: negative deltas are guarded reductions """
+    if not delta:
+        return balance(resource_id)
+    return record(resource_id, [(delta, reason, task_id)], expected=expected)
+
+
+@sqlite.retry_on_lock
+def set_balance(resource_id, quantity):
+    """ Bring a resource to `quantity` with a single adjusting movement """
+    with sqlite.write_transaction(using=router.db_for_write(ResourceMovement)):
+        _lock(resource_id)
+        return adjust(resource_id, quantity - balance(resource_id))
+
+
+@sqlite.retry_on_lock
+def record(resource_id, movements, expected=None):
+    """
+    Append `movements` — (delta, reason, task_id) tuples — for one resource.
+
+    The whole list is applied or refused together: if its net change would
+    take the balance below zero nothing is recorded and InsufficientQuantity
+    is raised. Returns the new balance.
+    """
+    net = sum(delta for delta, _, _ in movements)
+    alias = router.db_for_write(ResourceMovement)
+
+    with sqlite.write_transaction(using=alias):
+        if net < 0:
+            _lock(resource_id)
+        first, rest = movements[0], movements[1:]
+        if not _guarded_insert(alias, resource_id, first, net):
+            available = balance(resource_id)  # raises Resource.DoesNotExist
+            rejected.inc()
+            if expected is not None and expected >= -net:
+                contended.inc()
+            raise InsufficientQuantity(resource_id, available, -net)
+
+        # The guard above covered the whole list, and we now hold the write lock
+        if rest:
+            now = timezone.now()
+            ResourceMovement.objects.bulk_create([
+                ResourceMovement(resource_id=resource_id, delta=delta, reason=reason, task_id=task_id, created_at=now)
+                for delta, reason, task_id in rest
+            ])
+        applied.inc(len(movements))
+        resource_balance_changed.send(sender=Resource, resource_id=resource_id)
+        return balance(resource_id)
+
+
+def balance(resource_id):
+    """ Live balance of a resource """
+    resource = Resource.objects.with_balance().filter(pk=resource_id).values_list('ledger_balance', flat=True).first()
+    if resource is None:
+        raise Resource.DoesNotExist(f"Resource {resource_id} does not exist.")
+    return resource
+
+
+def balance_at(resource_id, when):
+    """
+    Balance of a resource at `when`: the newest snapshot whose folded
+    movements are all older than `when`, plus the movements after it up to
+    `when`. Returns None if `when` predates the resource's history.
+    """
+    snapshot = (
+        ResourceSnapshot.objects.filter(resource_id=resource_id, as_of__lte=when)
+        .order_by('-as_of', '-movement_id')
+        .values('quantity', 'movement_id')
+        .first()
+    )
+    if snapshot is None:
+        if not Resource.objects.filter(pk=resource_id).exists():
+            raise Resource.DoesNotExist(f"Resource {resource_id} does not exist.")
+        return None
+
+    since = ResourceMovement.objects.filter(
+        resource_id=resource_id, id__gt=snapshot['movement_id'], created_at__lte=when
+    ).aggregate(total=Sum('delta'))['total']
+    return snapshot['quantity'] + (since or 0)
+
+
+def compact(horizon=COMPACTION_HORIZON, resource_ids=None):
+    """
+    Fold movements older than `horizon` into a new snapshot for every
+    resource that has any. Returns the number of resources compacted.
+    """
+    cutoff = timezone.now() - horizon
+    resources = Resource.objects.filter(movements__id__gt=F('snapshot_through'))
+    if resource_ids is not None:
+        resources = resources.filter(pk__in=resource_ids)
+
+    count = 0
+    for resource_id, through in resources.values_list('pk', 'snapshot_through').distinct().order_by('pk'):
+        if _compact_one(resource_id, through, cutoff):
+            count += 1
+    return count
+
+
+@sqlite.retry_on_lock
+def _compact_one(resource_id, through, cutoff):
+    pending = ResourceMovement.objects.filter(resource_id=resource_id, id__gt=through)
+    # Stop at the first recent movement so nothing older can be skipped
+    first_recent = pending.filter(created_at__gte=cutoff).aggregate(first=Min('id'))['first']
+    fold = pending.filter(id__lt=first_recent) if first_recent is not None else pending
+    folded = fold.aggregate(total=Sum('delta'), last=Max('id'), newest=Max('created_at'), count=Count('id'))
+    if folded['last'] is None:
+        return False
+
+    with sqlite.write_transaction(using=router.db_for_write(Resource)):
+        # Guard on the old snapshot so two compactors can't fold the same movements
+        updated = Resource.objects.filter(pk=resource_id, snapshot_through=through).update(
+            quantity=F('quantity') + folded['total'], snapshot_through=folded['last']
+        )
+        if not updated:
+            return False
+        quantity = Resource.objects.filter(pk=resource_id).values_list('quantity', flat=True).get()
+        ResourceSnapshot.objects.create(
+            resource_id=resource_id, quantity=quantity, movement_id=folded['last'], as_of=folded['newest']
+        )
+    compacted.inc(folded['count'])
+    return True
+
+
+def _check_amount(amount):
+    if not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0:
+        raise ValueError("Amount must be a positive integer.")
+
+
+def _lock(resource_id):
+    """
+    Serialize reductions per resource where the backend has row locks.
+
+    The guarded INSERT alone isn't enough there: under READ COMMITTED two
+    transactions can each evaluate the guard's SUM without seeing the
+    other's uncommitted movement, both pass, and together overdraw the
+    resource. Holding the resource row makes the second guard wait for the
+    first transaction and then see its movement.
+    """
+    connection = connections[router.db_for_write(Resource)]
+    if connection.features.has_select_for_update:
+        list(Resource.objects.select_for_update().filter(pk=resource_id).values_list('pk', flat=True))
+
+
+def _guarded_insert(alias, resource_id, movement, net):
+    """ Insert one movement only if the balance can absorb `net`; True if inserted """
+    connection = connections[alias]
+    qn = connection.ops.quote_name
+    resources = qn(Resource._meta.db_table)
+    movements = qn(ResourceMovement._meta.db_table)
+    delta, reason, task_id = movement
+    created_at = connection.ops.adapt_datetimefield_value(timezone.now())
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {movements} (resource_id, delta, reason, task_id, created_at) "
+            f"SELECT r.id, %s, %s, %s, %s FROM {resources} r "
+            f"WHERE r.id = %s AND r.quantity + COALESCE("
+            f"(SELECT SUM(m.delta) FROM {movements} m WHERE m.resource_id = r.id AND m.id > r.snapshot_through), 0"
+            f") + %s >= 0",
+            [delta, reason, task_id, created_at, resource_id, net],
+        )
+        return cursor.rowcount == 1
@@ -0,0 +1,231 @@
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from django.core.asgi import get_asgi_application
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from rest_framework.authtoken.models import Token
+
+from appcms.models import Manager, Project, Supervisor, User
+
+
+class Gauge:
+    """ Requests in flight and threads alive, with their peaks """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = self.peak = 0
+        self.peak_threads = threading.active_count()
+
+    def __enter__(self):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def __exit__(self, *exc):
+        with self.lock:
+            self.current -= 1
+
+
+class TrickleInput:
+    """ wsgi.input that hands over the body a piece at a time, like a slow client """
+
+    def __init__(self, pieces, delay):
+        self.pieces = list(pieces)
+        self.delay = delay
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while self.pieces and (size < 0 or len(self.buffer) < size):
+            time.sleep(self.delay)
+            self.buffer += self.pieces.pop(0)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while self.pieces and b'\n' not in self.buffer:
+            time.sleep(self.delay)
+            self.buffer += self.pieces.pop(0)
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        data, self.buffer = self.buffer[:end], self.buffer[end:]
+        return data
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare WSGI (a fixed thread pool) and ASGI (the /async/ views) on the same workload: "
+        "many clients uploading a video slowly to the media upload endpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=200, help="Uploads to run, all started at once.")
+        parser.add_argument('--threads', type=int, default=8, help="WSGI worker threads (as in gunicorn --threads).")
+        parser.add_argument('--size-kb', type=int, default=64, help="Size of each upload.")
+        parser.add_argument('--pieces', type=int, default=10, help="Pieces each client sends its body in.")
+        parser.add_argument('--delay-ms', type=int, default=50, help="Pause before each piece, for a slow link.")
+        parser.add_argument('--host', default='localhost', help="Host header; must be in ALLOWED_HOSTS.")
+        parser.add_argument('--only', choices=['wsgi', 'asgi'], help="Run one side only.")
+
+    def handle(self, *args, **options):
+        fixture = self.create_fixture()
+        try:
+            body = encode_multipart(BOUNDARY, {
+                'project': fixture['project'],
+                'supervisor': fixture['supervisor'],
+                'manager': fixture['manager'],
+                'file': SimpleUploadedFile('bench.mp4', os.urandom(options['size_kb'] * 1024)),
+            })
+            step = -(-len(body) // options['pieces'])
+            pieces = [body[i:i + step] for i in range(0, len(body), step)]
+            request = {
+                'pieces': pieces,
+                'delay': options['delay_ms'] / 1000,
+                'length': len(body),
+                'token': fixture['token'],
+                'host': options['host'],
+            }
+
+            if options['only'] != 'asgi':
+                self.report(f"wsgi ({options['threads']} threads)", *self.run_wsgi(request, options['clients'], options['threads']))
+            if options['only'] != 'wsgi':
+                self.report("asgi", *self.run_asgi(request, options['clients']))
+        finally:
+            self.delete_fixture(fixture)
+
+    # Workload
+
+    def create_fixture(self):
+        tag = uuid.uuid4().hex[:8]
+        supervisor = Supervisor.objects.create(user=User.objects.create_user(f'bench-sup-{tag}', role='supervisor'))
+        manager_user = User.objects.create_user(f'bench-man-{tag}', role='manager')
+        manager = Manager.objects.create(user=manager_user, department='Benchmark', phone_number='0')
+        project = Project.objects.create(name=f'Benchmark {tag}', location='-', budget=0, timeline='2000-01-01', supervisor=supervisor)
+        return {
+            'users': [supervisor.user_id, manager_user.pk],
+            'project': project.pk,
+            'supervisor': supervisor.pk,
+            'manager': manager.pk,
+            'token': Token.objects.create(user=manager_user).key,
+        }
+
+    def delete_fixture(self, fixture):
+        # Cascades to the uploaded Media rows; their blobs are left to gc_blobs
+        Project.objects.filter(pk=fixture['project']).delete()
+        User.objects.filter(pk__in=fixture['users']).delete()
+
+    # WSGI: each request holds a pool thread from its first byte to its last
+
+    def run_wsgi(self, request, clients, threads):
+        application = get_wsgi_application()
+        gauge = Gauge()
+
+        def one():
+            environ = {
+                'REQUEST_METHOD': 'POST',
+                'PATH_INFO': '/media/upload/',
+                'QUERY_STRING': '',
+                'SERVER_NAME': request['host'],
+                'SERVER_PORT': '80',
+                'SERVER_PROTOCOL': 'HTTP/1.1',
+                'REMOTE_ADDR': '127.0.0.1',
+                'HTTP_HOST': request['host'],
+                'HTTP_AUTHORIZATION': f"Token {request['token']}",
+                'CONTENT_TYPE': MULTIPART_CONTENT,
+                'CONTENT_LENGTH': str(request['length']),
+                'wsgi.input': TrickleInput(request['pieces'], request['delay']),
+                'wsgi.errors': sys.stderr,
+                'wsgi.version': (1, 0),
+                'wsgi.url_scheme': 'http',
+                'wsgi.multithread': True,
+                'wsgi.multiprocess': False,
+                'wsgi.run_once': False,
+            }
+            statuses = []
+            started = time.perf_counter()
+            with gauge:
+                response = application(environ, lambda status, headers, exc_info=None: statuses.append(status))
+                b''.join(response)
+                response.close()
+            return int(statuses[0].split()[0]), time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            results = list(pool.map(lambda _: one(), range(clients)))
+        return results, time.perf_counter() - started, gauge
+
+    # ASGI: a request is a coroutine; no thread is held while its body arrives
+
+    def run_asgi(self, request, clients):
+        application = get_asgi_application()
+        gauge = Gauge()
+
+        async def one():
+            pieces = list(request['pieces'])
+            statuses = []
+
+            async def receive():
+                if not pieces:
+                    # Body done: block until cancelled, as a connected client would
+                    await asyncio.Event().wait()
+                await asyncio.sleep(request['delay'])
+                return {'type': 'http.request', 'body': pieces.pop(0), 'more_body': bool(pieces)}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    statuses.append(message['status'])
+
+            scope = {
+                'type': 'http',
+                'asgi': {'version': '3.0'},
+                'http_version': '1.1',
+                'method': 'POST',
+                'scheme': 'http',
+                'path': '/async/media/upload/',
+                'raw_path': b'/async/media/upload/',
+                'query_string': b'',
+                'root_path': '',
+                'headers': [
+                    (b'host', request['host'].encode()),
+                    (b'authorization', f"Token {request['token']}".encode()),
+                    (b'content-type', MULTIPART_CONTENT.encode()),
+                    (b'content-length', str(request['length']).encode()),
+                ],
+                'client': ('127.0.0.1', 0),
+                'server': (request['host'], 80),
+            }
+            started = time.perf_counter()
+            with gauge:
+                await application(scope, receive, send)
+            return statuses[0], time.perf_counter() - started
+
+        async def run():
+            return await asyncio.gather(*(one() for _ in range(clients)))
+
+        started = time.perf_counter()
+        results = async_to_sync(run)()
+        return results, time.perf_counter() - started, gauge
+
+    def report(self, label, results, elapsed, gauge):
+        latencies = sorted(latency for _, latency in results)
+        failed = sum(1 for status, _ in results if status != 201)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        self.stdout.write(
+            f"{label}: {len(results)} uploads in {elapsed:.2f}s ({len(results) / elapsed:.1f}/s), "
+            f"latency p50 {statistics.median(latencies):.3f}s p95 {p95:.3f}s max {latencies[-1]:.3f}s, "
+            f"peak in flight {gauge.peak}, peak threads {gauge.peak_threads}, failed {failed}"
+        )
+
@@ -0,0 +1,27 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from appcms import inventory
+
+
+class Command(BaseCommand):
+    help = "Fold old resource movements into new snapshots. Use --loop to keep running in the background."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--horizon', type=int, default=int(inventory.COMPACTION_HORIZON.total_seconds()),
+            help="Only fold movements older than this many seconds.",
+        )
+        parser.add_argument('--loop', action='store_true', help="Keep compacting until interrupted.")
+        parser.add_argument('--interval', type=int, default=300, help="Seconds between runs with --loop.")
+
+    def handle(self, *args, **options):
+        horizon = timedelta(seconds=options['horizon'])
+        while True:
+            count = inventory.compact(horizon=horizon)
+            self.stdout.write(f"Compacted {count} resource(s).")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
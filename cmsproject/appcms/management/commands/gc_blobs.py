@@ -0,0 +1,59 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from appcms import derivatives
+from appcms.models import Blob
+from appcms.signals import FILE_FIELDS
+from appcms.storage import content_store, is_blob
+
+
+class Command(BaseCommand):
+    help = "Delete stored blobs that no row has referred to for the grace period."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace-hours', type=int, default=24,
+            help="Keep unreferenced blobs this long, for uploads whose row hasn't been saved yet.",
+        )
+        parser.add_argument('--recount', action='store_true', help="Rebuild every refcount from the rows first.")
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be deleted.")
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            self.stdout.write(f"Corrected {self.recount()} refcount(s).")
+
+        cutoff = timezone.now() - timedelta(hours=options['grace_hours'])
+        candidates = Blob.objects.filter(refcount__lte=0, updated_at__lt=cutoff)
+        if options['dry_run']:
+            for name in candidates.values_list('name', flat=True):
+                self.stdout.write(name)
+            return
+
+        deleted = 0
+        for blob_id, name in candidates.values_list('pk', 'name').iterator():
+            with transaction.atomic():
+                # Re-checked under the row lock: an upload of the same bytes touches the row first
+                removed, _ = Blob.objects.filter(pk=blob_id, refcount__lte=0, updated_at__lt=cutoff).delete()
+                if removed:
+                    content_store.purge(name)
+                    for variant in (*derivatives.SIZES, 'exif'):
+                        content_store.purge(derivatives.variant_name(name, variant))
+                    deleted += 1
+        self.stdout.write(f"Deleted {deleted} blob(s).")
+
+    def recount(self):
+        counts = Counter()
+        for model, fields in FILE_FIELDS.items():
+            for row in model._base_manager.values_list(*fields).iterator():
+                counts.update(name for name in row if is_blob(name))
+
+        corrected = 0
+        for blob in Blob.objects.iterator():
+            if blob.refcount != counts.get(blob.name, 0):
+                Blob.objects.filter(pk=blob.pk).update(refcount=counts.get(blob.name, 0), updated_at=timezone.now())
+                corrected += 1
+        return corrected
@@ -0,0 +1,32 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from appcms import worker_import
+
+
+class Command(BaseCommand):
+    help = "Create workers from a CSV or NDJSON file, reporting every rejected row."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV (with a header row) or NDJSON file.")
+        parser.add_argument('--type', choices=['csv', 'ndjson'], help="File type; guessed from the extension if omitted.")
+        parser.add_argument('--mode', choices=['atomic', 'partial'], default='partial',
+                            help="'atomic' creates nothing unless every row is valid.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['type'] or ('csv' if os.path.splitext(path)[1].lower() == '.csv' else 'ndjson')
+        try:
+            with open(path, 'rb') as stream:
+                report = worker_import.import_workers(worker_import.read_rows(stream, fmt), options['mode'])
+        except OSError as e:
+            raise CommandError(str(e))
+        except worker_import.ImportFileError as e:
+            created = e.report['created'] if e.report else 0
+            raise CommandError(f"{path}: {e} ({created} worker(s) created before the error)")
+
+        for error in report['errors']:
+            messages = '; '.join(f"{field}: {' '.join(texts)}" for field, texts in error['errors'].items())
+            self.stderr.write(f"Row {error['row']}: {messages}")
+        self.stdout.write(f"Created {report['created']} worker(s); {report['failed']} row(s) rejected.")
@@ -0,0 +1,42 @@
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand
+
+from appcms.signals import FILE_FIELDS
+from appcms.storage import content_store, is_blob
+
+
+class Command(BaseCommand):
+    help = "Move existing uploads into the content-addressed blob store, deduplicating identical files."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete-originals', action='store_true', help="Remove each old file once no row uses it.")
+
+    def handle(self, *args, **options):
+        legacy = FileSystemStorage()  # MEDIA_ROOT, where upload_to paths were written
+        moved, missing, originals = 0, 0, set()
+
+        for model, fields in FILE_FIELDS.items():
+            for instance in model._base_manager.order_by('pk').iterator():
+                changed = []
+                for field in fields:
+                    name = getattr(instance, field).name
+                    if not name or is_blob(name):
+                        continue
+                    if not legacy.exists(name):
+                        self.stderr.write(f"{model.__name__} {instance.pk}: {name} not found")
+                        missing += 1
+                        continue
+                    with legacy.open(name) as original:
+                        setattr(instance, field, content_store.save(name, original))
+                    originals.add(name)
+                    changed.append(field)
+                if changed:
+                    # A regular save, so refcounts, caches and the sync feed follow
+                    instance.save(update_fields=[*changed, 'updated_at'])
+                    moved += len(changed)
+
+        if options['delete_originals']:
+            for name in originals:
+                legacy.delete(name)
+
+        self.stdout.write(f"Moved {moved} file(s) into the blob store ({missing} missing).")
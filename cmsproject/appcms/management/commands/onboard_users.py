@@ -0,0 +1,47 @@
+import csv
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+
+from appcms import onboarding
+
+
+class Command(BaseCommand):
+    help = "Register managers and supervisors in bulk from a CSV or JSON file, with a token each."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV with a header row (username,password,role,department,phone_number) or a JSON list.")
+        parser.add_argument('--mode', choices=['atomic', 'partial'], default='atomic',
+                            help="'atomic' creates nothing unless every user is valid.")
+        parser.add_argument('--show-tokens', action='store_true', help="Print each new user's token.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            with open(path, newline='', encoding='utf-8-sig') as f:
+                if os.path.splitext(path)[1].lower() == '.csv':
+                    entries = list(csv.DictReader(f))
+                else:
+                    entries = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"{path}: {e}")
+        if not isinstance(entries, list):
+            raise CommandError(f"{path}: expected a list of users.")
+
+        try:
+            results, created = onboarding.onboard(entries, options['mode'])
+        except IntegrityError:
+            raise CommandError("Some usernames were registered meanwhile; please retry.")
+
+        for result, entry in zip(results, entries):
+            if result is None:
+                continue
+            if result['status'] == 'error':
+                messages = '; '.join(f"{field}: {' '.join(texts)}" for field, texts in result['errors'].items())
+                self.stderr.write(f"Entry {result['index']}: {messages}")
+            elif options['show_tokens']:
+                self.stdout.write(f"{entry['username']}\t{result['token']}")
+        count = sum(1 for result in results if result and result['status'] == 'created')
+        self.stdout.write(f"Created {count} user(s).")
@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from appcms import sync
+
+
+class Command(BaseCommand):
+    help = "Delete sync log rows older than the retention window. Devices behind it get a resync response."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=getattr(settings, 'CMS_SYNC_RETENTION_DAYS', 30),
+            help="Keep changes from this many days.",
+        )
+
+    def handle(self, *args, **options):
+        count = sync.prune(timedelta(days=options['days']))
+        self.stdout.write(f"Pruned {count} change(s).")
@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from appcms import uploads
+from appcms.models import MediaUpload
+
+
+class Command(BaseCommand):
+    help = "Delete resumable uploads that were never finalized, along with their chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=48, help="Only purge uploads idle for this many hours.")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        stale = MediaUpload.objects.filter(media__isnull=True, updated_at__lt=cutoff)
+        ids = list(stale.values_list('pk', flat=True))
+        stale.delete()
+        for upload_id in ids:
+            uploads.discard(upload_id)
+        self.stdout.write(f"Purged {len(ids)} upload(s).")
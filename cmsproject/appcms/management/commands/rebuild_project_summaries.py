@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from appcms import summaries
+
+
+class Command(BaseCommand):
+    help = "Recompute the per-project summaries from the task, media, document and worker tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument('projects', nargs='*', type=int, help="Project ids to rebuild; every project by default.")
+
+    def handle(self, *args, **options):
+        # rebuild() takes its own write transaction; an outer atomic() would defer its BEGIN
+        count = summaries.rebuild(options['projects'] or None)
+        self.stdout.write(f"Rebuilt {count} project summary(ies).")
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from appcms import search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index from the task, document and media tables."
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = search.get_backend().rebuild()
+        self.stdout.write(f"Indexed {count} object(s).")
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from appcms import availability
+
+
+class Command(BaseCommand):
+    help = "Recompute the worker availability bitmaps from the task table."
+
+    def handle(self, *args, **options):
+        count = availability.rebuild()
+        self.stdout.write(f"Rebuilt {count} worker-year bitmap(s).")
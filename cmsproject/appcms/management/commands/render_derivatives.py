@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from appcms import derivatives
+from appcms.models import Media, Task
+
+
+class Command(BaseCommand):
+    help = "Render thumbnails and medium images for Media and Task images that don't have them yet."
+
+    def handle(self, *args, **options):
+        count = 0
+        for model in (Media, Task):
+            for instance in model.objects.exclude(image='').exclude(image__isnull=True).iterator():
+                if not derivatives.needs_derivatives(instance):
+                    continue
+                try:
+                    variants = derivatives.render(instance.image.path, instance.image.name)
+                except Exception as e:
+                    self.stderr.write(f"{model.__name__} {instance.pk}: {e}")
+                    continue
+                derivatives.store(model, instance.pk, instance.image.name, variants)
+                count += 1
+        self.stdout.write(f"Rendered derivatives for {count} image(s).")
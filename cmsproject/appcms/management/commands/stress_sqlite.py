@@ -0,0 +1,178 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+# Each function below runs in a worker process, against the file given to _init_worker
+
+_start = None
+
+
+def _init_worker(path, baseline, start):
+    global _start
+    import django
+    from django.conf import settings
+
+    _start = start
+    settings.DATABASES['default']['NAME'] = path
+    settings.CMS_READ_REPLICAS = []
+    if baseline:
+        settings.CMS_SQLITE_IMMEDIATE_WRITES = False
+        settings.CMS_SQLITE_LOCK_RETRIES = 0
+    django.setup()
+
+
+def _prepare(quantity):
+    from django.core.management import call_command
+    from appcms.models import Project, Resource, Supervisor, User, Worker
+
+    call_command('migrate', verbosity=0)
+    tag = uuid.uuid4().hex[:8]
+    user = User.objects.create_user(f'stress-{tag}', role='supervisor')
+    supervisor = Supervisor.objects.create(user=user)
+    project = Project.objects.create(name=f'Stress {tag}', location='-', budget=0, timeline='2000-01-01', supervisor=supervisor)
+    return {
+        'user': user.pk,
+        'supervisor': supervisor.pk,
+        'project': project.pk,
+        'worker': Worker.objects.create(name=f'Stress {tag}', aadhar_number=f'{uuid.uuid4().int % 10**12:012d}').pk,
+        'resource': Resource.objects.create(name=f'Stress {tag}', quantity=quantity).pk,
+    }
+
+
+def _hammer(ids, tasks):
+    """ Create `tasks` tasks through the API, deleting every third; returns (status counts, db.lock.* metrics) """
+    from rest_framework.test import APIRequestFactory, force_authenticate
+    from appcms import metrics
+    from appcms.models import User
+    from appcms.views import TaskViewSet
+
+    user = User.objects.get(pk=ids['user'])
+    create = TaskViewSet.as_view({'post': 'create'})
+    destroy = TaskViewSet.as_view({'delete': 'destroy'})
+    factory = APIRequestFactory()
+    statuses = Counter()
+    # Every process starts writing at once
+    _start.wait(timeout=120)
+    for i in range(tasks):
+        request = factory.post('/tasks/', {
+            'name': f'Stress {os.getpid()}-{i}',
+            'resource': ids['resource'],
+            'quantity_used': 1,
+            'worker': ids['worker'],
+            'project': ids['project'],
+            'supervisor': ids['supervisor'],
+            'start_date': '2000-01-01',
+            'end_date': '2000-01-02',
+            'description': '-',
+        }, format='json')
+        force_authenticate(request, user)
+        response = create(request)
+        statuses[f'create {response.status_code}'] += 1
+        if response.status_code == 201 and i % 3 == 2:
+            request = factory.delete(f"/tasks/{response.data['id']}/")
+            force_authenticate(request, user)
+            statuses[f'delete {destroy(request, pk=response.data["id"]).status_code}'] += 1
+    return dict(statuses), {name: value for name, value in metrics.snapshot().items() if name.startswith('db.lock.')}
+
+
+def _verify(ids, quantity):
+    from django.db.models import Sum
+    from appcms import inventory
+    from appcms.models import ResourceMovement, Task
+
+    used = Task.objects.filter(resource_id=ids['resource']).aggregate(total=Sum('quantity_used'))['total'] or 0
+    moved = ResourceMovement.objects.filter(resource_id=ids['resource']).aggregate(total=Sum('delta'))['total'] or 0
+    return {
+        'tasks': Task.objects.filter(resource_id=ids['resource']).count(),
+        'balance': inventory.balance(ids['resource']),
+        'expected': quantity - used,
+        'ledger': quantity + moved,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Stress the SQLite concurrency profile: several processes create and delete tasks "
+        "through the API against one database file, then the stock ledger is checked."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4, help="Writer processes.")
+        parser.add_argument('--tasks', type=int, default=50, help="Tasks each process creates.")
+        parser.add_argument('--path', help="Database file to use (migrated if needed); a temporary one by default.")
+        parser.add_argument(
+            '--baseline', action='store_true',
+            help="Run without BEGIN IMMEDIATE and lock retries, to compare against.",
+        )
+
+    def handle(self, *args, **options):
+        if settings.DATABASES['default']['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError("The default database is not SQLite.")
+
+        directory = None
+        path = options['path']
+        if path is None:
+            directory = tempfile.mkdtemp(prefix='cms-stress-')
+            path = os.path.join(directory, 'stress.sqlite3')
+        processes, tasks = options['processes'], options['tasks']
+        quantity = processes * tasks
+
+        context = multiprocessing.get_context('spawn')
+        try:
+            with ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(path, options['baseline'], context.Barrier(processes)),
+            ) as pool:
+                ids = pool.submit(_prepare, quantity).result()
+                started = time.perf_counter()
+                runs = list(pool.map(_hammer, [ids] * processes, [tasks] * processes))
+                elapsed = time.perf_counter() - started
+                state = pool.submit(_verify, ids, quantity).result()
+        finally:
+            if directory is not None:
+                shutil.rmtree(directory, ignore_errors=True)
+
+        self.report(runs, elapsed, state)
+
+    def report(self, runs, elapsed, state):
+        statuses = Counter()
+        for counts, _ in runs:
+            statuses.update(counts)
+        waits = [lock['db.lock.wait'] for _, lock in runs]
+        wait_count = sum(wait['count'] for wait in waits)
+        wait_total = sum(wait['total_ms'] for wait in waits)
+        lock = Counter()
+        for _, metrics in runs:
+            lock.update({name: value for name, value in metrics.items() if isinstance(value, int)})
+
+        requests = sum(statuses.values())
+        failed = sum(count for status, count in statuses.items() if status not in ('create 201', 'delete 204'))
+        self.stdout.write(
+            f"{len(runs)} processes: {requests} requests in {elapsed:.2f}s ({requests / elapsed:.1f}/s), "
+            f"{dict(sorted(statuses.items()))}, failed {failed}"
+        )
+        self.stdout.write(
+            f"lock waits {wait_count} (avg {wait_total / wait_count if wait_count else 0:.2f}ms, "
+            f"max {max((wait['max_ms'] for wait in waits), default=0):.2f}ms), "
+            f"lock errors {lock['db.lock.errors']}, retries {lock['db.lock.retries']}, gave up {lock['db.lock.gave_up']}"
+        )
+        self.stdout.write(
+            f"{state['tasks']} tasks left, balance {state['balance']} "
+            f"(expected {state['expected']}, ledger {state['ledger']})"
+        )
+
+        if failed:
+            raise CommandError(f"{failed} requests failed.")
+        if not state['balance'] == state['expected'] == state['ledger']:
+            raise CommandError("The stock ledger does not match the tasks.")
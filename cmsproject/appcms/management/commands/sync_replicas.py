@@ -0,0 +1,35 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from appcms import routers
+
+
+class Command(BaseCommand):
+    help = "Copy the SQLite primary over the SQLite read replicas, once or every --interval seconds."
+
+    def add_arguments(self, parser):
+        parser.add_argument('aliases', nargs='*', help="Replica aliases to refresh (default: CMS_READ_REPLICAS).")
+        parser.add_argument('--interval', type=float, help="Keep copying, this many seconds apart.")
+
+    def handle(self, *args, **options):
+        aliases = options['aliases'] or routers.replicas()
+        if not aliases:
+            raise CommandError("No replicas configured; set CMS_READ_REPLICAS (or CMS_SQLITE_REPLICAS for local copies).")
+        for alias in [DEFAULT_DB_ALIAS, *aliases]:
+            if alias not in settings.DATABASES:
+                raise CommandError(f"Unknown database alias '{alias}'.")
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError(f"'{alias}' is not SQLite; replicate it with the database's own tools.")
+
+        while True:
+            for alias in aliases:
+                # Drop this process's handle on the old file before it's replaced
+                connections[alias].close()
+                routers.copy_sqlite(DEFAULT_DB_ALIAS, connections[alias].settings_dict['NAME'])
+                self.stdout.write(f"{alias}: copied, {routers.measure_lag(alias):.1f}s behind")
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
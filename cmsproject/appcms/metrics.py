@@ -0,0 +1,92 @@
+"""
+In-process metrics for the CMS app.
+
+Counters and timers live in a module-level registry so any part of the app
+can record into them cheaply; `snapshot()` is what the /metrics/ endpoint
+returns. Values are per process and reset on restart.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class Counter:
+    """ A monotonically increasing, thread-safe count """
+
+    def __init__(self, name, description=''):
+        self.name = name
+        self.description = description
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+
+class Timer:
+    """ Records how many times something happened and how long it took """
+
+    def __init__(self, name, description=''):
+        self.name = name
+        self.description = description
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._count += 1
+            self._total += seconds
+            self._max = max(self._max, seconds)
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "count": self._count,
+                "total_ms": round(self._total * 1000, 3),
+                "avg_ms": round(self._total * 1000 / self._count, 3) if self._count else 0.0,
+                "max_ms": round(self._max * 1000, 3),
+            }
+
+
+def _get_or_create(cls, name, description):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, description)
+        return metric
+
+
+def counter(name, description=''):
+    return _get_or_create(Counter, name, description)
+
+
+def timer(name, description=''):
+    return _get_or_create(Timer, name, description)
+
+
+def snapshot():
+    """ Current value of every registered metric, keyed by name """
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return {metric.name: metric.snapshot() for metric in sorted(metrics, key=lambda m: m.name)}
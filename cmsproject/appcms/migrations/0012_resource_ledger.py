@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:41
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def create_baseline_snapshots(apps, schema_editor):
+    """ Record each existing resource's quantity as the start of its ledger history """
+    Resource = apps.get_model('appcms', 'Resource')
+    ResourceSnapshot = apps.get_model('appcms', 'ResourceSnapshot')
+    ResourceSnapshot.objects.bulk_create([
+        ResourceSnapshot(resource_id=resource_id, quantity=quantity, movement_id=0)
+        for resource_id, quantity in Resource.objects.values_list('id', 'quantity')
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appcms', '0011_alter_worker_options_alter_worker_table'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resource',
+            name='snapshot_through',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='ResourceMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delta', models.IntegerField()),
+                ('reason', models.CharField(choices=[('reduce', 'Reduce'), ('restore', 'Restore'), ('task', 'Task'), ('adjust', 'Adjust')], max_length=20)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('resource', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='movements', to='appcms.resource')),
+                ('task', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='movements', to='appcms.task')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['resource', 'id'], name='movement_resource_id_idx'), models.Index(fields=['resource', 'created_at'], name='movement_resource_time_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='ResourceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField()),
+                ('movement_id', models.BigIntegerField(default=0)),
+                ('as_of', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('resource', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='appcms.resource')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['resource', 'as_of'], name='snapshot_resource_time_idx')],
+            },
+        ),
+        migrations.RunPython(create_baseline_snapshots, migrations.RunPython.noop),
+    ]
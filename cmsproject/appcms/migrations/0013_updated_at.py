@@ -0,0 +1,19 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appcms', '0012_resource_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name=model_name,
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        )
+        for model_name in ['project', 'resource', 'worker', 'task', 'document', 'media']
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:53
+
+import django.utils.timezone
+from django.db import migrations, models
+
+SYNCED_MODELS = ['user', 'manager', 'supervisor', 'project', 'resource', 'worker', 'task', 'document', 'media']
+
+
+def log_existing_rows(apps, schema_editor):
+    """ Start the change log with every existing row, so syncing from 0 is a full download """
+    ChangeLog = apps.get_model('appcms', 'ChangeLog')
+    for name in SYNCED_MODELS:
+        model = apps.get_model('appcms', name)
+        ChangeLog.objects.bulk_create([
+            ChangeLog(model=f'appcms.{name}', object_id=pk, op='upsert')
+            for pk in model.objects.order_by('pk').values_list('pk', flat=True).iterator()
+        ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appcms', '0013_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('object_id', models.BigIntegerField()),
+                ('op', models.CharField(choices=[('upsert', 'Created or updated'), ('delete', 'Deleted')], max_length=10)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.RunPython(log_existing_rows, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:55
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appcms', '0014_changelog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('filename', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('chunk_size', models.IntegerField()),
+                ('sha256', models.CharField(blank=True, max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('manager', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='media_uploads', to='appcms.manager')),
+                ('media', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload', to='appcms.media')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='media_uploads', to='appcms.project')),
+                ('supervisor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='media_uploads', to='appcms.supervisor')),
+                ('uploaded_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='media_uploads', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MediaUploadChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('offset', models.BigIntegerField()),
+                ('size', models.IntegerField()),
+                ('sha256', models.CharField(max_length=64)),
+                ('received_at', models.DateTimeField(auto_now=True)),
+                ('upload', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='appcms.mediaupload')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('upload', 'offset'), name='upload_chunk_offset_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appcms', '0015_media_upload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:01
+
+import appcms.storage
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appcms', '0016_image_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('refcount', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='file',
+            field=models.FileField(storage=appcms.storage.upload_storage, upload_to='documents/%Y/%m/%d/'),
+        ),
+        migrations.AlterField(
+            model_name='media',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=appcms.storage.upload_storage, upload_to='media/images/%Y/%m/%d/'),
+        ),
+        migrations.AlterField(
+            model_name='media',
+            name='video',
+            field=models.FileField(blank=True, null=True, storage=appcms.storage.upload_storage, upload_to='media/videos/%Y/%m/%d/'),
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=appcms.storage.upload_storage, upload_to='tasks/'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appcms', '0017_content_addressed_storage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['project', 'created_at'], name='document_project_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['document_type', 'created_at'], name='document_type_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['created_at'], name='document_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='media',
+            index=models.Index(fields=['project', 'created_at'], name='media_project_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='media',
+            index=models.Index(fields=['created_at'], name='media_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['project', 'start_date'], name='task_project_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['supervisor', 'start_date'], name='task_supervisor_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['worker', 'start_date'], name='task_worker_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['resource', 'start_date'], name='task_resource_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['start_date'], name='task_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['end_date'], name='task_end_idx'),
+        ),
+    ]
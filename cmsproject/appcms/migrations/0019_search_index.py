@@ -0,0 +1,42 @@
+from django.db import migrations
+
+# Document types as shown to users, so the index matches get_document_type_display()
+DOCUMENT_TYPES = [
+    ('blueprint', 'Blueprint'),
+    ('contract', 'Contract'),
+    ('inspection_report', 'Inspection Report'),
+]
+
+
+def create_index(apps, schema_editor):
+    # FTS5 is SQLite's; other databases use search.DatabaseBackend and need no table
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    document_type = ' '.join(f"WHEN '{value}' THEN '{label}'" for value, label in DOCUMENT_TYPES)
+    for sql in [
+        "CREATE VIRTUAL TABLE appcms_search USING fts5(kind, project, title, body, tokenize = 'porter unicode61')",
+        "INSERT INTO appcms_search (rowid, kind, project, title, body) "
+        "SELECT id * 8 + 1, 'task', 'p' || project_id, name, description FROM appcms_task",
+        "INSERT INTO appcms_search (rowid, kind, project, title, body) "
+        f"SELECT id * 8 + 2, 'document', 'p' || project_id, title, CASE document_type {document_type} ELSE document_type END "
+        "FROM appcms_document",
+        "INSERT INTO appcms_search (rowid, kind, project, title, body) "
+        "SELECT id * 8 + 3, 'media', 'p' || project_id, '', COALESCE(description, '') FROM appcms_media",
+    ]:
+        schema_editor.execute(sql)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS appcms_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appcms', '0018_list_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
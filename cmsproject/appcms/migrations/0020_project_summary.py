@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:31
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def summarize_existing_projects(apps, schema_editor):
+    """ Count every existing project, so summaries only need adjusting from here on """
+    from appcms import summaries
+    summaries.rebuild(apps=apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appcms', '0019_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProjectSummary',
+            fields=[
+                ('project', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='appcms.project')),
+                ('task_count', models.IntegerField(default=0)),
+                ('material_used', models.BigIntegerField(default=0)),
+                ('equipment_used', models.BigIntegerField(default=0)),
+                ('labor_used', models.BigIntegerField(default=0)),
+                ('media_count', models.IntegerField(default=0)),
+                ('document_count', models.IntegerField(default=0)),
+                ('active_workers', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProjectWorker',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_count', models.IntegerField(default=0)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='appcms.project')),
+                ('worker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='appcms.worker')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('project', 'worker'), name='project_worker_uniq')],
+            },
+        ),
+        migrations.RunPython(summarize_existing_projects, migrations.RunPython.noop),
+    ]
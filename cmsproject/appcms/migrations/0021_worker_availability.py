@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def book_existing_tasks(apps, schema_editor):
+    """ Build the bitmaps from the tasks already assigned """
+    from appcms import availability
+    availability.rebuild(apps=apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appcms', '0020_project_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkerAvailability',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('busy', models.BinaryField()),
+                ('worker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='appcms.worker')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('year', 'worker'), name='worker_availability_uniq')],
+            },
+        ),
+        migrations.RunPython(book_existing_tasks, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,14 @@
 from django.db import models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractUser
-from django.db import transaction
 from django.conf import settings
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 import re
+import uuid
+from . import sqlite
+from .storage import upload_storage
 # Custom User model
 class User(AbstractUser):
     ROLE_CHOICES = [
@@ -36,9 +40,20 @@ class Project(models.Model):
     budget = models.DecimalField(max_digits=10, decimal_places=2)
     timeline = models.DateField()
     supervisor = models.ForeignKey(Supervisor, on_delete=models.SET_NULL, null=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return self.name
+# Resource queryset
+class ResourceQuerySet(models.QuerySet):
+    def with_balance(self):
+        """ Annotate each resource with its live balance (snapshot + movements since) """
+        pending = ResourceMovement.objects.filter(
+            resource=OuterRef('pk'), id__gt=OuterRef('snapshot_through')
+        ).order_by().values('resource').annotate(total=Sum('delta')).values('total')
+        return self.annotate(ledger_balance=F('quantity') + Coalesce(Subquery(pending), Value(0)))
+
+
 # Resource model
 class Resource(models.Model):
     MATERIAL = 'material'
@@ -52,33 +67,60 @@ class Resource(models.Model):
     ]
     
     name = models.CharField(max_length=255)
+    # Snapshot balance as of movement `snapshot_through`; the live balance also
+    # counts every later ResourceMovement (see `balance` and appcms.inventory).
     quantity = models.PositiveIntegerField()
+    snapshot_through = models.BigIntegerField(default=0, editable=False)
     resource_type = models.CharField(
         max_length=20,
         choices=RESOURCE_TYPES,
         default=MATERIAL,  # Default to 'Material' type
     )
+    # Ledger movements don't touch the row; see ConditionalGetMixin for how they are tracked
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = ResourceQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.name} ({self.get_resource_type_display()})"
 
+    @property
+    def balance(self):
+        """ Live quantity: the snapshot plus every movement recorded since """
+        if 'ledger_balance' not in self.__dict__:
+            from . import inventory
+            self.ledger_balance = inventory.balance(self.pk)
+        return self.ledger_balance
+
+    def save(self, *args, **kwargs):
+        """ Only a new resource writes its opening quantity; later changes go through the ledger """
+        adding = self._state.adding
+        if not adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in ('quantity', 'snapshot_through')
+            ]
+        super().save(*args, **kwargs)
+        if adding:
+            ResourceSnapshot.objects.create(resource=self, quantity=self.quantity, movement_id=self.snapshot_through)
+            self.ledger_balance = self.quantity
+
     def reduce_quantity(self, amount):
-        """ Reduces the resource quantity and saves it atomically """
-        if self.quantity < amount:
-            raise ValueError(f"Insufficient quantity. Available: {self.quantity}, Requested: {amount}")
-        self.quantity -= amount
-        self.save()
+        """ Records a guarded reduction in the ledger """
+        from . import inventory
+        self.ledger_balance = inventory.reduce(self.pk, amount, expected=self.balance)
 
     def restore_quantity(self, amount):
-        """ Restores the resource quantity and saves it atomically """
-        self.quantity += amount
-        self.save()
+        """ Records a restoration in the ledger """
+        from . import inventory
+        self.ledger_balance = inventory.restore(self.pk, amount)
 
 # Worker model
 class Worker(models.Model):
     name = models.CharField(max_length=100)
     aadhar_number = models.CharField(max_length=12, unique=True)  # Assuming Aadhar number is unique
     is_working = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def clean(self):
         """Custom validation for Aadhar number format"""
@@ -104,27 +146,148 @@ class Task(models.Model):
     supervisor = models.ForeignKey(Supervisor, on_delete=models.CASCADE)
     start_date = models.DateField()
     end_date = models.DateField()
-    image = models.ImageField(upload_to='tasks/', null=True, blank=True)
+    image = models.ImageField(upload_to='tasks/', storage=upload_storage, null=True, blank=True)
+    # Derivative names written by appcms.derivatives, with the original they came from
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     description = models.TextField()
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        # One per list filter, leading with its equality column and ending on the date range
+        indexes = [
+            models.Index(fields=['project', 'start_date'], name='task_project_start_idx'),
+            models.Index(fields=['supervisor', 'start_date'], name='task_supervisor_start_idx'),
+            models.Index(fields=['worker', 'start_date'], name='task_worker_start_idx'),
+            models.Index(fields=['resource', 'start_date'], name='task_resource_start_idx'),
+            models.Index(fields=['start_date'], name='task_start_idx'),
+            models.Index(fields=['end_date'], name='task_end_idx'),
+        ]
+
+    def _get_stock_held(self):
+        """
+        (resource_id, quantity_used) as stored in the database, or None for a
+        new task. Read, and locked where the backend has row locks, inside the
+        saving transaction: what this instance was loaded with is stale if
+        someone saved the task since.
+        """
+        if self._state.adding:
+            return None
+        return (
+            type(self)._base_manager.select_for_update().filter(pk=self.pk)
+            .values_list('resource_id', 'quantity_used').first()
+        )
+
+    def _apply_stock(self, changes):
+        """ Record {resource_id: delta} in the ledger through the inventory engine, in resource id order """
+        from . import inventory
+        cached = Task.resource.is_cached(self)
+        for resource_id in sorted(changes):
+            delta = changes[resource_id]
+            if not delta:
+                continue
+            expected = self.resource.balance if cached and resource_id == self.resource_id else None
+            quantity = inventory.adjust(resource_id, delta, expected=expected, reason=ResourceMovement.TASK, task_id=self.pk)
+            if cached and resource_id == self.resource_id:
+                self.resource.ledger_balance = quantity
 
     def save(self, *args, **kwargs):
-        """ Ensure that sufficient resource quantity is available and save the task atomically """
-        if not self.resource:
+        """ Take the task's stock from its resource and save the task atomically """
+        if not self.resource_id:
             raise ValueError("A valid resource is required for the task.")
 
-        if self.resource.quantity < self.quantity_used:
-            raise ValueError(f"Insufficient quantity for resource {self.resource.name}. Available: {self.resource.quantity}, Required: {self.quantity_used}")
-
-        # Using atomic transaction to ensure that resource quantity is properly updated
-        with transaction.atomic():
-            # Reduce the resource quantity
-            self.resource.reduce_quantity(self.quantity_used)
+        with sqlite.write_transaction():
+            # Net change per resource: give back what the row held, take what it holds now
+            held = self._get_stock_held()
+            changes = {held[0]: held[1]} if held is not None else {}
+            changes[self.resource_id] = changes.get(self.resource_id, 0) - self.quantity_used
 
+            # Save first so the movements can point at the task; a refusal rolls both back
             super().save(*args, **kwargs)
+            self._apply_stock(changes)
+
+    def delete(self, *args, **kwargs):
+        """ Give the task's stock back to its resource and delete the task atomically """
+        with sqlite.write_transaction():
+            held = self._get_stock_held()
+            if held is not None:
+                self._apply_stock({held[0]: held[1]})
+            return super().delete(*args, **kwargs)
 
     def __str__(self):
         return self.name
 
+# Resource movement model: append-only stock ledger
+class ResourceMovement(models.Model):
+    REDUCE = 'reduce'
+    RESTORE = 'restore'
+    TASK = 'task'
+    ADJUST = 'adjust'
+
+    REASON_CHOICES = [
+        (REDUCE, 'Reduce'),
+        (RESTORE, 'Restore'),
+        (TASK, 'Task'),
+        (ADJUST, 'Adjust'),
+    ]
+
+    resource = models.ForeignKey(Resource, on_delete=models.CASCADE, related_name='movements')
+    delta = models.IntegerField()
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES)
+    # Kept after the task is deleted so the history stays intact
+    task = models.ForeignKey(Task, null=True, blank=True, on_delete=models.DO_NOTHING, db_constraint=False, related_name='movements')
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['resource', 'id'], name='movement_resource_id_idx'),
+            models.Index(fields=['resource', 'created_at'], name='movement_resource_time_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.resource_id}: {self.delta:+d} ({self.reason})"
+
+# Resource snapshot model: balance folded up to a movement
+class ResourceSnapshot(models.Model):
+    resource = models.ForeignKey(Resource, on_delete=models.CASCADE, related_name='snapshots')
+    quantity = models.IntegerField()
+    # Last movement folded in, and the time of the newest movement folded in
+    movement_id = models.BigIntegerField(default=0)
+    as_of = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['resource', 'as_of'], name='snapshot_resource_time_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.resource_id}: {self.quantity} as of {self.as_of}"
+
+# Change log model: one row per write, read by the delta-sync feed
+class ChangeLog(models.Model):
+    UPSERT = 'upsert'
+    DELETE = 'delete'
+
+    OP_CHOICES = [
+        (UPSERT, 'Created or updated'),
+        (DELETE, 'Deleted'),
+    ]
+
+    # The primary key is the change sequence number that clients use as a watermark
+    model = models.CharField(max_length=100)  # app_label.model_name
+    object_id = models.BigIntegerField()
+    op = models.CharField(max_length=10, choices=OP_CHOICES)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    @classmethod
+    def record(cls, model, pks, op=UPSERT):
+        """ Log `op` for each primary key in `pks` """
+        label = model._meta.label_lower
+        cls.objects.bulk_create([cls(model=label, object_id=pk, op=op) for pk in pks])
+
+    def __str__(self):
+        return f"#{self.id} {self.op} {self.model}:{self.object_id}"
+
 # Document model
 class Document(models.Model):
     DOCUMENT_TYPE_CHOICES = [
@@ -136,8 +299,16 @@ class Document(models.Model):
     project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name="documents")
     title = models.CharField(max_length=255)
     document_type = models.CharField(max_length=20, choices=DOCUMENT_TYPE_CHOICES)
-    file = models.FileField(upload_to='documents/%Y/%m/%d/')
+    file = models.FileField(upload_to='documents/%Y/%m/%d/', storage=upload_storage)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'created_at'], name='document_project_created_idx'),
+            models.Index(fields=['document_type', 'created_at'], name='document_type_created_idx'),
+            models.Index(fields=['created_at'], name='document_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.title} ({self.get_document_type_display()})"
@@ -147,10 +318,18 @@ class Media(models.Model):
     project = models.ForeignKey('Project', on_delete=models.CASCADE, related_name="media_files")
     supervisor = models.ForeignKey('Supervisor', on_delete=models.CASCADE, related_name="media_files")
     manager = models.ForeignKey('Manager', on_delete=models.CASCADE, related_name="media_files")
-    image = models.ImageField(upload_to='media/images/%Y/%m/%d/', blank=True, null=True)
-    video = models.FileField(upload_to='media/videos/%Y/%m/%d/', blank=True, null=True)
+    image = models.ImageField(upload_to='media/images/%Y/%m/%d/', storage=upload_storage, blank=True, null=True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
+    video = models.FileField(upload_to='media/videos/%Y/%m/%d/', storage=upload_storage, blank=True, null=True)
     description = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['project', 'created_at'], name='media_project_created_idx'),
+            models.Index(fields=['created_at'], name='media_created_idx'),
+        ]
 
     def __str__(self):
         return f"Media for {self.project.name} by {self.supervisor.user.username} at {self.created_at}"
@@ -159,4 +338,114 @@ class Media(models.Model):
         if not self.created_at:
             self.created_at = timezone.now()  # Ensure created_at is set correctly
         super().save(*args, **kwargs)
+
+# Blob model: one file in the content-addressed upload storage (see appcms.storage)
+class Blob(models.Model):
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField()
+    # Number of model fields that point at this blob
+    refcount = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Last upload or reference change; gc_blobs waits a grace period after it
+    updated_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    @classmethod
+    def adjust(cls, names, delta):
+        """ Add `delta` to the refcount of each blob in `names` (a name listed twice counts twice) """
+        for name in names:
+            cls.objects.filter(name=name).update(refcount=F('refcount') + delta, updated_at=timezone.now())
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount} refs)"
+
+# Media upload model: a resumable, chunked video upload that becomes a Media on finalize
+class MediaUpload(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    uploaded_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='media_uploads')
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='media_uploads')
+    supervisor = models.ForeignKey(Supervisor, on_delete=models.CASCADE, related_name='media_uploads')
+    manager = models.ForeignKey(Manager, on_delete=models.CASCADE, related_name='media_uploads')
+    description = models.TextField(blank=True, null=True)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    chunk_size = models.IntegerField()
+    # Optional digest of the whole file, checked when the chunks are assembled
+    sha256 = models.CharField(max_length=64, blank=True)
+    media = models.OneToOneField(Media, on_delete=models.SET_NULL, null=True, blank=True, related_name='upload')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def offsets(self):
+        """ Offset of every chunk the finished file is made of """
+        return range(0, self.size, self.chunk_size)
+
+    def chunk_length(self, offset):
+        return min(self.chunk_size, self.size - offset)
+
+    def __str__(self):
+        return f"{self.filename} ({self.size} bytes)"
+
+# Media upload chunk model: one received, checksummed chunk
+class MediaUploadChunk(models.Model):
+    upload = models.ForeignKey(MediaUpload, on_delete=models.CASCADE, related_name='chunks')
+    offset = models.BigIntegerField()
+    size = models.IntegerField()
+    sha256 = models.CharField(max_length=64)
+    received_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['upload', 'offset'], name='upload_chunk_offset_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.upload_id} @ {self.offset}"
+
+# Project summary model: dashboard totals, kept up to date by appcms.summaries
+class ProjectSummary(models.Model):
+    project = models.OneToOneField(Project, on_delete=models.CASCADE, primary_key=True, related_name='summary')
+    task_count = models.IntegerField(default=0)
+    # Sum of quantity_used over the project's tasks, per type of the resource they draw on
+    material_used = models.BigIntegerField(default=0)
+    equipment_used = models.BigIntegerField(default=0)
+    labor_used = models.BigIntegerField(default=0)
+    media_count = models.IntegerField(default=0)
+    document_count = models.IntegerField(default=0)
+    # Distinct workers with is_working set among those assigned to the project's tasks
+    active_workers = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Summary of project {self.project_id}"
+
+# Project worker model: tasks per (project, worker), so the summary can count distinct workers
+class ProjectWorker(models.Model):
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='+')
+    worker = models.ForeignKey(Worker, on_delete=models.CASCADE, related_name='+')
+    task_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['project', 'worker'], name='project_worker_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.worker_id} on {self.project_id}: {self.task_count} task(s)"
+
+# Worker availability model: the days a worker's tasks book, as one bitmap per calendar year (see appcms.availability)
+class WorkerAvailability(models.Model):
+    worker = models.ForeignKey(Worker, on_delete=models.CASCADE, related_name='+')
+    year = models.IntegerField()
+    # Bit n (little-endian) set: booked on day n of the year, January 1st being day 0
+    busy = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            # Leading on year: availability queries read every worker's bitmap for a year
+            models.UniqueConstraint(fields=['year', 'worker'], name='worker_availability_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.worker_id} in {self.year}"
 #**** end ****
\ No newline at end of file
@@ -0,0 +1,220 @@
+"""
+Creating users in bulk, and hashing their passwords off the request thread.
+
+Password hashing (PBKDF2 by default) is deliberately slow, so
+`hash_passwords()` spreads it over a process pool with one worker per core
+(CMS_HASH_WORKERS). The pool also bounds how much hashing can be queued:
+once CMS_HASH_MAX_PENDING passwords are waiting, further callers get
+`Overloaded` straight away and the API answers 503 with Retry-After, rather
+than parking a request thread behind the queue.
+
+`onboard()` creates a batch of users with their Manager/Supervisor profile
+and Token: every entry is validated first (usernames are checked against
+the batch and, with IN queries, the database), the passwords are hashed in
+parallel outside any transaction, and the rows are written with one
+bulk_create per table.
+"""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.hashers import get_hasher, make_password
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+
+from . import metrics
+from .models import ChangeLog, Manager, Supervisor, User
+
+# Values per IN (...) query and rows per INSERT
+BATCH_SIZE = 500
+RETRY_AFTER = 5  # seconds, sent with 503s
+
+hashed = metrics.counter('onboarding.passwords_hashed', 'Passwords hashed for new users')
+overloaded = metrics.counter('onboarding.overloaded', 'Registrations turned away because hashing was saturated')
+hashing = metrics.timer('onboarding.hashing', 'Time to hash a batch of passwords')
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = 0
+_pending_lock = threading.Lock()
+
+
+class Overloaded(Exception):
+    """ Too many passwords are already waiting to be hashed """
+
+
+# Hashing
+
+def _hash(password, algorithm):
+    # Runs in the pool; the algorithm is passed so workers match the parent's settings
+    return make_password(password, hasher=algorithm)
+
+
+def _init_worker():
+    import django
+    django.setup()
+
+
+def _workers():
+    workers = getattr(settings, 'CMS_HASH_WORKERS', None)
+    return (os.cpu_count() or 1) if workers is None else workers
+
+
+def _get_executor(workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+        return _executor
+
+
+def shutdown():
+    """ Stop the pool; the next hash starts a new one """
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+
+
+@contextmanager
+def _admit(count):
+    global _pending
+    with _pending_lock:
+        # An idle pool always takes the work, however large the batch
+        if _pending and _pending + count > getattr(settings, 'CMS_HASH_MAX_PENDING', 32):
+            overloaded.inc()
+            raise Overloaded("Registration is busy; please retry shortly.")
+        _pending += count
+    try:
+        yield
+    finally:
+        with _pending_lock:
+            _pending -= count
+
+
+def hash_passwords(passwords):
+    """ Hashed forms of `passwords`, in order. Raises Overloaded when the queue is full. """
+    passwords = list(passwords)
+    if not passwords:
+        return []
+    algorithm = get_hasher().algorithm
+    with _admit(len(passwords)), hashing.time():
+        workers = _workers()
+        if not workers:
+            # Inline mode (tests)
+            results = [_hash(password, algorithm) for password in passwords]
+        else:
+            chunksize = max(1, len(passwords) // (workers * 4))
+            results = list(_get_executor(workers).map(_hash, passwords, [algorithm] * len(passwords), chunksize=chunksize))
+    hashed.inc(len(results))
+    return results
+
+
+# Bulk onboarding
+
+def onboard(entries, mode='atomic'):
+    """
+    Create a user, profile and token for each entry
+    ({"username", "password", "role", "department", "phone_number"}).
+
+    Returns (results, created): a result per entry with its status, and
+    whether anything was created. In 'atomic' mode nothing is created
+    unless every entry is valid. Raises Overloaded before writing anything.
+    """
+    results = [None] * len(entries)
+    valid = []
+    seen = set()
+    for index, entry in enumerate(entries):
+        data, errors = _clean(entry)
+        if not errors and data['username'] in seen:
+            errors = {'username': ["Duplicate of an earlier entry in this batch."]}
+        if errors:
+            results[index] = {"index": index, "status": "error", "errors": errors}
+            continue
+        seen.add(data['username'])
+        valid.append((index, data))
+
+    usernames = [data['username'] for _, data in valid]
+    taken = set()
+    for start in range(0, len(usernames), BATCH_SIZE):
+        taken.update(User.objects.filter(username__in=usernames[start:start + BATCH_SIZE]).values_list('username', flat=True))
+    accepted = []
+    for index, data in valid:
+        if data['username'] in taken:
+            results[index] = {"index": index, "status": "error", "errors": {'username': ["A user with that username already exists."]}}
+        else:
+            accepted.append((index, data))
+
+    if not accepted or (mode == 'atomic' and len(accepted) < len(entries)):
+        return results, False
+
+    # Hash before opening the transaction, so no locks are held while the pool works
+    passwords = hash_passwords(data['password'] for _, data in accepted)
+
+    with transaction.atomic():
+        users = User.objects.bulk_create([
+            User(username=data['username'], password=password, role=data['role'])
+            for (_, data), password in zip(accepted, passwords)
+        ], batch_size=BATCH_SIZE)
+        managers = Manager.objects.bulk_create([
+            Manager(user=user, department=data['department'], phone_number=data['phone_number'])
+            for (_, data), user in zip(accepted, users) if data['role'] == 'manager'
+        ], batch_size=BATCH_SIZE)
+        supervisors = Supervisor.objects.bulk_create([
+            Supervisor(user=user) for (_, data), user in zip(accepted, users) if data['role'] == 'supervisor'
+        ], batch_size=BATCH_SIZE)
+        # Token.save() generates the key; bulk_create doesn't call it
+        tokens = Token.objects.bulk_create([Token(user=user, key=Token.generate_key()) for user in users], batch_size=BATCH_SIZE)
+
+        # bulk_create sends no signals, so log the rows for /sync/ here
+        ChangeLog.record(User, [user.pk for user in users])
+        ChangeLog.record(Manager, [manager.pk for manager in managers])
+        ChangeLog.record(Supervisor, [supervisor.pk for supervisor in supervisors])
+
+    profiles = {profile.user_id: profile.pk for profile in [*managers, *supervisors]}
+    for (index, data), user, token in zip(accepted, users, tokens):
+        results[index] = {
+            "index": index,
+            "status": "created",
+            "id": user.pk,
+            "token": token.key,
+            f"{data['role']}_id": profiles[user.pk],
+        }
+    return results, True
+
+
+def _clean(entry):
+    """ (data, None) for a valid entry, or (None, {field: [messages]}) """
+    if not isinstance(entry, dict):
+        return None, {'non_field_errors': ["Each entry must be an object."]}
+    errors = {}
+    data = {key: str(entry.get(key) or '').strip() for key in ('username', 'role', 'department', 'phone_number')}
+    data['password'] = entry.get('password') or ''
+
+    username_field = User._meta.get_field('username')
+    if not data['username']:
+        errors['username'] = ["This field is required."]
+    elif len(data['username']) > username_field.max_length:
+        errors['username'] = [f"Ensure this field has no more than {username_field.max_length} characters."]
+    else:
+        try:
+            User.username_validator(data['username'])
+        except ValidationError as e:
+            errors['username'] = e.messages
+    if not isinstance(data['password'], str) or not data['password']:
+        errors['password'] = ["This field is required."]
+    if data['role'] not in dict(User.ROLE_CHOICES):
+        errors['role'] = [f"Role must be one of: {', '.join(dict(User.ROLE_CHOICES))}."]
+    elif data['role'] == 'manager':
+        for field in ('department', 'phone_number'):
+            max_length = Manager._meta.get_field(field).max_length
+            if not data[field]:
+                errors[field] = ["This field is required for managers."]
+            elif len(data[field]) > max_length:
+                errors[field] = [f"Ensure this field has no more than {max_length} characters."]
+
+    return (None, errors) if errors else (data, None)
@@ -0,0 +1,235 @@
+"""
+Keyset (cursor) pagination for the list endpoints.
+
+Each page is fetched with a range condition on the ordering key rather than
+an OFFSET, so the cost of a page doesn't grow with how deep the client has
+paged. The ordering always ends on the primary key, which makes it total and
+stable even when the leading key has duplicates.
+
+Views choose the key with `keyset_ordering` (default: ascending id), and
+clients may pick another from the view's `ordering_fields` with ?ordering=
+(see filters.py). Clients follow the `next`/`previous` links, may ask for
+`?page_size=`, and may opt in to a total with `?count=exact` or the cheaper
+`?count=approx`. A cursor that doesn't decode to a position on the current
+ordering is a 400.
+"""
+import base64
+import binascii
+import datetime
+import decimal
+import json
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .filters import keyset_ordering
+
+
+class KeysetPagination(BasePagination):
+    page_size = api_settings.PAGE_SIZE or 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    ordering = ('id',)
+    # Filtered queries are counted up to this many rows in ?count=approx mode
+    approximate_count_cap = 10000
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count, self.count_is_estimate = self.get_count(queryset, request)
+        page, reverse, position = self._page_query(queryset, request, view)
+        return self._page(list(page), reverse, position)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """ paginate_queryset() for async views: the page is read with the async ORM """
+        self.count, self.count_is_estimate = await sync_to_async(self.get_count)(queryset, request)
+        page, reverse, position = self._page_query(queryset, request, view)
+        return self._page([row async for row in page], reverse, position)
+
+    def _page_query(self, queryset, request, view):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.keys = self.get_ordering(view)
+
+        position, reverse = self.decode_cursor(request)
+        ordering = [self._order_term(field, descending != reverse) for field, descending in self.keys]
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            try:
+                queryset = queryset.filter(self._after(position, reverse))
+            except (TypeError, ValueError, DjangoValidationError):
+                # A position whose values don't fit the ordering fields
+                self.invalid_cursor()
+        # One extra row tells us whether there is another page in this direction
+        return queryset[:self.page_size + 1], reverse, position
+
+    def _page(self, rows, reverse, position):
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+            has_next, has_previous = position is not None, has_more
+        else:
+            has_next, has_previous = has_more, position is not None
+
+        self.next_position = self._position(rows[-1]) if has_next and rows else None
+        self.previous_position = self._position(rows[0]) if has_previous and rows else None
+        return rows
+
+    def get_paginated_response(self, data):
+        payload = OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+        ])
+        if self.count is not None:
+            payload['count'] = self.count
+            payload['count_is_estimate'] = self.count_is_estimate
+        payload['results'] = data
+        return Response(payload)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'count': {'type': 'integer'},
+                'count_is_estimate': {'type': 'boolean'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def get_ordering(self, view):
+        """ [(field, descending), ...] ending on the primary key """
+        ordering = list(keyset_ordering(view) or self.ordering)
+        keys = [(term.lstrip('-'), term.startswith('-')) for term in ordering]
+        if keys[-1][0] not in ('id', 'pk'):
+            keys.append(('id', keys[-1][1]))
+        return [('id' if field == 'pk' else field, descending) for field, descending in keys]
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self._link(self.next_position, reverse=False)
+
+    def get_previous_link(self):
+        if self.previous_position is None:
+            return None
+        return self._link(self.previous_position, reverse=True)
+
+    # Counting
+
+    def get_count(self, queryset, request):
+        mode = request.query_params.get(self.count_query_param, '').lower()
+        if mode in ('1', 'true', 'exact'):
+            return queryset.count(), False
+        if mode in ('approx', 'approximate', 'estimate'):
+            return self.estimate_count(queryset)
+        return None, False
+
+    def estimate_count(self, queryset):
+        """ (count, is_estimate) without scanning the whole table """
+        if not queryset.query.where:
+            estimate = self._table_estimate(queryset)
+            if estimate is not None:
+                return estimate, True
+        # Filtered: count, but stop once it's clearly "a lot"
+        capped = queryset.order_by()[:self.approximate_count_cap + 1].count()
+        return min(capped, self.approximate_count_cap), capped > self.approximate_count_cap
+
+    def _table_estimate(self, queryset):
+        model = queryset.model
+        connection = connections[queryset.db]
+        table = model._meta.db_table
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [table])
+                row = cursor.fetchone()
+                return max(row[0], 0) if row and row[0] >= 0 else None
+            if connection.vendor == 'sqlite':
+                # Highest rowid is a cheap upper bound that's close unless many rows were deleted
+                cursor.execute(f"SELECT MAX(rowid) FROM {connection.ops.quote_name(table)}")
+                row = cursor.fetchone()
+                return row[0] or 0
+        return None
+
+    # Cursors
+
+    def decode_cursor(self, request):
+        """ (position, reverse) from the request, or (None, False) on the first page """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            position, reverse = cursor['p'], bool(cursor.get('r'))
+        except (TypeError, ValueError, KeyError, UnicodeError, binascii.Error):
+            self.invalid_cursor()
+        if not isinstance(position, list) or len(position) != len(self.keys):
+            self.invalid_cursor()
+        if any(isinstance(value, (list, dict)) for value in position):
+            self.invalid_cursor()
+        return position, reverse
+
+    def invalid_cursor(self):
+        raise ValidationError({self.cursor_query_param: [self.invalid_cursor_message]})
+
+    def encode_cursor(self, position, reverse):
+        cursor = {'p': position}
+        if reverse:
+            cursor['r'] = 1
+        return base64.urlsafe_b64encode(json.dumps(cursor, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+    def _link(self, position, reverse):
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.count_query_param)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(position, reverse))
+
+    def _position(self, instance):
+        return [self._json_value(getattr(instance, field)) for field, _ in self.keys]
+
+    @staticmethod
+    def _json_value(value):
+        if isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+            return value.isoformat()
+        if isinstance(value, decimal.Decimal):
+            return str(value)
+        return value
+
+    @staticmethod
+    def _order_term(field, descending):
+        return f'-{field}' if descending else field
+
+    def _after(self, position, reverse):
+        """
+        Rows strictly after `position` in the page direction:
+        (k1 > v1) OR (k1 = v1 AND k2 > v2) OR ..., with the leading key also
+        bounded on its own so the database can use a plain index range.
+        """
+        condition = Q()
+        equal = Q()
+        for (field, descending), value in zip(self.keys, position):
+            lookup = 'lt' if descending != reverse else 'gt'
+            condition |= equal & Q(**{f'{field}__{lookup}': value})
+            equal &= Q(**{field: value})
+
+        field, descending = self.keys[0]
+        bound = 'lte' if descending != reverse else 'gte'
+        return Q(**{f'{field}__{bound}': position[0]}) & condition
@@ -1,19 +1,21 @@
 # permissions.py
 from rest_framework import permissions
 
+from .authentication import get_principal
+
 class IsManager(permissions.BasePermission):
     """
     Custom permission to only allow Managers to upload documents.
     """
     def has_permission(self, request, view):
-        return request.user.groups.filter(name='Manager').exists()
+        return get_principal(request).in_group('Manager')
 
 class IsSupervisor(permissions.BasePermission):
     """
     Custom permission to only allow Supervisors to view documents.
     """
     def has_permission(self, request, view):
-        return request.user.groups.filter(name='Supervisor').exists()
+        return get_principal(request).in_group('Supervisor')
 
 class IsManagerOrSupervisor(permissions.BasePermission):
     """
@@ -22,8 +24,9 @@ class IsManagerOrSupervisor(permissions.BasePermission):
     """
     def has_permission(self, request, view):
         # Supervisors can view, Managers can upload and view
+        principal = get_principal(request)
         if view.action == 'upload_document':
-            return request.user.groups.filter(name='Manager').exists()
+            return principal.in_group('Manager')
         elif view.action == 'get_project_documents':
-            return request.user.groups.filter(name='Manager').exists() or request.user.groups.filter(name='Supervisor').exists()
+            return principal.in_group('Manager') or principal.in_group('Supervisor')
         return False
@@ -0,0 +1,286 @@
+"""
+Read replicas for the appcms models.
+
+`ReplicaRouter` sends reads of appcms models to one of the database aliases
+in `settings.CMS_READ_REPLICAS`, and everything else to `default`: writes,
+`select_for_update()` (Django treats it as a write), reads inside a
+transaction on the primary, and the user and token tables, which a client
+reads straight after registering or logging in.
+
+A client that has just written sticks to the primary: after a successful
+POST/PUT/PATCH/DELETE, `ReplicaStickinessMiddleware` records in the shared
+cache, for CMS_REPLICA_STICKY_SECONDS, the client (its Authorization
+header, else its session, else its address), its authenticated user, and
+any token the write handed out (registration, login). Requests from any of
+those read from the primary until it expires, so they see their own
+writes, even when the next request is the first one sent with a new token.
+
+Replica lag is measured from the change log every CMS_REPLICA_CHECK_SECONDS:
+a replica holding every change the primary has is 0 seconds behind,
+otherwise it is as far behind as the oldest change it is missing. Replicas
+more than CMS_REPLICA_MAX_LAG behind, or that can't be queried, are skipped
+until they catch up; with none left, reads fall back to the primary.
+
+For local testing, `manage.py sync_replicas` copies an SQLite primary to
+SQLite replicas; set CMS_SQLITE_REPLICAS=<n> in the environment to
+configure `replica1`..`replicaN` (see settings.py).
+"""
+import hashlib
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models import Max
+from django.utils import timezone
+
+from . import metrics
+
+ROUTED_APPS = {'appcms'}
+UNSAFE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+replica_reads = metrics.counter('db.replica.reads', 'Reads routed to a replica')
+pinned_reads = metrics.counter('db.replica.pinned_reads', 'Reads kept on the primary for read-your-writes')
+fallbacks = metrics.counter('db.replica.fallbacks', 'Reads sent to the primary because no replica was healthy')
+lag_checks = metrics.counter('db.replica.lag_checks', 'Replica lag measurements')
+
+_pinned = ContextVar('appcms_replica_pinned', default=False)
+
+
+def replicas():
+    return list(getattr(settings, 'CMS_READ_REPLICAS', ()))
+
+
+@contextmanager
+def pin_to_primary():
+    """ Read from the primary for the duration of the block """
+    token = _pinned.set(True)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+def is_pinned():
+    pinned = _pinned.get()
+    return pinned() if callable(pinned) else pinned
+
+
+# Lag
+
+def measure_lag(alias):
+    """ Seconds `alias` is behind the primary, by the oldest change log entry it doesn't have yet """
+    from .models import ChangeLog
+
+    lag_checks.inc()
+    last = ChangeLog.objects.using(alias).aggregate(last=Max('id'))['last'] or 0
+    missing = (
+        ChangeLog.objects.using(DEFAULT_DB_ALIAS).filter(id__gt=last)
+        .order_by('id').values_list('created_at', flat=True).first()
+    )
+    if missing is None:
+        return 0.0
+    return max((timezone.now() - missing).total_seconds(), 0.0)
+
+
+class ReplicaHealth:
+    """ Per-process view of which replicas are fresh enough to read from, re-checked every few seconds """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked = {}  # alias: (monotonic time, lag seconds or None when unreachable)
+
+    def lag(self, alias):
+        now = time.monotonic()
+        with self._lock:
+            checked = self._checked.get(alias)
+        if checked is not None and now - checked[0] < getattr(settings, 'CMS_REPLICA_CHECK_SECONDS', 2):
+            return checked[1]
+        try:
+            lag = measure_lag(alias)
+        except Exception:
+            lag = None
+        with self._lock:
+            self._checked[alias] = (now, lag)
+        return lag
+
+    def healthy(self, aliases):
+        max_lag = getattr(settings, 'CMS_REPLICA_MAX_LAG', 10)
+        return [alias for alias in aliases if (lag := self.lag(alias)) is not None and lag <= max_lag]
+
+    def snapshot(self):
+        with self._lock:
+            return {alias: lag for alias, (_, lag) in self._checked.items()}
+
+    def clear(self):
+        with self._lock:
+            self._checked.clear()
+
+
+health = ReplicaHealth()
+
+
+# Router
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label not in ROUTED_APPS or model._meta.label == settings.AUTH_USER_MODEL:
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            # Follow relations on the database the instance came from
+            return instance._state.db
+        aliases = replicas()
+        if not aliases:
+            return None
+        if is_pinned() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            pinned_reads.inc()
+            return DEFAULT_DB_ALIAS
+        healthy = health.healthy(aliases)
+        if not healthy:
+            fallbacks.inc()
+            return DEFAULT_DB_ALIAS
+        replica_reads.inc()
+        return random.choice(healthy)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema from the primary
+        return db not in replicas()
+
+
+# Read-your-writes
+
+def _key(identity):
+    database = str(connections[DEFAULT_DB_ALIAS].settings_dict['NAME'])
+    digest = hashlib.sha256(f'{database}:{identity}'.encode()).hexdigest()[:32]
+    return f'appcms:replica:sticky:{digest}'
+
+
+def _client_key(request):
+    return _key(
+        request.META.get('HTTP_AUTHORIZATION')
+        or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        or request.META.get('REMOTE_ADDR', '')
+    )
+
+
+def _user_key(request):
+    """ Key of the request's authenticated user, or None; DRF sets request.user once the view authenticates """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return None
+    return _key(f'user:{user.pk}')
+
+
+def _write_keys(request, response):
+    """ Keys to pin after a successful write: the client, its user, and a token the response hands out """
+    keys = [_client_key(request), _user_key(request)]
+    data = getattr(response, 'data', None)
+    if isinstance(data, dict) and isinstance(data.get('token'), str):
+        keys.append(_key(f"Token {data['token']}"))
+    return [key for key in keys if key is not None]
+
+
+def _cache():
+    return caches[getattr(settings, 'CMS_OBJECT_CACHE', 'default')]
+
+
+class StickyCheck:
+    """
+    Whether a reading client is pinned, looked up on its first routed read:
+    by then the view has authenticated it, so its user's pin counts too.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.pinned = None
+
+    def __call__(self):
+        if self.pinned is not None:
+            return self.pinned
+        user_key = _user_key(self.request)
+        keys = [_client_key(self.request)] + ([user_key] if user_key else [])
+        pinned = bool(_cache().get_many(keys))
+        if pinned or user_key:
+            # Settled; an anonymous request is asked again in case it authenticates later
+            self.pinned = pinned
+        return pinned
+
+
+class ReplicaStickinessMiddleware:
+    """ Pins a client's reads to the primary while it writes, and for a short window afterwards """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not replicas():
+            return self.get_response(request)
+
+        writes = request.method in UNSAFE_METHODS
+        token = _pinned.set(writes or StickyCheck(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            _pinned.reset(token)
+        if writes and response.status_code < 400:
+            _cache().set_many(dict.fromkeys(_write_keys(request, response), 1), timeout=self.sticky_seconds())
+        return response
+
+    async def __acall__(self, request):
+        if not replicas():
+            return await self.get_response(request)
+
+        writes = request.method in UNSAFE_METHODS
+        # Routed reads run in sync threads, where the check can use the cache directly
+        token = _pinned.set(writes or StickyCheck(request))
+        try:
+            response = await self.get_response(request)
+        finally:
+            _pinned.reset(token)
+        if writes and response.status_code < 400:
+            await _cache().aset_many(dict.fromkeys(_write_keys(request, response), 1), timeout=self.sticky_seconds())
+        return response
+
+    @staticmethod
+    def sticky_seconds():
+        return getattr(settings, 'CMS_REPLICA_STICKY_SECONDS', 5)
+
+
+# SQLite file-copy replicas
+
+def copy_sqlite(source_alias, target_path):
+    """
+    Copy the SQLite database behind `source_alias` to `target_path` with the
+    online backup API (a consistent snapshot, even while it is being written),
+    then swap it into place so readers never open a half-written file.
+    """
+    source = connections[source_alias]
+    source.ensure_connection()
+    partial = f'{target_path}.{os.getpid()}.tmp'
+    target = sqlite3.connect(partial)
+    try:
+        source.connection.backup(target)
+    finally:
+        target.close()
+    os.replace(partial, target_path)
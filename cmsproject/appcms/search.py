@@ -0,0 +1,252 @@
+"""
+Full-text search over tasks, documents and media.
+
+What is searchable, per kind: a task's name and description, a document's
+title (and its type, so "inspection" finds inspection reports), and a media
+item's description. Every kind is searched by its project too.
+
+The index is kept in step by model signals (see signals.py), inside the
+writing transaction, so a rolled-back write never shows up in results.
+Writes that send no signals (bulk_create) call `index()` themselves.
+`manage.py rebuild_search_index` rebuilds it from scratch.
+
+The backend is chosen by settings.CMS_SEARCH_BACKEND:
+
+- `FTS5Backend` (the default) keeps an SQLite FTS5 inverted index in the
+  `appcms_search` virtual table created by migration 0019. A query reads
+  only the posting lists of its terms, so it stays fast on millions of
+  rows. Results are ranked by BM25, with title matches weighted above body
+  matches. Rows are keyed by rowid = object id * 8 + kind code, so an
+  update or delete finds its entry without a scan.
+- `DatabaseBackend` runs case-insensitive LIKE queries on the model tables.
+  It needs no index and works on any database, but scans: use it only
+  where FTS5 isn't available.
+
+Queries are split into words and every word must match; the last word also
+matches as a prefix, for search-as-you-type.
+"""
+import abc
+import functools
+import re
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .models import Document, Media, Task
+
+TABLE = 'appcms_search'
+MAX_LIMIT = 100
+WORD = re.compile(r'\w+')
+
+queries = metrics.timer('search.queries', 'Search queries answered')
+indexed = metrics.counter('search.indexed', 'Objects written to the search index')
+
+Entry = namedtuple('Entry', 'id project_id title body')
+
+
+class Source:
+    """ How one kind of object is indexed """
+
+    def __init__(self, kind, code, model, title, body, fields):
+        self.kind = kind
+        self.code = code
+        self.model = model
+        self.title = title
+        self.body = body
+        # Model fields the entry is built from: saves touching none of them leave the index alone
+        self.fields = fields
+
+    def entry(self, instance):
+        return Entry(instance.pk, instance.project_id, self.title(instance) or '', self.body(instance) or '')
+
+
+SOURCES = {
+    source.model: source for source in (
+        Source('task', 1, Task, lambda task: task.name, lambda task: task.description,
+               {'name', 'description', 'project'}),
+        Source('document', 2, Document, lambda document: document.title, lambda document: document.get_document_type_display(),
+               {'title', 'document_type', 'project'}),
+        Source('media', 3, Media, lambda media: '', lambda media: media.description,
+               {'description', 'project'}),
+    )
+}
+KINDS = {source.kind: source for source in SOURCES.values()}
+
+
+def terms(query):
+    """ The words of `query`, lowercased """
+    return [word.lower() for word in WORD.findall(query)]
+
+
+# Backends
+
+class SearchBackend(abc.ABC):
+    """ What CMS_SEARCH_BACKEND names: one index over every source """
+
+    @abc.abstractmethod
+    def update(self, source, entries):
+        """ Add or replace the index entries for `entries` of one source """
+
+    @abc.abstractmethod
+    def remove(self, source, ids):
+        """ Drop the index entries of one source's `ids` """
+
+    @abc.abstractmethod
+    def search(self, words, project=None, kinds=None, limit=20, offset=0):
+        """ Ranked hits: dicts of kind, id, project, title, snippet and score """
+
+    @abc.abstractmethod
+    def rebuild(self):
+        """ Reindex every object; returns the number indexed """
+
+
+class FTS5Backend(SearchBackend):
+    # bm25() weights per column: kind, project, title, body
+    weights = (0.0, 0.0, 10.0, 1.0)
+
+    def _connection(self, write=True):
+        return connections[router.db_for_write(Task) if write else router.db_for_read(Task)]
+
+    @staticmethod
+    def _rowid(source, pk):
+        return pk * 8 + source.code
+
+    def update(self, source, entries):
+        entries = list(entries)
+        if not entries:
+            return
+        rows = [(self._rowid(source, entry.id),) for entry in entries]
+        with self._connection().cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {TABLE} WHERE rowid = %s', rows)
+            cursor.executemany(
+                f'INSERT INTO {TABLE} (rowid, kind, project, title, body) VALUES (%s, %s, %s, %s, %s)',
+                [(self._rowid(source, entry.id), source.kind, f'p{entry.project_id}', entry.title, entry.body) for entry in entries],
+            )
+        indexed.inc(len(entries))
+
+    def remove(self, source, ids):
+        with self._connection().cursor() as cursor:
+            cursor.executemany(f'DELETE FROM {TABLE} WHERE rowid = %s', [(self._rowid(source, pk),) for pk in ids])
+
+    def match_expression(self, words, project=None, kinds=None):
+        """ The FTS5 MATCH expression: every word in the title or body, then the project and kind filters """
+        quoted = [f'"{word}"' for word in words]
+        quoted[-1] += '*'
+        expression = f'{{title body}} : ({" ".join(quoted)})'
+        if project is not None:
+            expression += f' AND project : "p{int(project)}"'
+        if kinds:
+            expression += f' AND kind : ({" OR ".join(sorted(kinds))})'
+        return expression
+
+    def search(self, words, project=None, kinds=None, limit=20, offset=0):
+        rank = f"bm25({TABLE}, {', '.join(str(weight) for weight in self.weights)})"
+        with self._connection(write=False).cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid, kind, project, title, snippet({TABLE}, 3, '[', ']', '…', 12), {rank} "
+                f"FROM {TABLE} WHERE {TABLE} MATCH %s ORDER BY {rank} LIMIT %s OFFSET %s",
+                [self.match_expression(words, project, kinds), limit, offset],
+            )
+            rows = cursor.fetchall()
+        return [
+            {
+                'kind': kind,
+                'id': rowid // 8,
+                'project': int(project_token[1:]),
+                'title': title,
+                'snippet': snippet,
+                'score': round(-score, 6),
+            }
+            for rowid, kind, project_token, title, snippet, score in rows
+        ]
+
+    def rebuild(self):
+        with self._connection().cursor() as cursor:
+            cursor.execute(f'DELETE FROM {TABLE}')
+        count = 0
+        for source in SOURCES.values():
+            last = 0
+            rows = source.model.objects.only(*source.fields).order_by('pk')
+            while batch := list(rows.filter(pk__gt=last)[:1000]):
+                self.update(source, [source.entry(instance) for instance in batch])
+                count += len(batch)
+                last = batch[-1].pk
+        with self._connection().cursor() as cursor:
+            cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
+        return count
+
+
+class DatabaseBackend(SearchBackend):
+    """ LIKE queries on the model tables; nothing to maintain """
+    lookups = {
+        'task': ('name', 'description'),
+        'document': ('title', 'document_type'),
+        'media': ('description',),
+    }
+
+    def update(self, source, entries):
+        pass
+
+    def remove(self, source, ids):
+        pass
+
+    def search(self, words, project=None, kinds=None, limit=20, offset=0):
+        hits = []
+        for kind, source in KINDS.items():
+            if kinds and kind not in kinds:
+                continue
+            fields = self.lookups[kind]
+            queryset = source.model.objects.all()
+            for word in words:
+                queryset = queryset.filter(functools.reduce(
+                    lambda q, field: q | Q(**{f'{field}__icontains': word}), fields, Q()
+                ))
+            if project is not None:
+                queryset = queryset.filter(project_id=project)
+            for instance in queryset.order_by('-pk')[:offset + limit]:
+                entry = source.entry(instance)
+                # Words found in the title count ten times those in the body, as with FTS5
+                score = sum(10 * (word in entry.title.lower()) + (word in entry.body.lower()) for word in words)
+                hits.append({
+                    'kind': kind, 'id': entry.id, 'project': entry.project_id,
+                    'title': entry.title, 'snippet': entry.body[:200], 'score': float(score),
+                })
+        hits.sort(key=lambda hit: -hit['score'])
+        return hits[offset:offset + limit]
+
+    def rebuild(self):
+        return 0
+
+
+@functools.lru_cache(maxsize=None)
+def _load(path):
+    return import_string(path)()
+
+
+def get_backend():
+    return _load(getattr(settings, 'CMS_SEARCH_BACKEND', 'appcms.search.FTS5Backend'))
+
+
+# Index maintenance and queries
+
+def index(model, instances):
+    """ Index (or reindex) `instances` of `model` """
+    source = SOURCES[model]
+    get_backend().update(source, [source.entry(instance) for instance in instances])
+
+
+def unindex(model, ids):
+    get_backend().remove(SOURCES[model], ids)
+
+
+def search(query, project=None, kinds=None, limit=20, offset=0):
+    """ Ranked hits for `query`; no words, no hits """
+    words = terms(query)
+    if not words:
+        return []
+    with queries.time():
+        return get_backend().search(words, project=project, kinds=kinds, limit=min(limit, MAX_LIMIT), offset=offset)
@@ -1,9 +1,109 @@
+from urllib.parse import urlencode
+
+from django.db import models
+from django.urls import reverse
 from rest_framework import serializers
-from .models import User, Manager, Supervisor, Project, Task, Resource, Worker, Document, Media
+from .models import User, Manager, Supervisor, Project, Task, Resource, Worker, Document, Media, MediaUpload
+from . import inventory, onboarding, sqlite, uploads
+
+# /files/<kind>/ of each model with uploads (see views.FileView)
+FILE_KINDS = {Document: 'documents', Media: 'media', Task: 'tasks'}
+
+
+def _param_set(request, name):
+    value = request.query_params.get(name)
+    return {part.strip() for part in value.split(',') if part.strip()} if value else set()
+
+
+def requested_fields(request):
+    """
+    The response shape a GET request asks for: (fields, exclude, expand).
+    `fields` is None when the client didn't restrict the fields.
+    """
+    if request is None or request.method not in ('GET', 'HEAD'):
+        return None, set(), set()
+    fields = _param_set(request, 'fields')
+    return fields or None, _param_set(request, 'exclude'), _param_set(request, 'expand')
+
+
+# Dynamic fields mixin
+class DynamicFieldsMixin:
+    """
+    Lets GET clients shape the top-level serializer with ?fields=, ?exclude=
+    and ?expand=. `Meta.expandable` maps a relation to the name of the
+    serializer used to inline it; anything else in ?expand= is ignored.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if not self._is_root():
+            return fields
+
+        only, exclude, expand = requested_fields(self.context.get('request'))
+        for name, serializer_name in getattr(self.Meta, 'expandable', {}).items():
+            if name in expand and name in fields:
+                fields[name] = globals()[serializer_name](read_only=True)
+        if only is not None:
+            fields = {name: field for name, field in fields.items() if name in only}
+        for name in exclude:
+            fields.pop(name, None)
+        return fields
+
+    def _is_root(self):
+        parent = self.parent
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        return parent is None
+
+
+# Served file fields
+def file_url(request, instance, field, variant=None):
+    """ /files/ URL of one of the row's files, which checks permissions and serves ranges """
+    url = reverse('file', kwargs={'kind': FILE_KINDS[type(instance)], 'pk': instance.pk, 'field': field})
+    if variant:
+        url = f"{url}?{urlencode({'variant': variant})}"
+    return request.build_absolute_uri(url) if request is not None else url
+
+
+class ServedFileField(serializers.FileField):
+    """ Accepts an upload like FileField, but renders the file's /files/ URL rather than its MEDIA_URL """
+
+    def to_representation(self, value):
+        if not value:
+            return None
+        return file_url(self.context.get('request'), value.instance, value.field.name)
+
+
+class ServedImageField(ServedFileField, serializers.ImageField):
+    pass
+
+
+class ServedFilesMixin:
+    """ Model file and image fields are rendered as /files/ URLs """
+    serializer_field_mapping = {
+        **serializers.ModelSerializer.serializer_field_mapping,
+        models.FileField: ServedFileField,
+        models.ImageField: ServedImageField,
+    }
+
+
+# Image variant field
+class ImageVariantField(serializers.ReadOnlyField):
+    """ /files/ URL of one derivative of the row's image (see appcms.derivatives), or None until it is rendered """
+
+    def __init__(self, variant, **kwargs):
+        self.variant = variant
+        super().__init__(source='*', **kwargs)
+
+    def to_representation(self, instance):
+        variants = instance.image_variants
+        if not instance.image or variants.get('source') != instance.image.name or self.variant not in variants:
+            return None
+        return file_url(self.context.get('request'), instance, 'image', self.variant)
 
 
 # User Serializer
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('id', 'username', 'password', 'role')
@@ -11,23 +111,26 @@ class UserSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         user = User(**validated_data)
-        user.set_password(validated_data['password'])  # Hash the password
+        # Hashed on the shared pool; raises onboarding.Overloaded when it's saturated
+        user.password = onboarding.hash_passwords([validated_data['password']])[0]
         user.save()
         return user
 
 
 # Manager Serializer
-class ManagerSerializer(serializers.ModelSerializer):
+class ManagerSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Manager
         fields = ('id', 'user', 'department', 'phone_number')
+        expandable = {'user': 'UserSerializer'}
 
 
 # Supervisor Serializer
-class SupervisorSerializer(serializers.ModelSerializer):
+class SupervisorSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Supervisor
         fields = ('id', 'user')
+        expandable = {'user': 'UserSerializer'}
 
 
 # Project Serializer
@@ -51,7 +154,7 @@ class SupervisorSerializer(serializers.ModelSerializer):
 
 
 # Resource Serializer
-class ResourceSerializer(serializers.ModelSerializer):
+class ResourceSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Resource
         fields = ['id', 'name', 'quantity']
@@ -61,9 +164,24 @@ class ResourceSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Quantity cannot be negative.")
         return value
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # The column is only the ledger snapshot; report the live balance
+        if 'quantity' in data:
+            data['quantity'] = instance.balance
+        return data
+
+    def update(self, instance, validated_data):
+        quantity = validated_data.pop('quantity', None)
+        with sqlite.write_transaction():
+            instance = super().update(instance, validated_data)
+            if quantity is not None:
+                instance.ledger_balance = inventory.set_balance(instance.pk, quantity)
+        return instance
+
 
 # Worker Serializer
-class WorkerSerializer(serializers.ModelSerializer):
+class WorkerSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Worker
         fields = ['id', 'name', 'aadhar_number', 'is_working']
@@ -75,10 +193,21 @@ class WorkerSerializer(serializers.ModelSerializer):
 
 
 # Task Serializer
-class TaskSerializer(serializers.ModelSerializer):
+class TaskSerializer(DynamicFieldsMixin, ServedFilesMixin, serializers.ModelSerializer):
+    resource = serializers.PrimaryKeyRelatedField(queryset=Resource.objects.with_balance())
+    supervisor = serializers.PrimaryKeyRelatedField(queryset=Supervisor.objects.select_related('user'))
+    image_thumb = ImageVariantField('thumb')
+    image_medium = ImageVariantField('medium')
+
     class Meta:
         model = Task
-        fields = ['id', 'name', 'resource', 'quantity_used', 'worker', 'project', 'supervisor', 'start_date', 'end_date', 'image', 'description']
+        fields = ['id', 'name', 'resource', 'quantity_used', 'worker', 'project', 'supervisor', 'start_date', 'end_date', 'image', 'image_thumb', 'image_medium', 'description']
+        expandable = {
+            'resource': 'ResourceSerializer',
+            'worker': 'WorkerSerializer',
+            'project': 'ProjectSerializer',
+            'supervisor': 'SupervisorSerializer',
+        }
 
     def validate(self, data):
         resource = data.get('resource')
@@ -90,21 +219,28 @@ class TaskSerializer(serializers.ModelSerializer):
         if quantity_used is None or quantity_used <= 0:
             raise serializers.ValidationError("Quantity used must be a positive integer.")
 
-        if resource.quantity < quantity_used:
+        # On update the task's current usage goes back to the resource first
+        available = resource.balance
+        if self.instance is not None and self.instance.resource_id == resource.id:
+            available += self.instance.quantity_used
+
+        if available < quantity_used:
             raise serializers.ValidationError(
-                f"Insufficient quantity for resource {resource.name}. Available: {resource.quantity}, Requested: {quantity_used}"
+                f"Insufficient quantity for resource {resource.name}. Available: {available}, Requested: {quantity_used}"
             )
         
         return data
 
 
 # Profile Serializer
-class ProjectSerializer(serializers.ModelSerializer):
-    supervisor = serializers.PrimaryKeyRelatedField(queryset=Supervisor.objects.all())
+class ProjectSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    # Choices are labelled with Supervisor.__str__, which reads the user
+    supervisor = serializers.PrimaryKeyRelatedField(queryset=Supervisor.objects.select_related('user'))
 
     class Meta:
         model = Project
         fields = ['id', 'name', 'supervisor', 'location', 'budget', 'timeline']
+        expandable = {'supervisor': 'SupervisorSerializer'}
 
     def validate(self, data):
         # Validate supervisor_id if provided
@@ -117,21 +253,28 @@ class ProjectSerializer(serializers.ModelSerializer):
         return data
 
 # Document Serializer
-class DocumentSerializer(serializers.ModelSerializer):
+class DocumentSerializer(DynamicFieldsMixin, ServedFilesMixin, serializers.ModelSerializer):
     class Meta:
         model = Document
         fields = ['id', 'project', 'title', 'document_type', 'file', 'created_at']
+        expandable = {'project': 'ProjectSerializer'}
 
 
 # Media Serializer
-class MediaSerializer(serializers.ModelSerializer):
-    # Optional: You can use the related model fields for convenience
-    supervisor_id = serializers.PrimaryKeyRelatedField(queryset=Supervisor.objects.all(), write_only=True)
-    manager_id = serializers.PrimaryKeyRelatedField(queryset=Manager.objects.all(), write_only=True)
-    
+class MediaSerializer(DynamicFieldsMixin, ServedFilesMixin, serializers.ModelSerializer):
+    supervisor = serializers.PrimaryKeyRelatedField(queryset=Supervisor.objects.select_related('user'))
+    manager = serializers.PrimaryKeyRelatedField(queryset=Manager.objects.select_related('user'))
+    image_thumb = ImageVariantField('thumb')
+    image_medium = ImageVariantField('medium')
+
     class Meta:
         model = Media
-        fields = ['id', 'project', 'supervisor', 'manager', 'image', 'video', 'description', 'created_at']
+        fields = ['id', 'project', 'supervisor', 'manager', 'image', 'image_thumb', 'image_medium', 'video', 'description', 'created_at']
+        expandable = {
+            'project': 'ProjectSerializer',
+            'supervisor': 'SupervisorSerializer',
+            'manager': 'ManagerSerializer',
+        }
 
     def validate(self, data):
         # Ensure either image or video is provided
@@ -147,3 +290,39 @@ class MediaSerializer(serializers.ModelSerializer):
                 raise serializers.ValidationError("Video must be in MP4, MKV, or AVI format.")
         
         return data
+
+
+# Media Upload Serializer
+class MediaUploadSerializer(serializers.ModelSerializer):
+    supervisor = serializers.PrimaryKeyRelatedField(queryset=Supervisor.objects.all())
+    manager = serializers.PrimaryKeyRelatedField(queryset=Manager.objects.all())
+    chunk_size = serializers.IntegerField(min_value=uploads.MIN_CHUNK_SIZE, max_value=uploads.MAX_CHUNK_SIZE, default=8 * 1024 * 1024)
+    received = serializers.SerializerMethodField()
+    missing = serializers.SerializerMethodField()
+
+    class Meta:
+        model = MediaUpload
+        fields = ['id', 'project', 'supervisor', 'manager', 'description', 'filename', 'size', 'chunk_size', 'sha256', 'received', 'missing', 'media', 'created_at']
+        read_only_fields = ['media', 'created_at']
+
+    def get_received(self, obj):
+        return sorted(chunk.offset for chunk in obj.chunks.all())
+
+    def get_missing(self, obj):
+        received = set(self.get_received(obj))
+        return [offset for offset in obj.offsets if offset not in received]
+
+    def validate_filename(self, value):
+        if not value.lower().endswith(uploads.VIDEO_EXTENSIONS):
+            raise serializers.ValidationError("Video must be in MP4, MKV, or AVI format.")
+        return value
+
+    def validate_size(self, value):
+        if value <= 0 or value > uploads.max_upload_size():
+            raise serializers.ValidationError(f"Size must be between 1 and {uploads.max_upload_size()} bytes.")
+        return value
+
+    def validate_sha256(self, value):
+        if value and (len(value) != 64 or any(c not in '0123456789abcdef' for c in value.lower())):
+            raise serializers.ValidationError("Must be a hex SHA-256 digest.")
+        return value.lower()
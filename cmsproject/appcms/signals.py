@@ -0,0 +1,323 @@
+"""
+Signals for the CMS app and the receivers that keep derived state in step.
+
+Receivers are connected when AppcmsConfig.ready() imports this module.
+"""
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import Signal, receiver
+from django.utils import timezone
+
+from rest_framework.authtoken.models import Token
+
+from . import authentication, availability, derivatives, search, storage, summaries
+from .cache import object_cache
+from .models import Blob, ChangeLog, Document, Manager, Media, Project, ProjectSummary, Resource, Supervisor, Task, User, Worker
+
+# Sent by the inventory engine after it records movements for a resource.
+# Arguments: resource_id.
+resource_balance_changed = Signal()
+
+# File fields stored as shared blobs, whose references are counted
+FILE_FIELDS = {
+    Task: ('image',),
+    Document: ('file',),
+    Media: ('image', 'video'),
+}
+
+# Models whose writes are logged for the delta-sync feed
+SYNCED_MODELS = (User, Manager, Supervisor, Project, Resource, Worker, Task, Document, Media)
+
+
+# Object cache invalidation
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+@receiver(post_save, sender=Resource)
+@receiver(post_delete, sender=Resource)
+@receiver(post_save, sender=Worker)
+@receiver(post_delete, sender=Worker)
+def invalidate_cached_object(sender, instance, **kwargs):
+    object_cache.invalidate(sender, instance.pk)
+
+
+@receiver(post_save, sender=Supervisor)
+@receiver(post_delete, sender=Supervisor)
+def invalidate_cached_projects(sender, instance, **kwargs):
+    # Project lists can inline their supervisor
+    object_cache.invalidate(Project)
+
+
+@receiver(pre_delete, sender=Supervisor)
+def invalidate_orphaned_projects(sender, instance, **kwargs):
+    # on_delete=SET_NULL rewrites these without a save(), so drop each cached copy now
+    for pk in Project.objects.filter(supervisor=instance).values_list('pk', flat=True):
+        object_cache.invalidate(Project, pk)
+
+
+@receiver(resource_balance_changed)
+def invalidate_cached_resource(sender, resource_id, **kwargs):
+    object_cache.invalidate(Resource, resource_id)
+
+
+# Change log for /sync/
+def log_upsert(sender, instance, raw=False, **kwargs):
+    if not raw:
+        ChangeLog.record(sender, [instance.pk])
+
+
+def log_delete(sender, instance, **kwargs):
+    ChangeLog.record(sender, [instance.pk], ChangeLog.DELETE)
+
+
+for model in SYNCED_MODELS:
+    post_save.connect(log_upsert, sender=model, dispatch_uid=f'changelog-upsert-{model._meta.label_lower}')
+    post_delete.connect(log_delete, sender=model, dispatch_uid=f'changelog-delete-{model._meta.label_lower}')
+
+
+# on_delete=SET_NULL is a bulk update that sends no signals and leaves updated_at alone,
+# so log the rows it will touch and move their updated_at for the conditional-GET validators
+@receiver(pre_delete, sender=Supervisor)
+def log_orphaned_projects(sender, instance, **kwargs):
+    projects = Project.objects.filter(supervisor=instance)
+    ChangeLog.record(Project, projects.values_list('pk', flat=True))
+    projects.update(updated_at=timezone.now())
+
+
+@receiver(pre_delete, sender=Worker)
+def log_orphaned_tasks(sender, instance, **kwargs):
+    tasks = Task.objects.filter(worker=instance)
+    ChangeLog.record(Task, tasks.values_list('pk', flat=True))
+    tasks.update(updated_at=timezone.now())
+
+
+@receiver(resource_balance_changed)
+def log_balance_change(sender, resource_id, **kwargs):
+    ChangeLog.record(Resource, [resource_id])
+
+
+# Image derivatives
+@receiver(post_save, sender=Media)
+@receiver(post_save, sender=Task)
+def schedule_derivatives(sender, instance, raw=False, **kwargs):
+    if not raw and derivatives.needs_derivatives(instance):
+        derivatives.schedule(instance)
+
+
+# Search index, written in the same transaction as the row
+def index_for_search(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw:
+        return
+    if update_fields is not None and not search.SOURCES[sender].fields & set(update_fields):
+        return
+    search.index(sender, [instance])
+
+
+def unindex_for_search(sender, instance, **kwargs):
+    search.unindex(sender, [instance.pk])
+
+
+for model in search.SOURCES:
+    post_save.connect(index_for_search, sender=model, dispatch_uid=f'search-index-{model._meta.label_lower}')
+    post_delete.connect(unindex_for_search, sender=model, dispatch_uid=f'search-unindex-{model._meta.label_lower}')
+
+
+# Project summaries, adjusted in the same transaction as the row
+SUMMARY_TASK_FIELDS = {'project', 'resource', 'quantity_used', 'worker'}
+
+
+def _deleting_project(origin):
+    # The summary goes with the project, so there is nothing left to adjust
+    return isinstance(origin, Project) or getattr(origin, 'model', None) is Project
+
+
+@receiver(post_save, sender=Project)
+def create_project_summary(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        ProjectSummary.objects.create(project=instance)
+
+
+@receiver(pre_save, sender=Task)
+def remember_summary_state(sender, instance, raw=False, update_fields=None, **kwargs):
+    instance._summary_state = None
+    if raw or instance._state.adding:
+        return
+    if update_fields is not None and not SUMMARY_TASK_FIELDS & set(update_fields):
+        instance._summary_state = False
+        return
+    row = sender._base_manager.filter(pk=instance.pk).values_list('project_id', 'resource_id', 'quantity_used', 'worker_id').first()
+    instance._summary_state = summaries.TaskState(*row) if row else None
+
+
+@receiver(post_save, sender=Task)
+def summarize_task(sender, instance, raw=False, **kwargs):
+    old = getattr(instance, '_summary_state', None)
+    if raw or old is False:
+        return
+    summaries.tasks_changed([(old, summaries.task_state(instance))])
+
+
+@receiver(post_delete, sender=Task)
+def unsummarize_task(sender, instance, origin=None, **kwargs):
+    if not _deleting_project(origin):
+        summaries.tasks_changed([(summaries.task_state(instance), None)])
+
+
+def remember_summary_project(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or instance._state.adding:
+        instance._summary_project = None
+    elif update_fields is not None and 'project' not in update_fields:
+        instance._summary_project = instance.project_id
+    else:
+        instance._summary_project = sender._base_manager.filter(pk=instance.pk).values_list('project_id', flat=True).first()
+
+
+def count_for_summary(sender, instance, raw=False, **kwargs):
+    if not raw:
+        summaries.counted(sender, getattr(instance, '_summary_project', None), instance.project_id)
+
+
+def uncount_for_summary(sender, instance, origin=None, **kwargs):
+    if not _deleting_project(origin):
+        summaries.counted(sender, instance.project_id, None)
+
+
+for model in (Media, Document):
+    pre_save.connect(remember_summary_project, sender=model, dispatch_uid=f'summary-before-{model._meta.label_lower}')
+    post_save.connect(count_for_summary, sender=model, dispatch_uid=f'summary-count-{model._meta.label_lower}')
+    post_delete.connect(uncount_for_summary, sender=model, dispatch_uid=f'summary-uncount-{model._meta.label_lower}')
+
+
+@receiver(pre_save, sender=Worker)
+@receiver(pre_save, sender=Resource)
+def remember_summary_attribute(sender, instance, raw=False, **kwargs):
+    field = 'is_working' if sender is Worker else 'resource_type'
+    instance._summary_attribute = None
+    if not raw and not instance._state.adding:
+        instance._summary_attribute = sender._base_manager.filter(pk=instance.pk).values_list(field, flat=True).first()
+
+
+@receiver(post_save, sender=Worker)
+def summarize_worker_activity(sender, instance, created, raw=False, **kwargs):
+    was_working = getattr(instance, '_summary_attribute', None)
+    if not raw and not created and was_working is not None and was_working != instance.is_working:
+        summaries.worker_activity_changed(instance.pk, instance.is_working)
+
+
+@receiver(pre_delete, sender=Worker)
+def unsummarize_worker(sender, instance, **kwargs):
+    # Its tasks are unassigned by a bulk update and its ProjectWorker rows cascade
+    if sender._base_manager.filter(pk=instance.pk, is_working=True).exists():
+        summaries.worker_activity_changed(instance.pk, False)
+
+
+@receiver(post_save, sender=Resource)
+def summarize_resource_type(sender, instance, created, raw=False, **kwargs):
+    old_type = getattr(instance, '_summary_attribute', None)
+    if not raw and not created and old_type is not None and old_type != instance.resource_type:
+        # Every task on the resource moves between usage columns
+        summaries.rebuild(Task.objects.filter(resource=instance).values_list('project_id', flat=True).distinct())
+
+
+# Worker availability bitmaps, refreshed in the same transaction as the task
+AVAILABILITY_TASK_FIELDS = {'worker', 'start_date', 'end_date'}
+
+
+@receiver(pre_save, sender=Task)
+def remember_booking(sender, instance, raw=False, update_fields=None, **kwargs):
+    instance._booking = None
+    if raw or instance._state.adding:
+        return
+    if update_fields is not None and not AVAILABILITY_TASK_FIELDS & set(update_fields):
+        instance._booking = False
+        return
+    row = sender._base_manager.filter(pk=instance.pk).values_list('worker_id', 'start_date', 'end_date').first()
+    instance._booking = availability.Booking(*row) if row else None
+
+
+@receiver(post_save, sender=Task)
+def book_worker(sender, instance, raw=False, **kwargs):
+    old = getattr(instance, '_booking', None)
+    if raw or old is False:
+        return
+    availability.tasks_changed([(old, availability.booking(instance))])
+
+
+@receiver(post_delete, sender=Task)
+def release_worker(sender, instance, **kwargs):
+    availability.tasks_changed([(availability.booking(instance), None)])
+
+
+# Blob reference counts
+def _blob_names(names):
+    return [name for name in names if storage.is_blob(name)]
+
+
+def remember_stored_files(sender, instance, raw=False, update_fields=None, **kwargs):
+    fields = FILE_FIELDS[sender]
+    if update_fields is not None:
+        fields = [field for field in fields if field in update_fields]
+    instance._stored_files = None
+    if raw or not fields or instance._state.adding:
+        return
+    row = sender._base_manager.filter(pk=instance.pk).values_list(*fields).first()
+    instance._stored_files = dict(zip(fields, row)) if row else None
+
+
+def count_file_references(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    before = getattr(instance, '_stored_files', None) or {}
+    fields = FILE_FIELDS[sender] if created else before.keys()
+    old = [before.get(field) for field in fields]
+    new = [getattr(instance, field).name for field in fields]
+    changed = [(o, n) for o, n in zip(old, new) if o != n]
+    Blob.adjust(_blob_names(n for _, n in changed), +1)
+    Blob.adjust(_blob_names(o for o, _ in changed), -1)
+
+
+def release_file_references(sender, instance, **kwargs):
+    Blob.adjust(_blob_names(getattr(instance, field).name for field in FILE_FIELDS[sender]), -1)
+
+
+for model in FILE_FIELDS:
+    pre_save.connect(remember_stored_files, sender=model, dispatch_uid=f'blob-before-{model._meta.label_lower}')
+    post_save.connect(count_file_references, sender=model, dispatch_uid=f'blob-count-{model._meta.label_lower}')
+    post_delete.connect(release_file_references, sender=model, dispatch_uid=f'blob-release-{model._meta.label_lower}')
+
+
+# Cached token authentication
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    # Covers deactivation and role changes, and anything else that alters request.user
+    authentication.invalidate_user(instance.pk)
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_cached_token(sender, instance, **kwargs):
+    authentication.invalidate_user(instance.user_id)
+
+
+# Principals are cached with the user, so profile and group changes invalidate it too
+@receiver(post_save, sender=Manager)
+@receiver(post_delete, sender=Manager)
+@receiver(post_save, sender=Supervisor)
+@receiver(post_delete, sender=Supervisor)
+def invalidate_cached_principal(sender, instance, **kwargs):
+    authentication.invalidate_user(instance.user_id)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_cached_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # post_clear names nobody and the group is empty by then, so note its members now
+        instance._cleared_user_ids = list(instance.user_set.values_list('pk', flat=True))
+        return
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        authentication.invalidate_user(instance.pk)
+        return
+    # Changed from the group's side: every member named, or the members noted before a clear
+    user_ids = pk_set if pk_set is not None else instance.__dict__.pop('_cleared_user_ids', [])
+    for user_id in user_ids:
+        authentication.invalidate_user(user_id)
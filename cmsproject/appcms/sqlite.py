@@ -0,0 +1,146 @@
+"""
+High-concurrency profile for SQLite databases.
+
+SQLite has no row locks, so `select_for_update()` is a no-op and writers are
+serialized by a single database lock. Three things keep that lock from
+turning into "database is locked" errors under load:
+
+- every connection runs in WAL mode with the pragmas in CMS_SQLITE_PRAGMAS,
+  so readers never block the writer and commits don't fsync the main file;
+- transactions that read and then write (stock movements, task saves,
+  worker assignment) are opened with `write_transaction()`, which starts
+  them with BEGIN IMMEDIATE: the write lock is taken up front, queueing in
+  SQLite's busy handler for up to OPTIONS['timeout'] seconds. A deferred
+  transaction that reads first and writes later can't wait: if another
+  writer committed in between it fails at once. Every other transaction
+  stays deferred, so a long one (an upload being assembled, an import
+  being parsed) doesn't hold the database-wide lock while it works; keep
+  file and network I/O out of write transactions;
+- writes that still time out are retried from the top of the transaction by
+  `retry_on_lock`, up to CMS_SQLITE_LOCK_RETRIES times with jittered
+  exponential backoff.
+
+Time spent waiting for the lock at BEGIN, lock errors, retries and give-ups
+are reported under db.lock.* on /metrics/. `manage.py stress_sqlite` checks
+the profile with several processes writing to one database file.
+"""
+import functools
+import random
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from . import metrics
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',  # durable in WAL mode except across a power cut
+    'temp_store': 'MEMORY',
+    'cache_size': -16000,  # KiB
+    'mmap_size': 128 * 1024 * 1024,
+}
+LOCK_MESSAGES = ('database is locked', 'database table is locked')
+
+lock_waits = metrics.timer('db.lock.wait', 'Time spent waiting for the write lock at BEGIN')
+lock_errors = metrics.counter('db.lock.errors', 'Statements that failed because the database was locked')
+lock_retries = metrics.counter('db.lock.retries', 'Transactions retried after a lock timeout')
+lock_gave_up = metrics.counter('db.lock.gave_up', 'Transactions that still hit a locked database after every retry')
+
+
+def is_lock_error(exc):
+    return isinstance(exc, OperationalError) and any(message in str(exc) for message in LOCK_MESSAGES)
+
+
+# Connection setup
+
+@receiver(connection_created)
+def configure(sender, connection, **kwargs):
+    """ Apply the pragmas and the lock monitor to every new SQLite connection """
+    if connection.vendor != 'sqlite':
+        return
+    # Replicas are read-only copies swapped in by file; they keep the primary's journal
+    if connection.alias not in getattr(settings, 'CMS_READ_REPLICAS', ()):
+        pragmas = getattr(settings, 'CMS_SQLITE_PRAGMAS', DEFAULT_PRAGMAS)
+        with connection.cursor() as cursor:
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name} = {value}')
+    if lock_monitor not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, lock_monitor)
+
+
+def lock_monitor(execute, sql, params, many, context):
+    """ Execute wrapper timing BEGIN and counting lock errors """
+    try:
+        if sql.startswith('BEGIN'):
+            with lock_waits.time():
+                return execute(sql, params, many, context)
+        return execute(sql, params, many, context)
+    except OperationalError as e:
+        if is_lock_error(e):
+            lock_errors.inc()
+        raise
+
+
+# Write transactions
+
+class WriteTransaction(transaction.Atomic):
+    """
+    atomic() that, when it opens the transaction on SQLite, takes the write
+    lock at BEGIN. Nested in an open transaction it is a plain savepoint.
+    """
+
+    def __enter__(self):
+        connection = transaction.get_connection(self.using)
+        if (
+            connection.vendor != 'sqlite'
+            or connection.in_atomic_block
+            or not getattr(settings, 'CMS_SQLITE_IMMEDIATE_WRITES', True)
+        ):
+            return super().__enter__()
+        connection.ensure_connection()
+        # Read by the backend when atomic() issues BEGIN
+        previous, connection.transaction_mode = connection.transaction_mode, 'IMMEDIATE'
+        try:
+            return super().__enter__()
+        finally:
+            connection.transaction_mode = previous
+
+
+def write_transaction(using=None, savepoint=True, durable=False):
+    return WriteTransaction(using, savepoint, durable)
+
+
+# Retries
+
+def retry_on_lock(func=None, using=DEFAULT_DB_ALIAS):
+    """
+    Decorator re-running `func` when it fails because the database is locked.
+
+    Only the outermost transaction can be retried: inside an atomic block the
+    error is raised as is, for the code that opened the block to handle.
+    """
+    if func is None:
+        return functools.partial(retry_on_lock, using=using)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        attempts = getattr(settings, 'CMS_SQLITE_LOCK_RETRIES', 3)
+        backoff = getattr(settings, 'CMS_SQLITE_LOCK_BACKOFF', 0.05)
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if not is_lock_error(e) or connections[using].in_atomic_block:
+                    raise
+                if attempt >= attempts:
+                    lock_gave_up.inc()
+                    raise
+            attempt += 1
+            lock_retries.inc()
+            time.sleep(min(backoff * 2 ** (attempt - 1), 1.0) * random.uniform(0.5, 1.0))
+
+    return wrapper
@@ -0,0 +1,140 @@
+"""
+Content-addressed storage for uploaded files.
+
+Every upload is hashed (SHA-256) while it is streamed to a temporary file,
+then stored once as `blobs/ab/cd/<digest><ext>`; uploading the same bytes
+again, from any row, reuses the stored blob. Each blob has a `Blob` row whose
+`refcount` counts the model fields pointing at it (kept up to date by the
+receivers in signals.py), so deleting a Document, Media or Task never
+deletes a file another row still uses. `delete()` is therefore a no-op here:
+unreferenced blobs are removed by `manage.py gc_blobs` after a grace period.
+
+The file fields in appcms/models.py take their storage from
+`upload_storage()`; set CMS_CONTENT_ADDRESSED_UPLOADS = False to go back to
+the default storage and the `upload_to` paths.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.utils import timezone
+
+from . import sqlite
+
+BLOB_PREFIX = 'blobs'
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def get_available_name(self, name, max_length=None):
+        # The name is chosen by _save() from the content, and collisions are the point
+        return name
+
+    def _save(self, name, content):
+        if hasattr(content, 'temporary_file_path'):
+            return self.commit(name, *self.adopt(content))
+        return self.commit(name, *self.spool(content))
+
+    def adopt(self, content):
+        """
+        (path, hex digest, size) of content already in a file of its own
+        (a large form upload, an assembled chunked upload), which commit()
+        then moves into place. The file is hashed unless `content.sha256`
+        says what it holds.
+        """
+        temp_path = content.temporary_file_path()
+        digest = getattr(content, 'sha256', None)
+        if digest is None:
+            hasher = hashlib.sha256()
+            with open(temp_path, 'rb') as source:
+                for chunk in iter(lambda: source.read(64 * 1024), b''):
+                    hasher.update(chunk)
+            digest = hasher.hexdigest()
+        os.chmod(temp_path, self.file_permissions_mode if self.file_permissions_mode is not None else 0o644)
+        return temp_path, digest, os.path.getsize(temp_path)
+
+    def spool(self, content):
+        """
+        Stream `content` to a temporary file, hashing it on the way: returns
+        (temp path, hex digest, size). File I/O only, so it may run on any thread.
+        """
+        temp_dir = self.path(f'{BLOB_PREFIX}/tmp')
+        os.makedirs(temp_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir)
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    digest.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+            os.chmod(temp_path, self.file_permissions_mode if self.file_permissions_mode is not None else 0o644)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return temp_path, digest.hexdigest(), size
+
+    def commit(self, name, temp_path, digest, size):
+        """
+        Move a spooled or adopted file into place and record its Blob; returns
+        the blob name. The move may be a full copy (an upload on another
+        filesystem), so it happens before the write transaction, which only
+        writes the row.
+        """
+        from .models import Blob
+
+        blob_name = self.blob_name(digest, name)
+        path = self.path(blob_name)
+        try:
+            # gc_blobs deletes an old row and then its file in one transaction. Touching the row
+            # first waits that out and keeps the row young, so a file found below stays put
+            Blob.objects.filter(name=blob_name).update(updated_at=timezone.now())
+            moved = False
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                file_move_safe(temp_path, path, allow_overwrite=True)
+                moved = True
+            try:
+                with sqlite.write_transaction():
+                    Blob.objects.update_or_create(name=blob_name, defaults={'size': size, 'updated_at': timezone.now()})
+            except BaseException:
+                # Nothing refers to a file we just put there unless another upload recorded it meanwhile
+                if moved and not Blob.objects.filter(name=blob_name).exists():
+                    os.remove(path)
+                raise
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return blob_name
+
+    @staticmethod
+    def blob_name(digest, name):
+        extension = os.path.splitext(name)[1].lower()
+        return f'{BLOB_PREFIX}/{digest[:2]}/{digest[2:4]}/{digest}{extension}'
+
+    def delete(self, name):
+        # Blobs are shared between rows; gc_blobs removes them once nothing refers to them
+        pass
+
+    def purge(self, name):
+        """ Really remove a blob's file """
+        super().delete(name)
+
+
+content_store = ContentAddressedStorage()
+
+
+def upload_storage():
+    """ Storage for the upload fields in appcms/models.py """
+    if getattr(settings, 'CMS_CONTENT_ADDRESSED_UPLOADS', True):
+        return content_store
+    return default_storage
+
+
+def is_blob(name):
+    return bool(name) and name.startswith(f'{BLOB_PREFIX}/')
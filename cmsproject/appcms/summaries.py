@@ -0,0 +1,197 @@
+"""
+Per-project dashboard totals.
+
+`ProjectSummary` holds, for each project, its task count, the quantity its
+tasks use per resource type, its media and document counts and how many
+distinct active workers are assigned to its tasks. The counts are adjusted
+by the model signals (see signals.py) in the same transaction as the write
+that changes them, with `UPDATE ... SET n = n + delta`, so reading them is
+one primary-key lookup however many tasks a project has.
+
+Distinct workers can't be counted by increments alone, so `ProjectWorker`
+keeps the number of the project's tasks each worker is assigned to: a
+worker counts once while that number is above zero, and only while its
+`is_working` is set.
+
+Writes that send no signals (bulk_create) call `tasks_changed()` themselves.
+`rebuild()` recomputes summaries from the tables (`manage.py
+rebuild_project_summaries`); a project that somehow has no summary row gets
+one, counted from the tables, the first time /projects/<pk>/summary/ asks.
+"""
+from collections import Counter, defaultdict, namedtuple
+
+from django.apps import apps as global_apps
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from . import metrics, sqlite
+
+# ProjectSummary column per Resource.resource_type
+USED_FIELDS = {
+    'material': 'material_used',
+    'equipment': 'equipment_used',
+    'labor': 'labor_used',
+}
+
+adjusted = metrics.counter('summaries.adjusted', 'Incremental project summary updates')
+rebuilt = metrics.counter('summaries.rebuilt', 'Project summaries recomputed from the tables')
+
+# What one task contributes to its project's summary
+TaskState = namedtuple('TaskState', 'project_id resource_id quantity_used worker_id')
+
+
+def task_state(task):
+    return TaskState(task.project_id, task.resource_id, task.quantity_used, task.worker_id)
+
+
+def _model(name):
+    return global_apps.get_model('appcms', name)
+
+
+# Incremental updates
+
+def tasks_changed(changes):
+    """ Apply task writes given as (old TaskState or None, new TaskState or None) pairs """
+    changes = [(old, new) for old, new in changes if old != new]
+    if not changes:
+        return
+    resource_ids = {state.resource_id for pair in changes for state in pair if state is not None}
+    types = dict(_model('Resource').objects.filter(pk__in=resource_ids).values_list('pk', 'resource_type'))
+
+    deltas = defaultdict(Counter)
+    assignments = Counter()
+    for old, new in changes:
+        for state, sign in ((old, -1), (new, +1)):
+            if state is None:
+                continue
+            deltas[state.project_id]['task_count'] += sign
+            field = USED_FIELDS.get(types.get(state.resource_id))
+            if field:
+                deltas[state.project_id][field] += sign * state.quantity_used
+            if state.worker_id is not None:
+                assignments[state.project_id, state.worker_id] += sign
+
+    for (project_id, worker_id), delta in assignments.items():
+        if delta:
+            deltas[project_id]['active_workers'] += _assign(project_id, worker_id, delta)
+    adjust(deltas)
+
+
+def _assign(project_id, worker_id, delta):
+    """ Add `delta` to a worker's task count on a project; returns the change in active workers (-1, 0 or 1) """
+    ProjectWorker = _model('ProjectWorker')
+    row = ProjectWorker.objects.select_for_update().filter(project_id=project_id, worker_id=worker_id).first()
+    before = row.task_count if row else 0
+    after = before + delta
+    if row is None and after <= 0:
+        # Already gone, with the project or worker it belonged to
+        return 0
+    if row is None:
+        ProjectWorker.objects.create(project_id=project_id, worker_id=worker_id, task_count=after)
+    elif after <= 0:
+        row.delete()
+    else:
+        ProjectWorker.objects.filter(pk=row.pk).update(task_count=after)
+
+    if (before > 0) == (after > 0):
+        return 0
+    if not _model('Worker').objects.filter(pk=worker_id, is_working=True).exists():
+        return 0
+    return 1 if after > 0 else -1
+
+
+def counted(model, old_project_id, new_project_id):
+    """ A media item or document moved from one project to another (None for created/deleted) """
+    if old_project_id == new_project_id:
+        return
+    field = {'Media': 'media_count', 'Document': 'document_count'}[model.__name__]
+    deltas = defaultdict(Counter)
+    if old_project_id is not None:
+        deltas[old_project_id][field] -= 1
+    if new_project_id is not None:
+        deltas[new_project_id][field] += 1
+    adjust(deltas)
+
+
+def worker_activity_changed(worker_id, is_working):
+    """ A worker started or stopped working: count it in or out of every project it is assigned to """
+    ProjectSummary, ProjectWorker = _model('ProjectSummary'), _model('ProjectWorker')
+    sign = 1 if is_working else -1
+    ProjectSummary.objects.filter(
+        project_id__in=ProjectWorker.objects.filter(worker_id=worker_id, task_count__gt=0).values('project_id')
+    ).update(active_workers=F('active_workers') + sign, updated_at=timezone.now())
+
+
+def adjust(deltas):
+    """
+    Add {project_id: {field: delta}} to the summaries. A missing summary is
+    left missing: the project is being deleted, or its summary will be
+    counted from scratch when it is first read.
+    """
+    ProjectSummary = _model('ProjectSummary')
+    for project_id, fields in sorted(deltas.items()):
+        fields = {field: F(field) + delta for field, delta in fields.items() if delta}
+        if fields:
+            adjusted.inc()
+            ProjectSummary.objects.filter(project_id=project_id).update(updated_at=timezone.now(), **fields)
+
+
+# Rebuilding
+
+def rebuild(project_ids=None, apps=global_apps):
+    """
+    Recompute the summaries (and worker assignments) of `project_ids`, or of
+    every project, from the task, media, document and worker tables. Returns
+    the number of summaries written. `apps` lets migrations pass their
+    historical models.
+    """
+    Project = apps.get_model('appcms', 'Project')
+    Task = apps.get_model('appcms', 'Task')
+    Media = apps.get_model('appcms', 'Media')
+    Document = apps.get_model('appcms', 'Document')
+    Worker = apps.get_model('appcms', 'Worker')
+    ProjectSummary = apps.get_model('appcms', 'ProjectSummary')
+    ProjectWorker = apps.get_model('appcms', 'ProjectWorker')
+
+    # Counted and replaced in one write transaction, so an adjustment committed
+    # after the counts were read can't be overwritten by them
+    with sqlite.write_transaction():
+        projects = Project.objects.all()
+        if project_ids is not None:
+            projects = projects.filter(pk__in=list(project_ids))
+        project_ids = list(projects.values_list('pk', flat=True))
+        if not project_ids:
+            return 0
+
+        summaries = {pk: ProjectSummary(project_id=pk) for pk in project_ids}
+        tasks = Task.objects.filter(project_id__in=project_ids).order_by()
+        for row in tasks.values('project_id', 'resource__resource_type').annotate(count=Count('pk'), used=Sum('quantity_used')):
+            summary = summaries[row['project_id']]
+            summary.task_count += row['count']
+            field = USED_FIELDS.get(row['resource__resource_type'])
+            if field:
+                setattr(summary, field, getattr(summary, field) + (row['used'] or 0))
+        for model, field in ((Media, 'media_count'), (Document, 'document_count')):
+            counts = model.objects.filter(project_id__in=project_ids).order_by().values('project_id').annotate(count=Count('pk'))
+            for row in counts:
+                setattr(summaries[row['project_id']], field, row['count'])
+
+        assignments = list(
+            tasks.filter(worker__isnull=False).values('project_id', 'worker_id').annotate(count=Count('pk'))
+        )
+        working = set(
+            Worker.objects.filter(pk__in={row['worker_id'] for row in assignments}, is_working=True).values_list('pk', flat=True)
+        )
+        for row in assignments:
+            if row['worker_id'] in working:
+                summaries[row['project_id']].active_workers += 1
+
+        ProjectWorker.objects.filter(project_id__in=project_ids).delete()
+        ProjectWorker.objects.bulk_create([
+            ProjectWorker(project_id=row['project_id'], worker_id=row['worker_id'], task_count=row['count'])
+            for row in assignments
+        ], batch_size=1000)
+        ProjectSummary.objects.filter(project_id__in=project_ids).delete()
+        ProjectSummary.objects.bulk_create(summaries.values(), batch_size=1000)
+    rebuilt.inc(len(summaries))
+    return len(summaries)
@@ -0,0 +1,145 @@
+"""
+Delta-sync feed for offline devices.
+
+Every write to a synced model appends a `ChangeLog` row (see signals.py), and
+the log's primary key is a global change sequence. A client keeps the highest
+sequence it has seen as its watermark and asks for everything after it, so a
+sync reads the log by primary-key range and then loads only the rows that
+changed: its cost follows the number of changes, not the size of the tables.
+
+Several changes to one row collapse into its latest state; deletions are
+returned as tombstones (bare ids). Managers see every user; anyone else sees
+only their own.
+
+The log is pruned after CMS_SYNC_RETENTION_DAYS (see the prune_changelog
+command). A watermark from before the oldest retained change can't be caught
+up, so the client has to resync: reload everything, then continue from the
+watermark it was given.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+
+from . import sqlite
+from .models import ChangeLog, Resource, User
+from .serializers import (
+    DocumentSerializer, ManagerSerializer, MediaSerializer, ProjectSerializer, ResourceSerializer,
+    SupervisorSerializer, TaskSerializer, UserSerializer, WorkerSerializer,
+)
+
+DEFAULT_LIMIT = 1000
+MAX_LIMIT = 5000
+PRUNE_BATCH = 5000
+
+# Feed key and serializer per synced model; resources are loaded with their live balance
+FEEDS = {
+    'users': UserSerializer,
+    'managers': ManagerSerializer,
+    'supervisors': SupervisorSerializer,
+    'projects': ProjectSerializer,
+    'resources': ResourceSerializer,
+    'workers': WorkerSerializer,
+    'tasks': TaskSerializer,
+    'documents': DocumentSerializer,
+    'media': MediaSerializer,
+}
+_FEED_BY_LABEL = {serializer.Meta.model._meta.label_lower: name for name, serializer in FEEDS.items()}
+
+
+def _queryset(model):
+    if model is Resource:
+        return Resource.objects.with_balance()
+    return model._default_manager.all()
+
+
+class ResyncRequired(Exception):
+    """ The watermark is older than the retained log; carries the watermark to resync from """
+
+    def __init__(self, watermark):
+        super().__init__(f"Changes before #{watermark} have been pruned.")
+        self.watermark = watermark
+
+
+def _settled():
+    log = ChangeLog.objects.all()
+    settle = timedelta(seconds=getattr(settings, 'CMS_SYNC_SETTLE_SECONDS', 2))
+    if settle:
+        log = log.filter(created_at__lte=timezone.now() - settle)
+    return log
+
+
+def _hidden(principal):
+    """ Log rows the caller may not see: other users' accounts, unless they are a manager """
+    if principal is not None and principal.role == 'manager':
+        return Q(pk__in=[])
+    user_id = principal.user_id if principal is not None else None
+    return Q(model=User._meta.label_lower) & ~Q(object_id=user_id)
+
+
+def changes_since(since, limit=DEFAULT_LIMIT, context=None, principal=None):
+    """
+    Changes with a sequence above `since`, at most `limit` log rows, that
+    `principal` may see.
+
+    Returns {"watermark", "has_more", "changes"} where `changes` maps each feed
+    that changed to {"upserted": [...], "deleted": [ids]}. Changes newer than
+    the settle window are held back for the next sync. Raises ResyncRequired
+    if changes after `since` have been pruned.
+    """
+    oldest = ChangeLog.objects.aggregate(oldest=Min('id'))['oldest']
+    if oldest is not None and since < oldest - 1:
+        raise ResyncRequired(_settled().aggregate(last=Max('id'))['last'] or oldest - 1)
+
+    log = _settled().filter(id__gt=since, model__in=_FEED_BY_LABEL).exclude(_hidden(principal))
+
+    rows = list(log.order_by('id').values_list('id', 'model', 'object_id', 'op')[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # The latest operation per object wins
+    latest = {}
+    for _, label, object_id, op in rows:
+        latest[(label, object_id)] = op
+
+    changes = {}
+    for (label, object_id), op in latest.items():
+        feed = changes.setdefault(_FEED_BY_LABEL[label], {'upserted': [], 'deleted': []})
+        feed['upserted' if op == ChangeLog.UPSERT else 'deleted'].append(object_id)
+
+    for name, feed in changes.items():
+        serializer_class = FEEDS[name]
+        ids = feed['upserted']
+        # A row missing here was deleted after this batch; its tombstone comes in a later one
+        objects = _queryset(serializer_class.Meta.model).filter(pk__in=ids).order_by('pk') if ids else []
+        feed['upserted'] = serializer_class(objects, many=True, context=context or {}).data
+        feed['deleted'].sort()
+
+    return {
+        'watermark': rows[-1][0] if rows else since,
+        'has_more': has_more,
+        'changes': changes,
+    }
+
+
+def prune(retention=None):
+    """
+    Delete log rows older than `retention` (CMS_SYNC_RETENTION_DAYS by default),
+    in batches, always keeping the newest row so the retained window has a
+    known start. Returns the number of rows deleted.
+    """
+    if retention is None:
+        retention = timedelta(days=getattr(settings, 'CMS_SYNC_RETENTION_DAYS', 30))
+    newest = ChangeLog.objects.aggregate(newest=Max('id'))['newest']
+    if newest is None:
+        return 0
+    expired = ChangeLog.objects.filter(id__lt=newest, created_at__lt=timezone.now() - retention)
+
+    deleted = 0
+    while True:
+        ids = list(expired.order_by('id').values_list('id', flat=True)[:PRUNE_BATCH])
+        if not ids:
+            return deleted
+        with sqlite.write_transaction():
+            deleted += ChangeLog.objects.filter(pk__in=ids).delete()[0]
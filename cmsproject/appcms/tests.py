@@ -1,3 +1,2265 @@
-from django.test import TestCase
+import base64
+import contextlib
+import datetime
+import hashlib
+import io
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import Group
+from django.core.management import call_command
+from django.db import DatabaseError, OperationalError, connection, transaction
+from django.http import HttpResponse
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import numpy as np
+from PIL import Image
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.response import Response
+from rest_framework.test import APIClient
+
+from . import authentication, availability, cache, derivatives, files, forecast, inventory, metrics, onboarding, pagination, routers, search, sqlite, storage, summaries, sync, uploads, worker_import
+from .permissions import IsManager, IsManagerOrSupervisor, IsSupervisor
+from .cache import object_cache
+from .models import Blob, ChangeLog, Document, Manager, Media, MediaUpload, MediaUploadChunk, Project, ProjectSummary, Resource, ResourceMovement, ResourceSnapshot, Supervisor, Task, User, Worker, WorkerAvailability
 
 # Create your tests here.
+
+
+def seed_rows(count, prefix):
+    """ Create `count` rows of every API model, each with its own related rows """
+    for i in range(count):
+        tag = f"{prefix}{i}"
+        supervisor = Supervisor.objects.create(user=User.objects.create_user(f"sup-{tag}", password='x', role='supervisor'))
+        manager = Manager.objects.create(
+            user=User.objects.create_user(f"man-{tag}", password='x', role='manager'),
+            department='Civil', phone_number='9999999999',
+        )
+        project = Project.objects.create(
+            name=f"Project {tag}", location='Site', budget=1000, timeline=datetime.date(2025, 1, 1), supervisor=supervisor,
+        )
+        resource = Resource.objects.create(name=f"Cement {tag}", quantity=100)
+        worker = Worker.objects.create(name=f"Worker {tag}", aadhar_number=f"{abs(hash(tag)) % 10**12:012d}")
+        Task.objects.create(
+            name=f"Task {tag}", resource=resource, quantity_used=1, worker=worker, project=project, supervisor=supervisor,
+            start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 5), description='Pour footing',
+        )
+        Document.objects.create(project=project, title=f"Blueprint {tag}", document_type='blueprint', file=f"documents/{tag}.pdf")
+        Media.objects.create(project=project, supervisor=supervisor, manager=manager, image=f"media/images/{tag}.jpg", description='Footing')
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class AuthenticatedAPITestCase(TestCase):
+    """ Requests go through an APIClient signed in as a freshly created user """
+
+    username = 'viewer'
+    role = 'manager'
+
+    def setUp(self):
+        self.user = User.objects.create_user(self.username, password='x', role=self.role)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+
+class QueryCountRegressionTests(AuthenticatedAPITestCase):
+    """ Every endpoint must run a fixed number of queries however many rows it returns """
+
+    N = 3
+    endpoints = [
+        '/projects/',
+        '/tasks/',
+        '/resources/',
+        '/workers/',
+        '/documents/',
+        '/media/',
+    ]
+
+    def count_queries(self, url, params=None):
+        # API pages big enough to hold every seeded row
+        params = dict(params or {})
+        if not url.startswith('/admin/'):
+            params.setdefault('page_size', 500)
+        # Measure the database plan, not the object cache
+        object_cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return len(queries)
+
+    def assert_constant(self, urls, params=None):
+        self.seeded = getattr(self, 'seeded', 0) + 1
+        seed_rows(self.N, f"{self.seeded}a")
+        small = {url: self.count_queries(url, params) for url in urls}
+        seed_rows(self.N * 9, f"{self.seeded}b")
+        for url in urls:
+            with self.subTest(url=url, params=params):
+                self.assertEqual(self.count_queries(url, params), small[url])
+
+    def test_list_query_count_does_not_grow_with_rows(self):
+        self.assert_constant(self.endpoints)
+
+    def test_list_query_count_with_total_does_not_grow_with_rows(self):
+        self.assert_constant(self.endpoints, {'count': 'exact'})
+
+    def test_sparse_and_expanded_query_count_does_not_grow_with_rows(self):
+        expanded = {
+            '/projects/': 'supervisor',
+            '/tasks/': 'resource,worker,project,supervisor',
+            '/documents/': 'project',
+            '/media/': 'project,supervisor,manager',
+        }
+        for url, expand in expanded.items():
+            self.assert_constant([url], {'expand': expand})
+        self.assert_constant(self.endpoints, {'fields': 'id,name'})
+
+    def test_browsable_api_query_count_does_not_grow_with_rows(self):
+        # The HTML forms list every related object through its __str__
+        self.assert_constant(self.endpoints, {'format': 'api'})
+
+    def test_admin_changelist_query_count_does_not_grow_with_rows(self):
+        self.client.force_login(User.objects.create_superuser('admin', password='x', role='manager'))
+        self.assert_constant(['/admin/appcms/media/', '/admin/appcms/supervisor/', '/admin/appcms/manager/'])
+
+    def test_detail_query_count_does_not_grow_with_rows(self):
+        seed_rows(self.N, 'a')
+        urls = [f"{url}{model.objects.order_by('id').values_list('id', flat=True).first()}/" for url, model in [
+            ('/projects/', Project), ('/tasks/', Task), ('/resources/', Resource), ('/workers/', Worker),
+        ]]
+        small = {url: self.count_queries(url) for url in urls}
+        seed_rows(self.N * 9, 'b')
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertEqual(self.count_queries(url), small[url])
+
+
+class ConditionalGetTests(AuthenticatedAPITestCase):
+    """ Unchanged lists and objects are answered with a 304 from the validators alone """
+
+    def setUp(self):
+        super().setUp()
+        seed_rows(2, 'c')
+        object_cache.clear()
+
+    def revalidate(self, url, etag, **params):
+        return self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_list_is_not_modified(self):
+        for url in QueryCountRegressionTests.endpoints:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                with CaptureQueriesContext(connection) as queries:
+                    revalidated = self.revalidate(url, response['ETag'])
+                self.assertEqual(revalidated.status_code, 304)
+                # Only the validator aggregates run; the page itself is never loaded
+                self.assertLessEqual(len(queries), 2)
+
+    def test_etag_varies_with_query(self):
+        etag = self.client.get('/tasks/')['ETag']
+        self.assertEqual(self.revalidate('/tasks/', etag, fields='id').status_code, 200)
+        self.assertEqual(self.revalidate('/tasks/', etag, expand='resource').status_code, 200)
+
+    def test_writes_change_the_list_etag(self):
+        etag = self.client.get('/workers/')['ETag']
+        Worker.objects.order_by('id').first().delete()
+        self.assertEqual(self.revalidate('/workers/', etag).status_code, 200)
+
+        etag = self.client.get('/projects/')['ETag']
+        project = Project.objects.order_by('id').first()
+        project.name = 'Renamed'
+        project.save()
+        self.assertEqual(self.revalidate('/projects/', etag).status_code, 200)
+
+    def test_set_null_changes_the_validators(self):
+        task = Task.objects.order_by('id').first()
+        list_etag = self.client.get('/tasks/')['ETag']
+        detail_etag = self.client.get(f'/tasks/{task.id}/')['ETag']
+        task.worker.delete()
+        self.assertEqual(self.revalidate('/tasks/', list_etag).status_code, 200)
+        self.assertEqual(self.revalidate(f'/tasks/{task.id}/', detail_etag).status_code, 200)
+
+        project = Project.objects.order_by('id').first()
+        list_etag = self.client.get('/projects/')['ETag']
+        project.supervisor.delete()
+        response = self.revalidate('/projects/', list_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(next(row for row in response.data['results'] if row['id'] == project.id)['supervisor'])
+
+    def test_stock_movements_change_resource_validators(self):
+        resource = Resource.objects.order_by('id').first()
+        list_etag = self.client.get('/resources/')['ETag']
+        detail_etag = self.client.get(f'/resources/{resource.id}/')['ETag']
+        expanded_etag = self.client.get('/tasks/', {'expand': 'resource'})['ETag']
+
+        resource.reduce_quantity(5)
+
+        self.assertEqual(self.revalidate('/resources/', list_etag).status_code, 200)
+        self.assertEqual(self.revalidate(f'/resources/{resource.id}/', detail_etag).status_code, 200)
+        self.assertEqual(self.revalidate('/tasks/', expanded_etag, expand='resource').status_code, 200)
+
+    def test_detail_if_modified_since(self):
+        task = Task.objects.order_by('id').first()
+        last_modified = self.client.get(f'/tasks/{task.id}/')['Last-Modified']
+
+        response = self.client.get(f'/tasks/{task.id}/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        Task.objects.filter(pk=task.pk).update(updated_at=task.updated_at + datetime.timedelta(minutes=1))
+        response = self.client.get(f'/tasks/{task.id}/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+
+    def test_missing_object_is_still_not_found(self):
+        self.assertEqual(self.client.get('/workers/999999/', HTTP_IF_NONE_MATCH='*').status_code, 404)
+
+
+@override_settings(CMS_SYNC_SETTLE_SECONDS=0)
+class SyncFeedTests(AuthenticatedAPITestCase):
+    """ /sync/ returns what changed after a watermark, with tombstones for deletions """
+
+    def setUp(self):
+        super().setUp()
+        seed_rows(2, 's')
+
+    def sync(self, since, **params):
+        response = self.client.get('/sync/', {'since': since, **params})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.data
+
+    def ids(self, data, feed, kind='upserted'):
+        feed = data['changes'].get(feed, {'upserted': [], 'deleted': []})[kind]
+        return [row['id'] for row in feed] if kind == 'upserted' else feed
+
+    def test_full_sync_then_nothing_new(self):
+        data = self.sync(0)
+        self.assertEqual(sorted(self.ids(data, 'tasks')), sorted(Task.objects.values_list('id', flat=True)))
+        self.assertEqual(len(self.ids(data, 'media')), 2)
+        self.assertNotIn('password', data['changes']['users']['upserted'][0])
+        self.assertEqual(self.sync(data['watermark']), {'watermark': data['watermark'], 'has_more': False, 'changes': {}})
+
+    def test_updates_and_tombstones(self):
+        watermark = self.sync(0)['watermark']
+        project = Project.objects.order_by('id').first()
+        project.name = 'Renamed'
+        project.save()
+        worker = Worker.objects.order_by('id').first()
+        worker_id, orphaned = worker.id, Task.objects.get(worker=worker)
+        worker.delete()
+
+        data = self.sync(watermark)
+        self.assertEqual([row['name'] for row in data['changes']['projects']['upserted']], ['Renamed'])
+        self.assertEqual(self.ids(data, 'workers', 'deleted'), [worker_id])
+        # SET_NULL rewrites the worker's tasks without a save() of their own
+        self.assertEqual([(row['id'], row['worker']) for row in data['changes']['tasks']['upserted']], [(orphaned.id, None)])
+
+        # A row deleted after being updated comes back only as a tombstone
+        watermark = data['watermark']
+        project.name = 'Again'
+        project.save()
+        project_id = project.id
+        project.delete()
+        data = self.sync(watermark)
+        self.assertEqual(self.ids(data, 'projects'), [])
+        self.assertEqual(self.ids(data, 'projects', 'deleted'), [project_id])
+
+    def test_stock_changes_and_bulk_tasks_are_logged(self):
+        watermark = self.sync(0)['watermark']
+        task = Task.objects.order_by('id').first()
+        response = self.client.post('/tasks/bulk/', [{
+            'name': 'Bulk', 'resource': task.resource_id, 'quantity_used': 2, 'project': task.project_id,
+            'supervisor': task.supervisor_id, 'start_date': '2025-01-01', 'end_date': '2025-01-02', 'description': 'd',
+        }], format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+
+        data = self.sync(watermark)
+        self.assertEqual(self.ids(data, 'tasks'), [response.data['results'][0]['id']])
+        self.assertEqual(data['changes']['resources']['upserted'][0]['quantity'], Resource.objects.get(pk=task.resource_id).balance)
+
+    def test_paging_with_limit(self):
+        total = ChangeLog.objects.count()
+        seen, watermark, has_more = 0, 0, True
+        while has_more:
+            data = self.sync(watermark, limit=5)
+            seen += sum(len(feed['upserted']) + len(feed['deleted']) for feed in data['changes'].values())
+            watermark, has_more = data['watermark'], data['has_more']
+        self.assertEqual(watermark, ChangeLog.objects.order_by('-id').first().id)
+        self.assertLessEqual(seen, total)
+
+    def test_query_count_follows_changes_not_tables(self):
+        def queries_for_one_change():
+            watermark = ChangeLog.objects.order_by('-id').first().id
+            Worker.objects.create(name='New', aadhar_number=f"{ChangeLog.objects.count():012d}")
+            with CaptureQueriesContext(connection) as queries:
+                self.sync(watermark)
+            return len(queries)
+
+        self.sync(0)  # Resolves the caller's principal, which stays cached on the user
+        small = queries_for_one_change()
+        seed_rows(20, 't')
+        self.assertEqual(queries_for_one_change(), small)
+
+    @override_settings(CMS_SYNC_SETTLE_SECONDS=60)
+    def test_recent_changes_wait_for_the_settle_window(self):
+        ChangeLog.objects.update(created_at=timezone.now() - datetime.timedelta(minutes=5))
+        watermark = self.sync(0)['watermark']
+        Worker.objects.create(name='Fresh', aadhar_number='123412341234')
+        self.assertEqual(self.sync(watermark)['changes'], {})
+
+    def test_invalid_watermark(self):
+        self.assertEqual(self.client.get('/sync/', {'since': 'yesterday'}).status_code, 400)
+
+    def test_users_are_scoped_to_the_caller(self):
+        everyone = set(User.objects.values_list('id', flat=True))
+        self.assertEqual(set(self.ids(self.sync(0), 'users')), everyone)
+
+        supervisor = User.objects.filter(role='supervisor').order_by('id').first()
+        self.client.force_authenticate(supervisor)
+        data = self.sync(0)
+        self.assertEqual(self.ids(data, 'users'), [supervisor.id])
+        User.objects.filter(role='manager').order_by('id').first().delete()
+        self.assertEqual(self.sync(data['watermark'])['changes'].get('users'), None)
+
+    def test_prune_and_resync(self):
+        watermark = self.sync(0)['watermark']
+        expired = ChangeLog.objects.count()
+        ChangeLog.objects.update(created_at=timezone.now() - datetime.timedelta(days=40))
+        Worker.objects.create(name='Kept', aadhar_number='432143214321')
+        ChangeLog.objects.filter(id__gt=watermark).update(created_at=timezone.now() - datetime.timedelta(minutes=5))
+
+        out = io.StringIO()
+        call_command('prune_changelog', days=30, stdout=out)
+        self.assertEqual(out.getvalue().strip(), f"Pruned {expired} change(s).")
+        self.assertEqual(ChangeLog.objects.count(), 1)
+
+        # Caught-up devices carry on; anyone further behind is told to resync
+        self.assertEqual(self.ids(self.sync(watermark), 'workers'), [Worker.objects.get(name='Kept').id])
+        response = self.client.get('/sync/', {'since': 0})
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual((response.data['resync'], response.data['watermark']), (True, watermark + 1))
+
+        # The newest row is kept even once it expires, so the window still has a start
+        ChangeLog.objects.update(created_at=timezone.now() - datetime.timedelta(days=40))
+        self.assertEqual(sync.prune(), 0)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class InventoryTests(TestCase):
+    """ Stock moves through guarded ledger inserts and never goes below zero """
+
+    def setUp(self):
+        seed_rows(1, 'i')
+        self.task = Task.objects.get()
+        self.resource = Resource.objects.create(name='Sand', quantity=10)
+
+    def test_guarded_reduce_and_restore(self):
+        self.assertEqual(inventory.reduce(self.resource.pk, 4), 6)
+        self.assertEqual(inventory.restore(self.resource.pk, 2), 8)
+        self.assertEqual(inventory.reduce(self.resource.pk, 8), 0)
+        self.assertEqual(
+            list(ResourceMovement.objects.filter(resource=self.resource).order_by('pk').values_list('delta', 'reason')),
+            [(-4, 'reduce'), (2, 'restore'), (-8, 'reduce')],
+        )
+        with self.assertRaises(ValueError):
+            inventory.reduce(self.resource.pk, 0)
+        with self.assertRaises(Resource.DoesNotExist):
+            inventory.reduce(self.resource.pk + 100, 1)
+
+    def test_insufficient_quantity_and_counters(self):
+        rejected, contended = inventory.rejected.value, inventory.contended.value
+        with self.assertRaises(inventory.InsufficientQuantity) as raised:
+            inventory.reduce(self.resource.pk, 11)
+        self.assertEqual((raised.exception.available, raised.exception.requested), (10, 11))
+        self.assertEqual((inventory.rejected.value - rejected, inventory.contended.value - contended), (1, 0))
+
+        # The caller saw enough stock, so losing it is contention
+        with self.assertRaises(inventory.InsufficientQuantity):
+            inventory.reduce(self.resource.pk, 11, expected=12)
+        self.assertEqual((inventory.rejected.value - rejected, inventory.contended.value - contended), (2, 1))
+        self.assertEqual(inventory.balance(self.resource.pk), 10)
+        self.assertFalse(ResourceMovement.objects.filter(resource=self.resource).exists())
+
+    def test_movement_lists_apply_together(self):
+        with self.assertRaises(inventory.InsufficientQuantity):
+            inventory.record(self.resource.pk, [(5, 'restore', None), (-20, 'reduce', None)])
+        self.assertEqual(inventory.record(self.resource.pk, [(5, 'restore', None), (-15, 'reduce', None)]), 0)
+
+    def test_task_saves_read_the_stock_they_hold(self):
+        resource_id = self.task.resource_id
+        start = inventory.balance(resource_id)
+        first, second = Task.objects.get(pk=self.task.pk), Task.objects.get(pk=self.task.pk)
+        first.quantity_used = 20
+        first.save()
+        # Loaded before the first save: it must give back 20, not the 1 it was loaded with
+        second.quantity_used = 30
+        second.save()
+        self.assertEqual(inventory.balance(resource_id), start + 1 - 30)
+        second.delete()
+        self.assertEqual(inventory.balance(resource_id), start + 1)
+
+
+class TaskBulkTests(AuthenticatedAPITestCase):
+    """ /tasks/bulk/ validates every item, then takes each resource's stock in one guarded write """
+
+    role = 'supervisor'
+
+    def setUp(self):
+        super().setUp()
+        seed_rows(1, 'b')
+        self.task = Task.objects.get()
+        self.sand = Resource.objects.create(name='Sand', quantity=10)
+        self.lime = Resource.objects.create(name='Lime', quantity=10)
+
+    def item(self, resource, quantity, **overrides):
+        return {
+            'name': 'Plaster', 'resource': resource.pk, 'quantity_used': quantity, 'worker': self.task.worker_id,
+            'project': self.task.project_id, 'supervisor': self.task.supervisor_id,
+            'start_date': '2025-02-01', 'end_date': '2025-02-03', 'description': '-', **overrides,
+        }
+
+    def post(self, items, mode=None):
+        body = items if mode is None else {'mode': mode, 'tasks': items}
+        return self.client.post('/tasks/bulk/', body, format='json')
+
+    def statuses(self, response):
+        return [result['status'] for result in response.data['results']]
+
+    def test_atomic_batch_rolls_back_on_one_failure(self):
+        tasks = Task.objects.count()
+        response = self.post([self.item(self.sand, 4), self.item(self.lime, 4), self.item(self.sand, 7)])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.statuses(response), ['skipped', 'skipped', 'error'])
+        self.assertIn('quantity_used', response.data['results'][2]['errors'])
+        self.assertEqual((response.data['created'], response.data['failed']), (0, 1))
+        self.assertEqual(Task.objects.count(), tasks)
+        self.assertEqual((inventory.balance(self.sand.pk), inventory.balance(self.lime.pk)), (10, 10))
+        self.assertFalse(ResourceMovement.objects.filter(resource__in=[self.sand, self.lime]).exists())
+
+        # An invalid item stops the batch before any stock is looked at
+        response = self.post([self.item(self.sand, 1), self.item(self.sand, 1, name='')])
+        self.assertEqual(self.statuses(response), ['skipped', 'error'])
+        self.assertIn('name', response.data['results'][1]['errors'])
+        self.assertEqual(Task.objects.count(), tasks)
+
+    def test_partial_mode_creates_what_fits(self):
+        response = self.post(
+            [self.item(self.sand, 4), self.item(self.sand, 7), self.item(self.lime, 3, end_date='x'), self.item(self.sand, 6)],
+            mode='partial',
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.statuses(response), ['created', 'error', 'error', 'created'])
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 2))
+        created = [result['id'] for result in response.data['results'] if result['status'] == 'created']
+        self.assertEqual(sorted(Task.objects.filter(pk__in=created).values_list('quantity_used', flat=True)), [4, 6])
+        self.assertEqual((inventory.balance(self.sand.pk), inventory.balance(self.lime.pk)), (0, 10))
+
+        # Nothing fits: nothing is created
+        response = self.post([self.item(self.sand, 1)], mode='partial')
+        self.assertEqual((response.status_code, self.statuses(response)), (400, ['error']))
+
+    def test_stock_is_taken_once_per_resource(self):
+        items = [self.item(self.sand, 1), self.item(self.lime, 2), self.item(self.sand, 3), self.item(self.sand, 4)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post(items)
+        self.assertEqual(response.status_code, 201, response.data)
+        guarded = [query for query in queries if query['sql'].startswith('INSERT') and 'SUM(m.delta)' in query['sql']]
+        self.assertEqual(len(guarded), 2)
+        self.assertEqual((inventory.balance(self.sand.pk), inventory.balance(self.lime.pk)), (2, 8))
+        # Still one movement per task, pointing at it
+        ids = [result['id'] for result in response.data['results']]
+        self.assertEqual(
+            dict(ResourceMovement.objects.filter(task_id__in=ids).values_list('task_id', 'delta')),
+            {task_id: -item['quantity_used'] for task_id, item in zip(ids, items)},
+        )
+
+    def test_bad_requests(self):
+        self.assertEqual(self.post([]).status_code, 400)
+        self.assertEqual(self.post([self.item(self.sand, 1)], mode='eventually').status_code, 400)
+        self.assertEqual(self.client.post('/tasks/bulk/', {'tasks': 'none'}, format='json').status_code, 400)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class LedgerHistoryTests(TestCase):
+    """ Compaction folds old movements into snapshots; past balances read through them """
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.resource = Resource.objects.create(name='Gravel', quantity=10)
+        ResourceSnapshot.objects.filter(resource=self.resource).update(as_of=self.now - datetime.timedelta(hours=1))
+        self.movements = [
+            self.move(-3, minutes=30),
+            self.move(-2, minutes=20),
+            self.move(1, minutes=0),
+        ]
+
+    def move(self, delta, minutes):
+        inventory.adjust(self.resource.pk, delta)
+        movement = ResourceMovement.objects.filter(resource=self.resource).latest('pk')
+        ResourceMovement.objects.filter(pk=movement.pk).update(created_at=self.now - datetime.timedelta(minutes=minutes))
+        return movement.pk
+
+    def test_compact_folds_up_to_the_horizon(self):
+        self.assertEqual(inventory.compact(horizon=datetime.timedelta(minutes=10)), 1)
+        self.resource.refresh_from_db()
+        self.assertEqual((self.resource.quantity, self.resource.snapshot_through), (5, self.movements[1]))
+        snapshot = ResourceSnapshot.objects.filter(resource=self.resource).latest('pk')
+        self.assertEqual((snapshot.quantity, snapshot.movement_id), (5, self.movements[1]))
+        self.assertEqual(snapshot.as_of, self.now - datetime.timedelta(minutes=20))
+        self.assertEqual(inventory.balance(self.resource.pk), 6)
+
+        # Nothing else is old enough yet
+        self.assertEqual(inventory.compact(horizon=datetime.timedelta(minutes=10)), 0)
+        self.assertEqual(inventory.compact(horizon=datetime.timedelta(0)), 1)
+        self.resource.refresh_from_db()
+        self.assertEqual((self.resource.quantity, self.resource.snapshot_through), (6, self.movements[2]))
+        self.assertEqual(inventory.balance(self.resource.pk), 6)
+
+    def test_racing_compactors_fold_once(self):
+        # Both read the same snapshot_through before either wrote
+        cutoff = self.now + datetime.timedelta(minutes=1)
+        self.assertTrue(inventory._compact_one(self.resource.pk, 0, cutoff))
+        self.assertFalse(inventory._compact_one(self.resource.pk, 0, cutoff))
+        self.resource.refresh_from_db()
+        self.assertEqual(self.resource.quantity, 6)
+        self.assertEqual(ResourceSnapshot.objects.filter(resource=self.resource).count(), 2)
+        self.assertEqual(inventory.balance(self.resource.pk), 6)
+
+    def test_balance_at_before_and_after_a_snapshot(self):
+        at = lambda minutes: inventory.balance_at(self.resource.pk, self.now - datetime.timedelta(minutes=minutes))
+        self.assertIsNone(at(120))
+        self.assertEqual([at(40), at(25), at(15), at(0)], [10, 7, 5, 6])
+
+        inventory.compact(horizon=datetime.timedelta(minutes=10))
+        # The same answers from either side of the new snapshot
+        self.assertIsNone(at(120))
+        self.assertEqual([at(40), at(25), at(15), at(0)], [10, 7, 5, 6])
+        with self.assertRaises(Resource.DoesNotExist):
+            inventory.balance_at(self.resource.pk + 100, self.now)
+
+    def test_balance_endpoint(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('ledger', password='x', role='manager'))
+        url = f'/resources/{self.resource.pk}/balance/'
+        self.assertEqual(client.get(url).data['quantity'], 6)
+        at = (self.now - datetime.timedelta(minutes=25)).isoformat()
+        self.assertEqual(client.get(url, {'at': at}).data['quantity'], 7)
+        self.assertEqual(client.get(url, {'at': 'yesterday'}).status_code, 400)
+        early = client.get(url, {'at': (self.now - datetime.timedelta(hours=2)).isoformat()})
+        self.assertEqual(early.status_code, 404)
+        self.assertIn('error', early.data)
+        self.assertEqual(client.get(f'/resources/{self.resource.pk + 100}/balance/', {'at': at}).status_code, 404)
+
+
+class ConcurrentReductionTests(TransactionTestCase):
+    """ Reductions racing from several threads never overdraw a resource """
+
+    @override_settings(CMS_SQLITE_LOCK_RETRIES=50, CMS_SQLITE_LOCK_BACKOFF=0.001)
+    def test_concurrent_reductions_never_go_negative(self):
+        resource = Resource.objects.create(name='Rebar', quantity=25)
+
+        def take(_):
+            try:
+                taken = 0
+                for _ in range(10):
+                    try:
+                        inventory.reduce(resource.pk, 1)
+                        taken += 1
+                    except inventory.InsufficientQuantity:
+                        pass
+                return taken
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            taken = sum(pool.map(take, range(6)))
+        self.assertEqual(taken, 25)
+        self.assertEqual(inventory.balance(resource.pk), 0)
+        self.assertEqual(ResourceMovement.objects.filter(resource=resource).count(), 25)
+
+
+class ChunkedUploadTests(AuthenticatedAPITestCase):
+    """ Resumable uploads: chunks in any order, checksummed, assembled on finalize """
+
+    role = 'supervisor'
+
+    CHUNK = 64 * 1024
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=self.media_root, CMS_UPLOAD_TEMP_DIR=os.path.join(self.media_root, 'tmp'))
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        super().setUp()
+        seed_rows(1, 'u')
+        self.media = Media.objects.get()
+        self.video = os.urandom(self.CHUNK * 2 + 1000)
+
+    def start(self, **overrides):
+        data = {
+            'filename': 'pour.mp4', 'size': len(self.video), 'chunk_size': self.CHUNK,
+            'project': self.media.project_id, 'supervisor': self.media.supervisor_id, 'manager': self.media.manager_id,
+            'sha256': hashlib.sha256(self.video).hexdigest(), **overrides,
+        }
+        response = self.client.post('/media/uploads/', data, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return response.data
+
+    def put_chunk(self, upload_id, offset, body=None, digest=None):
+        body = self.video[offset:offset + self.CHUNK] if body is None else body
+        return self.client.generic(
+            'PUT', f'/media/uploads/{upload_id}/chunks/{offset}/', body, content_type='application/octet-stream',
+            HTTP_X_CHUNK_SHA256=digest or hashlib.sha256(body).hexdigest(),
+        )
+
+    def test_out_of_order_resume_and_finalize(self):
+        upload = self.start()
+        self.assertEqual(upload['missing'], [0, self.CHUNK, self.CHUNK * 2])
+
+        self.assertEqual(self.put_chunk(upload['id'], self.CHUNK * 2).status_code, 200)
+        self.assertEqual(self.put_chunk(upload['id'], 0).status_code, 200)
+        self.assertEqual(self.client.post(f"/media/uploads/{upload['id']}/finalize/").status_code, 409)
+
+        # Resume from the status report
+        status = self.client.get(f"/media/uploads/{upload['id']}/").data
+        self.assertEqual(status['missing'], [self.CHUNK])
+        self.assertEqual(self.put_chunk(upload['id'], self.CHUNK).status_code, 200)
+
+        response = self.client.post(f"/media/uploads/{upload['id']}/finalize/")
+        self.assertEqual(response.status_code, 201, response.content)
+        media = Media.objects.get(pk=response.data['media_id'])
+        with media.video.open('rb') as stored:
+            self.assertEqual(stored.read(), self.video)
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'tmp', upload['id'])))
+
+        # Finalizing again is harmless
+        again = self.client.post(f"/media/uploads/{upload['id']}/finalize/")
+        self.assertEqual(again.data['media_id'], media.id)
+
+    def test_finalize_moves_the_file_and_claims_the_upload_once(self):
+        upload = MediaUpload.objects.get(pk=self.start()['id'])
+        for offset in upload.offsets:
+            self.assertEqual(self.put_chunk(upload.pk, offset).status_code, 200)
+
+        # Another finalize wins while this one is storing its file
+        winner = Media.objects.create(project_id=upload.project_id, supervisor_id=upload.supervisor_id, manager_id=upload.manager_id)
+        assemble = uploads.assemble
+
+        def assemble_and_lose(upload):
+            assembled = assemble(upload)
+            MediaUpload.objects.filter(pk=upload.pk).update(media=winner)
+            return assembled
+
+        with mock.patch.object(uploads, 'assemble', assemble_and_lose):
+            response = self.client.post(f"/media/uploads/{upload.pk}/finalize/")
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.data['media_id'], winner.pk)
+        self.assertEqual(Media.objects.count(), 2)
+        # The assembled file was moved into storage, not copied
+        self.assertFalse([name for name in os.listdir(uploads.upload_dir(upload.pk)) if name.startswith('assembled')])
+        # The loser's blob is left unreferenced for gc_blobs
+        self.assertTrue(Blob.objects.filter(name__endswith='.mp4', refcount=0).exists())
+
+    def test_bad_chunks_are_rejected(self):
+        upload = self.start()
+        self.assertEqual(self.put_chunk(upload['id'], 0, digest='0' * 64).status_code, 400)
+        self.assertEqual(self.put_chunk(upload['id'], 0, body=b'short').status_code, 400)
+        self.assertEqual(self.put_chunk(upload['id'], 100).status_code, 400)
+        self.assertEqual(self.client.get(f"/media/uploads/{upload['id']}/").data['received'], [])
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'tmp', upload['id'])), [])
+
+    def test_whole_file_checksum_is_verified(self):
+        upload = self.start(sha256='f' * 64)
+        for offset in range(0, len(self.video), self.CHUNK):
+            self.put_chunk(upload['id'], offset)
+        response = self.client.post(f"/media/uploads/{upload['id']}/finalize/")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Media.objects.exclude(pk=self.media.pk).exists())
+
+    def test_init_validation_and_ownership(self):
+        response = self.client.post('/media/uploads/', {
+            'filename': 'notes.txt', 'size': 10, 'project': self.media.project_id,
+            'supervisor': self.media.supervisor_id, 'manager': self.media.manager_id,
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        upload = self.start()
+        other = APIClient()
+        other.force_authenticate(User.objects.create_user('other', password='x', role='supervisor'))
+        self.assertEqual(other.get(f"/media/uploads/{upload['id']}/").status_code, 404)
+
+    def test_parallel_chunks(self):
+        upload = MediaUpload.objects.get(pk=self.start()['id'])
+        offsets = list(upload.offsets)
+
+        # Chunks land in their own files, so concurrent writers never collide on disk
+        def write(offset):
+            body = self.video[offset:offset + self.CHUNK]
+            return uploads.write_chunk(upload, offset, io.BytesIO(body), hashlib.sha256(body).hexdigest())
+
+        with ThreadPoolExecutor(max_workers=len(offsets)) as pool:
+            sizes = list(pool.map(write, offsets))
+        for offset, size in zip(offsets, sizes):
+            MediaUploadChunk.objects.create(upload=upload, offset=offset, size=size, sha256='-')
+
+        response = self.client.post(f"/media/uploads/{upload.pk}/finalize/")
+        self.assertEqual(response.status_code, 201, response.content)
+        with Media.objects.get(pk=response.data['media_id']).video.open('rb') as stored:
+            self.assertEqual(stored.read(), self.video)
+
+
+@override_settings(CMS_DERIVATIVE_WORKERS=0)
+class ImageDerivativeTests(AuthenticatedAPITestCase):
+    """ Uploaded photos get EXIF-free thumbnails and a metadata sidecar after commit """
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=self.media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        super().setUp()
+        seed_rows(1, 'd')
+        self.media = Media.objects.get()
+
+    def photo(self):
+        # 1200x400 landscape, tagged "rotate 90°" so it displays as portrait
+        exif = Image.Exif()
+        exif[0x010F] = 'Acme'  # Make
+        exif[0x0112] = 6  # Orientation
+        buffer = io.BytesIO()
+        Image.new('RGB', (1200, 400), 'orange').save(buffer, 'JPEG', exif=exif)
+        return SimpleUploadedFile('site.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+    def test_upload_renders_derivatives_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/media/upload/', {
+                'file': self.photo(), 'project': self.media.project_id,
+                'supervisor': self.media.supervisor_id, 'manager': self.media.manager_id,
+            })
+        self.assertEqual(response.status_code, 201, response.content)
+
+        media = Media.objects.get(pk=response.data['media_id'])
+        self.assertEqual(set(media.image_variants), {'source', 'thumb', 'medium', 'exif'})
+        with Image.open(media.image.storage.path(media.image_variants['thumb'])) as thumb:
+            self.assertEqual(thumb.size, (67, 200))
+            self.assertEqual(dict(thumb.getexif()), {})
+        with Image.open(media.image.storage.path(media.image_variants['medium'])) as medium:
+            self.assertEqual(medium.size, (267, 800))
+        with media.image.storage.open(media.image_variants['exif']) as sidecar:
+            self.assertEqual(json.load(sidecar)['Make'], 'Acme')
+
+        rows = {row['id']: row for row in self.client.get('/media/').data['results']}
+        self.assertEqual(rows[media.id]['image_thumb'], f'http://testserver/files/media/{media.id}/image/?variant=thumb')
+        self.assertIsNone(rows[self.media.id]['image_thumb'])
+
+    def test_derivatives_wait_for_commit(self):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            self.media.image = self.photo()
+            self.media.save()
+        self.assertEqual(Media.objects.get(pk=self.media.pk).image_variants, {})
+        self.assertEqual(len(callbacks), 1)
+
+    def test_stale_result_is_discarded(self):
+        self.media.image = self.photo()
+        self.media.save()
+        variants = derivatives.render(self.media.image.path, self.media.image.name)
+        Media.objects.filter(pk=self.media.pk).update(image='media/images/other.jpg')
+        derivatives.store(Media, self.media.pk, self.media.image.name, variants)
+        self.assertEqual(Media.objects.get(pk=self.media.pk).image_variants, {})
+
+    def test_render_runs_in_a_process_pool(self):
+        self.media.image = self.photo()
+        self.media.save()
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            variants = pool.submit(derivatives.render, self.media.image.path, self.media.image.name).result()
+        self.assertTrue(os.path.exists(self.media.image.storage.path(variants['thumb'])))
+
+
+class FileServingTests(AuthenticatedAPITestCase):
+    """ /files/ streams uploads with Range support behind the viewsets' permissions """
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=self.media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        super().setUp()
+        seed_rows(1, 'f')
+        self.body = bytes(range(256)) * 40
+        self.document = Document.objects.get()
+        self.document.file.save('plan.pdf', ContentFile(self.body))
+        self.url = f'/files/documents/{self.document.id}/file/'
+
+    def fetch(self, client=None, url=None, **headers):
+        response = (client or self.client).get(url or self.url, **headers)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, content
+
+    def test_whole_file(self):
+        response, content = self.fetch()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(content, self.body)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_byte_ranges(self):
+        response, content = self.fetch(HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(content, self.body[100:200])
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.body)}')
+        self.assertEqual(response['Content-Length'], '100')
+
+        response, content = self.fetch(HTTP_RANGE='bytes=-10')
+        self.assertEqual(content, self.body[-10:])
+        response, content = self.fetch(HTTP_RANGE='bytes=10000-')
+        self.assertEqual(content, self.body[10000:])
+
+        response, _ = self.fetch(HTTP_RANGE=f'bytes={len(self.body)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.body)}')
+
+    def test_ranges_can_be_sent_with_sendfile(self):
+        request = RequestFactory().get(self.url, HTTP_RANGE='bytes=100-199')
+        response = files.serve(request, self.document.file.storage, self.document.file.name)
+        # A WSGI file_wrapper sends Content-Length bytes from the descriptor's position
+        fileno = response.file_to_stream.fileno()
+        self.assertEqual(os.lseek(fileno, 0, os.SEEK_CUR), 100)
+        self.assertEqual(os.pread(fileno, int(response['Content-Length']), 100), self.body[100:200])
+        response.close()
+
+    def test_serializers_link_to_files(self):
+        document = self.client.get('/documents/').json()['results'][0]
+        self.assertEqual(document['file'], f'http://testserver/files/documents/{self.document.id}/file/')
+        self.assertEqual(self.fetch(url=document['file'])[1], self.body)
+        media = self.client.get('/media/').json()['results'][0]
+        self.assertEqual(media['image'], f"http://testserver/files/media/{media['id']}/image/")
+        self.assertIsNone(media['video'])
+        task = self.client.get('/tasks/').json()['results'][0]
+        self.assertIsNone(task['image'])
+
+    def test_if_range_and_conditional_get(self):
+        etag = self.fetch()[0]['ETag']
+        response, content = self.fetch(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual((response.status_code, content), (206, self.body[:10]))
+        response, content = self.fetch(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual((response.status_code, content), (200, self.body))
+        self.assertEqual(self.fetch(HTTP_IF_NONE_MATCH=etag)[0].status_code, 304)
+
+    def test_permissions_follow_the_viewsets(self):
+        self.assertEqual(self.fetch(client=APIClient())[0].status_code, 401)
+        self.assertEqual(self.fetch(url=f'/files/documents/{self.document.id}/title/')[0].status_code, 404)
+        self.assertEqual(self.fetch(url='/files/users/1/file/')[0].status_code, 404)
+        task = Task.objects.get()
+        self.assertEqual(self.fetch(client=APIClient(), url=f'/files/tasks/{task.id}/image/')[0].status_code, 404)
+
+    def test_image_variants(self):
+        media = Media.objects.get()
+        self.assertEqual(self.fetch(url=f'/files/media/{media.id}/image/?variant=thumb')[0].status_code, 404)
+        media.image.save('site.jpg', ContentFile(b'original'))
+        thumb = media.image.storage.save('site.thumb.jpg', ContentFile(b'thumb'))
+        Media.objects.filter(pk=media.pk).update(image_variants={'source': media.image.name, 'thumb': thumb})
+        self.assertEqual(self.fetch(url=f'/files/media/{media.id}/image/?variant=thumb')[1], b'thumb')
+
+    @override_settings(CMS_FILE_OFFLOAD='x-accel', CMS_FILE_OFFLOAD_PREFIX='/protected/')
+    def test_offload_to_front_end(self):
+        response, content = self.fetch(HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(content, b'')
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected/{self.document.file.name}')
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class BlobStorageTests(TestCase):
+    """ Uploads are stored once per content and only collected when nothing refers to them """
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=self.media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        seed_rows(1, 'b')
+        self.project = Project.objects.get()
+
+    def document(self, body, title='Plan'):
+        document = Document(project=self.project, title=title, document_type='blueprint')
+        document.file.save('plan.PDF', ContentFile(body))
+        return document
+
+    def gc(self):
+        call_command('gc_blobs', grace_hours=0, stdout=io.StringIO())
+
+    def test_identical_uploads_share_one_blob(self):
+        first, second = self.document(b'same bytes'), self.document(b'same bytes', 'Copy')
+        self.assertEqual(first.file.name, second.file.name)
+        digest = hashlib.sha256(b'same bytes').hexdigest()
+        self.assertEqual(first.file.name, f"blobs/{digest[:2]}/{digest[2:4]}/{digest}.pdf")
+        self.assertEqual(Blob.objects.get(name=first.file.name).refcount, 2)
+
+        path = first.file.path
+        first.delete()
+        self.gc()
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(Blob.objects.get(name=second.file.name).refcount, 1)
+
+        second.delete()
+        self.assertEqual(Blob.objects.get(name=second.file.name).refcount, 0)
+        call_command('gc_blobs', stdout=io.StringIO())  # still inside the grace period
+        self.assertTrue(os.path.exists(path))
+        self.gc()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(Blob.objects.exists())
+
+    def test_file_is_moved_before_the_write_transaction(self):
+        events = []
+        move, write_transaction = storage.file_move_safe, sqlite.write_transaction
+
+        @contextlib.contextmanager
+        def recorded_transaction(*args, **kwargs):
+            events.append('begin')
+            with write_transaction(*args, **kwargs):
+                yield
+            events.append('commit')
+
+        def recorded_move(*args, **kwargs):
+            events.append('move')
+            return move(*args, **kwargs)
+
+        with mock.patch.object(storage, 'file_move_safe', recorded_move), mock.patch.object(sqlite, 'write_transaction', recorded_transaction):
+            document = self.document(b'moved')
+        self.assertEqual(events, ['move', 'begin', 'commit'])
+        with document.file.open('rb') as stored:
+            self.assertEqual(stored.read(), b'moved')
+
+    def test_failed_row_insert_removes_the_file(self):
+        digest = hashlib.sha256(b'orphan').hexdigest()
+        path = os.path.join(self.media_root, 'blobs', digest[:2], digest[2:4], f'{digest}.pdf')
+        with mock.patch.object(Blob.objects, 'update_or_create', side_effect=DatabaseError('disk I/O error')):
+            with self.assertRaises(DatabaseError):
+                self.document(b'orphan')
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'blobs', 'tmp')), [])
+
+    def test_replacing_a_file_moves_the_reference(self):
+        document = self.document(b'v1')
+        old = document.file.name
+        document.file.save('plan.pdf', ContentFile(b'v2'))
+        self.assertEqual(Blob.objects.get(name=old).refcount, 0)
+        self.assertEqual(Blob.objects.get(name=document.file.name).refcount, 1)
+
+        # Saves that don't touch the file leave the count alone
+        document.title = 'Renamed'
+        document.save()
+        Document.objects.get(pk=document.pk).save(update_fields=['title'])
+        self.assertEqual(Blob.objects.get(name=document.file.name).refcount, 1)
+
+    def test_field_delete_keeps_shared_file(self):
+        first, second = self.document(b'shared'), self.document(b'shared', 'Copy')
+        first.file.delete(save=True)
+        with second.file.open('rb') as stored:
+            self.assertEqual(stored.read(), b'shared')
+
+    def test_migrate_existing_files(self):
+        legacy = os.path.join(self.media_root, 'documents', '2024')
+        os.makedirs(legacy)
+        for name in ('a.pdf', 'b.pdf'):
+            with open(os.path.join(legacy, name), 'wb') as f:
+                f.write(b'old upload')
+        Document.objects.all().delete()
+        Document.objects.bulk_create([
+            Document(project=self.project, title=name, document_type='contract', file=f'documents/2024/{name}')
+            for name in ('a.pdf', 'b.pdf')
+        ])
+
+        call_command('migrate_files', delete_originals=True, stdout=io.StringIO(), stderr=io.StringIO())
+        names = set(Document.objects.values_list('file', flat=True))
+        self.assertEqual(len(names), 1)
+        self.assertEqual(Blob.objects.get(name=names.pop()).refcount, 2)
+        self.assertEqual(os.listdir(legacy), [])
+
+    def test_recount_repairs_drift(self):
+        document = self.document(b'drift')
+        Blob.objects.update(refcount=7)
+        call_command('gc_blobs', recount=True, grace_hours=0, stdout=io.StringIO())
+        self.assertEqual(Blob.objects.get(name=document.file.name).refcount, 1)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'object-cache-tests'}})
+class ObjectCacheTests(AuthenticatedAPITestCase):
+    """ Reads go through the two cache tiers; writes and stock movements invalidate them """
+
+    def setUp(self):
+        object_cache.clear()
+        self.addCleanup(object_cache.clear)
+        super().setUp()
+        self.worker = Worker.objects.create(name='Kiran', aadhar_number='123412341234')
+        self.resource = Resource.objects.create(name='Tiles', quantity=50)
+
+    def counts(self):
+        return cache.local_hits.value, cache.shared_hits.value, cache.misses.value
+
+    def delta(self, before):
+        return tuple(after - was for after, was in zip(self.counts(), before))
+
+    def test_hits_and_misses(self):
+        loader = mock.Mock(return_value=self.worker)
+        before = self.counts()
+        first = object_cache.get_object(Worker, self.worker.pk, loader)
+        second = object_cache.get_object(Worker, self.worker.pk, loader)
+        self.assertEqual(loader.call_count, 1)
+        self.assertEqual(self.delta(before), (1, 0, 1))
+        # Callers get copies they may change
+        second.name = 'Changed'
+        self.assertEqual(object_cache.get_object(Worker, self.worker.pk, loader).name, 'Kiran')
+        self.assertEqual(first.name, 'Kiran')
+
+        # Another process: nothing in its own LRU, the shared tier still has it
+        object_cache.local.clear()
+        before = self.counts()
+        object_cache.get_object(Worker, self.worker.pk, loader)
+        self.assertEqual((loader.call_count, self.delta(before)), (1, (0, 1, 0)))
+
+    def test_views_read_through_the_cache(self):
+        self.client.get(f'/workers/{self.worker.pk}/')
+        self.client.get('/workers/')
+        # Only the conditional-GET validators are read; the rows come from the cache
+        with self.assertNumQueries(2):
+            self.assertEqual(self.client.get(f'/workers/{self.worker.pk}/').json()['name'], 'Kiran')
+            self.assertEqual([row['name'] for row in self.client.get('/workers/').json()['results']], ['Kiran'])
+
+    def test_save_and_delete_invalidate(self):
+        url = f'/workers/{self.worker.pk}/'
+        self.client.get(url)
+        self.client.get('/workers/')
+        self.worker.name = 'Kiran R'
+        self.worker.save()
+        self.assertEqual(self.client.get(url).json()['name'], 'Kiran R')
+        self.assertEqual([row['name'] for row in self.client.get('/workers/').json()['results']], ['Kiran R'])
+
+        self.worker.delete()
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get('/workers/').json()['results'], [])
+
+    def test_deleting_a_supervisor_invalidates_its_projects(self):
+        supervisor = Supervisor.objects.create(user=User.objects.create_user('lead', password='x', role='supervisor'))
+        project = Project.objects.create(
+            name='Bridge', location='Site', budget=1000, timeline=datetime.date(2025, 1, 1), supervisor=supervisor,
+        )
+        url = f'/projects/{project.pk}/'
+        self.assertEqual(self.client.get(url).json()['supervisor'], supervisor.pk)
+        self.client.get('/projects/')
+
+        supervisor.delete()
+        self.assertEqual(self.client.get(url).json()['supervisor'], None)
+        self.assertEqual(self.client.get('/projects/').json()['results'][0]['supervisor'], None)
+
+    def test_stock_movements_invalidate_the_resource(self):
+        url = f'/resources/{self.resource.pk}/'
+        self.assertEqual(self.client.get(url).json()['quantity'], 50)
+        self.client.get('/resources/')
+        invalidations = cache.invalidations.value
+        inventory.reduce(self.resource.pk, 5)
+        self.assertGreater(cache.invalidations.value, invalidations)
+        self.assertEqual(self.client.get(url).json()['quantity'], 45)
+        self.assertEqual(self.client.get('/resources/').json()['results'][0]['quantity'], 45)
+
+    def test_lru_eviction_and_stats(self):
+        lru = cache.LRUCache(2)
+        evictions = cache.evictions.value
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c'), len(lru)), (1, None, 3, 2))
+        self.assertEqual(cache.evictions.value - evictions, 1)
+
+        self.client.get(f'/workers/{self.worker.pk}/')
+        self.client.get(f'/workers/{self.worker.pk}/')
+        stats = self.client.get('/metrics/').json()
+        for name in ('local_hits', 'shared_hits', 'misses', 'evictions', 'invalidations'):
+            self.assertIsInstance(stats[f'cache.object.{name}'], int)
+        self.assertGreaterEqual(stats['cache.object.local_hits'], 1)
+        self.assertGreaterEqual(stats['cache.object.misses'], 1)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class TokenCacheTests(TestCase):
+    """ Tokens resolve from the process cache until the user or token changes """
+
+    def setUp(self):
+        authentication.clear()
+        object_cache.clear()
+        self.user = User.objects.create_user('cached', password='x', role='manager')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def token_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            status = self.client.get('/metrics/').status_code
+        return status, sum('authtoken_token' in query['sql'] for query in queries)
+
+    def test_repeat_requests_skip_the_database(self):
+        hits = metrics.snapshot()['auth.token.hits']
+        # The token's user, for its version stamp, then the token and user themselves
+        self.assertEqual(self.token_queries(), (200, 2))
+        self.assertEqual(self.token_queries(), (200, 0))
+        self.assertEqual(metrics.snapshot()['auth.token.hits'], hits + 1)
+
+    def test_deactivating_the_user_revokes_access(self):
+        self.token_queries()
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.token_queries()[0], 401)
+
+    def test_deleting_the_token_revokes_access(self):
+        self.token_queries()
+        self.token.delete()
+        self.assertEqual(self.token_queries()[0], 401)
+
+    def test_role_change_is_seen(self):
+        self.token_queries()
+        User.objects.filter(pk=self.user.pk).update(role='supervisor')  # unseen: no save()
+        self.assertEqual(self.token_queries(), (200, 0))
+        user = User.objects.get(pk=self.user.pk)
+        user.role = 'supervisor'
+        user.save()
+        self.assertEqual(self.token_queries(), (200, 1))
+
+    def test_invalidation_during_the_load_is_not_lost(self):
+        load = TokenAuthentication.authenticate_credentials
+
+        def load_then_invalidate(auth, key):
+            user, token = load(auth, key)
+            authentication.invalidate_user(user.pk)  # e.g. a deactivation committing meanwhile
+            return user, token
+
+        with mock.patch.object(TokenAuthentication, 'authenticate_credentials', load_then_invalidate):
+            self.assertEqual(self.token_queries(), (200, 2))
+        # Stored under the stamp from before the load, so it's already stale
+        self.assertEqual(self.token_queries(), (200, 1))
+        self.assertEqual(self.token_queries(), (200, 0))
+
+    @override_settings(CMS_AUTH_CACHE_TTL=0)
+    def test_cache_can_be_disabled(self):
+        self.assertEqual(self.token_queries(), (200, 1))
+        self.assertEqual(self.token_queries(), (200, 1))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PrincipalTests(TestCase):
+    """ Role, groups and profile ids are resolved once and cached with the token """
+
+    def setUp(self):
+        authentication.clear()
+        object_cache.clear()
+        self.user = User.objects.create_user('boss', password='x', role='manager')
+        self.manager = Manager.objects.create(user=self.user, department='Civil', phone_number='9999999999')
+        self.user.groups.add(Group.objects.create(name='Manager'))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.user).key}')
+
+    def test_resolved_in_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            principal = authentication.Principal.load(self.user.pk)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual((principal.role, principal.groups, principal.manager_id, principal.supervisor_id),
+                         ('manager', frozenset({'Manager'}), self.manager.id, None))
+
+    def test_permissions_read_the_principal(self):
+        request = SimpleNamespace(user=User.objects.get(pk=self.user.pk))
+        view = SimpleNamespace(action='get_project_documents')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(IsManager().has_permission(request, view))
+            self.assertFalse(IsSupervisor().has_permission(request, view))
+            self.assertTrue(IsManagerOrSupervisor().has_permission(request, view))
+        self.assertEqual(len(queries), 1)
+
+    def test_warm_profile_request_only_reads_the_profile(self):
+        self.assertEqual(self.client.get('/profile/').status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/profile/')
+        self.assertEqual(response.data['department'], 'Civil')
+        self.assertEqual([q['sql'] for q in queries if 'appcms_manager' not in q['sql']], [])
+
+    def test_group_and_profile_changes_are_seen(self):
+        self.client.get('/profile/')
+        self.user.groups.clear()
+        self.assertEqual(authentication.get_principal(SimpleNamespace(user=self.authenticated_user())).groups, frozenset())
+
+        self.manager.delete()
+        self.assertEqual(self.client.get('/profile/').status_code, 404)
+
+    def test_clearing_a_group_is_seen_by_its_members(self):
+        principal = lambda: authentication.get_principal(SimpleNamespace(user=self.authenticated_user()))
+        self.assertEqual(principal().groups, frozenset({'Manager'}))
+        Group.objects.get(name='Manager').user_set.clear()
+        self.assertEqual(principal().groups, frozenset())
+
+        group = Group.objects.create(name='Auditor')
+        group.user_set.add(self.user)
+        self.assertEqual(principal().groups, frozenset({'Auditor'}))
+        group.user_set.remove(self.user)
+        self.assertEqual(principal().groups, frozenset())
+
+    def authenticated_user(self):
+        key = Token.objects.get(user=self.user).key
+        return authentication.CachedTokenAuthentication().authenticate_credentials(key)[0]
+
+
+class WorkerImportTests(AuthenticatedAPITestCase):
+    """ Bulk worker import validates, de-duplicates and inserts a file in set-based queries """
+
+    def setUp(self):
+        object_cache.clear()
+        super().setUp()
+        Worker.objects.create(name='Existing', aadhar_number='111111111111')
+
+    def post(self, body, content_type='text/csv', mode='partial'):
+        return self.client.generic('POST', f'/workers/import/?mode={mode}', body.encode(), content_type=content_type)
+
+    def test_csv_reports_each_bad_row(self):
+        body = (
+            "name,aadhar_number,is_working\n"
+            "Asha,222222222222,yes\n"
+            "Bad,12345,no\n"
+            "Copy,222222222222,\n"
+            "Old,111111111111,1\n"
+            ",333333333333,0\n"
+            "Ravi,444444444444,maybe\n"
+            "Meena,555555555555,0\n"
+        )
+        response = self.post(body)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['created'], response.data['failed']), (2, 5))
+        self.assertEqual(
+            [(error['row'], sorted(error['errors'])) for error in response.data['errors']],
+            [(2, ['aadhar_number']), (3, ['aadhar_number']), (4, ['aadhar_number']), (5, ['name']), (6, ['is_working'])],
+        )
+        self.assertTrue(Worker.objects.get(aadhar_number='222222222222').is_working)
+        self.assertEqual(ChangeLog.objects.filter(model='appcms.worker').count(), 3)
+
+    def test_query_count_is_independent_of_row_count(self):
+        rows = ''.join(json.dumps({'name': f'W{i}', 'aadhar_number': f'{i:012d}'}) + '\n' for i in range(2, 1202))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post(rows, content_type='application/x-ndjson')
+        self.assertEqual(response.data['created'], 1200)
+        self.assertLess(len(queries), 30)  # a handful per 1000-row chunk, not one per row
+
+    def test_atomic_mode_creates_nothing_on_error(self):
+        response = self.post('{"name": "A", "aadhar_number": "222222222222"}\nnot json\n', 'application/x-ndjson', 'atomic')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['created'], 0)
+        self.assertEqual(response.data['errors'][0]['row'], 2)
+        self.assertFalse(Worker.objects.filter(aadhar_number='222222222222').exists())
+
+    def test_partial_mode_commits_chunk_by_chunk(self):
+        body = b"name,aadhar_number\nAsha,222222222222\nRavi,333333333333\nMeena,44444444\xff4444\n"
+        with mock.patch.object(worker_import, 'CHUNK_ROWS', 2), mock.patch.object(worker_import, 'READ_SIZE', 16):
+            response = self.client.generic('POST', '/workers/import/?mode=partial', body, content_type='text/csv')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(Worker.objects.filter(aadhar_number__in=['222222222222', '333333333333']).count(), 2)
+
+    def test_conflicts_missed_by_the_lookup_are_rejected(self):
+        # Numbers taken between the lookup and the insert make every bulk attempt fail
+        rows = [(1, {'name': 'Old', 'aadhar_number': '111111111111'}), (2, {'name': 'New', 'aadhar_number': '222222222222'})]
+        with mock.patch.object(worker_import, '_drop_existing', lambda candidates, report: candidates):
+            report = worker_import.import_workers(iter(rows))
+        self.assertEqual((report['created'], report['failed']), (1, 1))
+        self.assertEqual(report['errors'][0]['row'], 1)
+        self.assertTrue(Worker.objects.filter(aadhar_number='222222222222').exists())
+
+        with mock.patch.object(worker_import, '_drop_existing', lambda candidates, report: candidates):
+            report = worker_import.import_workers(iter([(1, {'name': 'Other', 'aadhar_number': '333333333333'})] + rows), 'atomic')
+        self.assertEqual((report['created'], report['failed']), (0, 2))
+        self.assertFalse(Worker.objects.filter(aadhar_number='333333333333').exists())
+
+    def test_rejects_unknown_types_and_headers(self):
+        self.assertEqual(self.post('x', content_type='application/json').status_code, 415)
+        self.assertEqual(self.post('first,second\n1,2\n').status_code, 400)
+
+    def test_management_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write("name,aadhar_number\nAsha,222222222222\nOld,111111111111\n")
+        self.addCleanup(os.remove, f.name)
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_workers', f.name, stdout=out, stderr=err)
+        self.assertIn('Created 1 worker(s); 1 row(s) rejected.', out.getvalue())
+        self.assertIn('Row 2: aadhar_number', err.getvalue())
+
+
+@override_settings(CMS_HASH_WORKERS=0)
+class BulkOnboardingTests(AuthenticatedAPITestCase):
+    """ Users, profiles and tokens are created a table at a time, with passwords hashed off-thread """
+
+    username = 'admin'
+
+    def setUp(self):
+        authentication.clear()
+        super().setUp()
+        self.user.groups.add(Group.objects.create(name='Manager'))
+
+    def entries(self, count, prefix='u'):
+        return [
+            {'username': f'{prefix}{i}', 'password': f'pw{i}', 'role': 'manager', 'department': 'Civil', 'phone_number': '99'}
+            if i % 2 else {'username': f'{prefix}{i}', 'password': f'pw{i}', 'role': 'supervisor'}
+            for i in range(count)
+        ]
+
+    def test_batch_creates_users_profiles_and_tokens(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/register/bulk/', self.entries(40), format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 40)
+        self.assertLess(len(queries), 20)
+
+        first, second = response.data['results'][:2]
+        self.assertEqual(Supervisor.objects.get(pk=first['supervisor_id']).user_id, first['id'])
+        self.assertEqual(Manager.objects.get(pk=second['manager_id']).department, 'Civil')
+        self.assertTrue(User.objects.get(pk=second['id']).check_password('pw1'))
+        token = APIClient()
+        token.credentials(HTTP_AUTHORIZATION=f"Token {second['token']}")
+        self.assertEqual(token.get('/profile/').status_code, 200)
+
+    def test_atomic_batch_reports_errors_and_creates_nothing(self):
+        entries = self.entries(3) + [
+            {'username': 'admin', 'password': 'x', 'role': 'supervisor'},
+            {'username': 'u0', 'password': 'x', 'role': 'supervisor'},
+            {'username': 'bad name!', 'password': 'x', 'role': 'manager'},
+        ]
+        response = self.client.post('/register/bulk/', entries, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([r['status'] for r in response.data['results']], ['skipped'] * 3 + ['error'] * 3)
+        self.assertEqual(sorted(response.data['results'][5]['errors']), ['department', 'phone_number', 'username'])
+        self.assertEqual(User.objects.count(), 1)
+
+        response = self.client.post('/register/bulk/?mode=partial', entries, format='json')
+        self.assertEqual((response.status_code, response.data['created'], response.data['failed']), (201, 3, 3))
+
+    def test_only_managers_may_onboard(self):
+        self.client.force_authenticate(User.objects.create_user('sup', password='x', role='supervisor'))
+        self.assertEqual(self.client.post('/register/bulk/', self.entries(1), format='json').status_code, 403)
+
+    @override_settings(CMS_HASH_MAX_PENDING=1)
+    def test_registration_is_turned_away_when_hashing_is_saturated(self):
+        with onboarding._admit(1):
+            response = APIClient().post('/register/supervisor/', {'user': {'username': 's', 'password': 'x', 'role': 'supervisor'}}, format='json')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(onboarding.RETRY_AFTER))
+        self.assertFalse(User.objects.filter(username='s').exists())
+
+        response = APIClient().post('/register/supervisor/', {'user': {'username': 's', 'password': 'x', 'role': 'supervisor'}}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+    @override_settings(CMS_HASH_WORKERS=2)
+    def test_passwords_are_hashed_in_the_pool(self):
+        onboarding.shutdown()
+        self.addCleanup(onboarding.shutdown)
+        hashed = onboarding.hash_passwords(['a', 'b', 'c'])
+        self.assertTrue(all(value.startswith('md5$') for value in hashed))
+        self.assertEqual(len(set(hashed)), 3)
+
+    def test_management_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump(self.entries(2, 'cmd'), f)
+        self.addCleanup(os.remove, f.name)
+        out = io.StringIO()
+        call_command('onboard_users', f.name, '--show-tokens', stdout=out)
+        self.assertIn('Created 2 user(s).', out.getvalue())
+        self.assertIn(f"cmd1\t{Token.objects.get(user__username='cmd1').key}", out.getvalue())
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'], CMS_DERIVATIVE_WORKERS=0)
+class AsyncViewTests(TestCase):
+    """ The /async/ views answer exactly like their DRF counterparts """
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=self.media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        authentication.clear()
+        object_cache.clear()
+        seed_rows(3, 'a')
+        self.manager = Manager.objects.first()
+        self.key = Token.objects.create(user=self.manager.user).key
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.key}')
+
+    def aget(self, path, **headers):
+        return async_to_sync(self.async_client.get)(path, headers={'Authorization': f'Token {self.key}', **headers})
+
+    def apost(self, path, data):
+        return async_to_sync(self.async_client.post)(path, data, headers={'Authorization': f'Token {self.key}'})
+
+    def test_lists_match_the_drf_views(self):
+        for path in ['projects/', 'tasks/?expand=resource,project', 'resources/?fields=id,quantity', 'workers/?page_size=2',
+                     'documents/?expand=project', 'media/?fields=id,image_thumb']:
+            expected = self.client.get(f'/{path}', HTTP_ACCEPT='application/json')
+            response = self.aget(f'/async/{path}')
+            self.assertEqual(response.status_code, 200, path)
+            self.assertEqual(response.json(), json.loads(expected.content.decode().replace('/workers/', '/async/workers/')), path)
+
+    def test_list_conditional_get(self):
+        response = self.aget('/async/workers/')
+        self.assertEqual(self.aget('/async/workers/', if_none_match=response['ETag']).status_code, 304)
+
+    def test_authentication_and_permissions(self):
+        self.assertEqual(async_to_sync(self.async_client.get)('/async/workers/').status_code, 401)
+        self.assertEqual(async_to_sync(self.async_client.get)('/async/projects/').status_code, 200)
+        response = async_to_sync(self.async_client.get)('/async/profile/', headers={'Authorization': 'Token nope'})
+        self.assertEqual(response.status_code, 401)
+
+    def test_profile(self):
+        self.assertEqual(self.aget('/async/profile/').json(), self.client.get('/profile/').json())
+
+    def test_media_upload(self):
+        image = io.BytesIO()
+        Image.new('RGB', (40, 30), 'red').save(image, 'JPEG')
+        upload = SimpleUploadedFile('site.jpg', image.getvalue(), content_type='image/jpeg')
+        project = Project.objects.first()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.apost('/async/media/upload/', {
+                'file': upload, 'project': project.id, 'supervisor': project.supervisor_id, 'manager': self.manager.id,
+            })
+        self.assertEqual(response.status_code, 201)
+        media = Media.objects.get(pk=response.json()['media_id'])
+        self.assertEqual(Blob.objects.get(name=media.image.name).refcount, 1)
+        self.assertEqual(media.image.read(), image.getvalue())
+
+        response = self.apost('/async/media/upload/', {'file': upload, 'project': 0, 'supervisor': 0, 'manager': 0})
+        self.assertEqual(response.status_code, 400)
+
+    def test_document_upload(self):
+        project = Project.objects.first()
+        response = self.apost('/async/documents/upload/', {
+            'file': SimpleUploadedFile('plan.pdf', b'%PDF-1.4'), 'project': project.id, 'document_type': 'contract',
+        })
+        self.assertEqual(response.status_code, 201)
+        document = Document.objects.get(pk=response.json()['document_id'])
+        self.assertEqual((document.title, document.file.read()), ('plan.pdf', b'%PDF-1.4'))
+        self.assertEqual(self.apost('/async/documents/upload/', {'project': 999999}).status_code, 404)
+
+    def test_benchmark_command(self):
+        out = io.StringIO()
+        call_command('bench_concurrency', '--only', 'asgi', '--clients', '5', '--delay-ms', '0', '--host', 'testserver', stdout=out)
+        self.assertIn('asgi: 5 uploads', out.getvalue())
+        self.assertIn('failed 0', out.getvalue())
+        self.assertFalse(User.objects.filter(username__startswith='bench-').exists())
+
+
+@override_settings(CMS_READ_REPLICAS=['replica'])
+class ReplicaRouterTests(SimpleTestCase):
+    """ appcms reads go to a fresh replica unless the client has just written """
+
+    def setUp(self):
+        self.router = routers.ReplicaRouter()
+        routers.health.clear()
+        patcher = mock.patch.object(routers, 'measure_lag', return_value=0.0)
+        self.measure_lag = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reads_and_writes(self):
+        self.assertEqual(self.router.db_for_read(Project), 'replica')
+        self.assertIsNone(self.router.db_for_read(User))
+        self.assertIsNone(self.router.db_for_read(Token))
+        self.assertEqual(self.router.db_for_write(Project), 'default')
+        self.assertFalse(self.router.allow_migrate('replica', 'appcms'))
+        with routers.pin_to_primary():
+            self.assertEqual(self.router.db_for_read(Project), 'default')
+
+    def test_lagging_or_broken_replicas_fall_back_to_the_primary(self):
+        self.measure_lag.return_value = 60.0
+        self.assertEqual(self.router.db_for_read(Project), 'default')
+        routers.health.clear()
+        self.measure_lag.side_effect = DatabaseError('no such table')
+        self.assertEqual(self.router.db_for_read(Project), 'default')
+
+    @override_settings(CMS_REPLICA_CHECK_SECONDS=60)
+    def test_lag_is_checked_periodically(self):
+        for _ in range(5):
+            self.router.db_for_read(Project)
+        self.assertEqual(self.measure_lag.call_count, 1)
+
+    def test_clients_stick_to_the_primary_after_writing(self):
+        seen = []
+
+        def view(request):
+            seen.append(self.router.db_for_read(Project))
+            return HttpResponse(status=201 if request.method == 'POST' else 200)
+
+        middleware = routers.ReplicaStickinessMiddleware(view)
+        factory = RequestFactory()
+        cache_key = routers._client_key(factory.get('/', HTTP_AUTHORIZATION='Token a'))
+        self.addCleanup(routers._cache().delete, cache_key)
+
+        middleware(factory.get('/', HTTP_AUTHORIZATION='Token a'))
+        middleware(factory.post('/', HTTP_AUTHORIZATION='Token a'))
+        middleware(factory.get('/', HTTP_AUTHORIZATION='Token a'))
+        middleware(factory.get('/', HTTP_AUTHORIZATION='Token b'))
+        self.assertEqual(seen, ['replica', 'default', 'default', 'replica'])
+
+
+    def test_users_and_issued_tokens_stick_too(self):
+        seen = []
+        user = SimpleNamespace(pk=7, is_authenticated=True)
+
+        def view(request):
+            # As DRF does once the view has authenticated the request
+            if request.META.get('HTTP_AUTHORIZATION'):
+                request.user = user
+            seen.append(self.router.db_for_read(Project))
+            if request.method == 'POST':
+                return Response({'token': 'issued'}, status=201)
+            return HttpResponse()
+
+        middleware = routers.ReplicaStickinessMiddleware(view)
+        factory = RequestFactory()
+        for identity in ('Token issued', 'Token other', 'Token writer', None):
+            request = factory.get('/', HTTP_AUTHORIZATION=identity) if identity else factory.get('/')
+            self.addCleanup(routers._cache().delete, routers._client_key(request))
+        self.addCleanup(routers._cache().delete, routers._user_key(SimpleNamespace(user=user)))
+
+        # A registration: no credentials yet, a token in the response
+        middleware(factory.post('/register/'))
+        middleware(factory.get('/profile/', HTTP_AUTHORIZATION='Token issued'))
+        # A write by the user with one token pins the user's other clients
+        routers._cache().delete(routers._user_key(SimpleNamespace(user=user)))
+        middleware(factory.post('/tasks/', HTTP_AUTHORIZATION='Token writer'))
+        middleware(factory.get('/tasks/', HTTP_AUTHORIZATION='Token other'))
+        middleware(factory.get('/tasks/', REMOTE_ADDR='10.0.0.9'))
+        self.assertEqual(seen, ['default', 'default', 'default', 'default', 'replica'])
+
+
+class ReplicaLagTests(TransactionTestCase):
+    """ Lag is read from the change log; SQLite replicas are snapshot copies """
+    # Not TestCase: the backup API can't copy a database while this connection holds a transaction open
+
+    def test_caught_up_replica_has_no_lag(self):
+        Worker.objects.create(name='Asha', aadhar_number='222222222222')
+        self.assertEqual(routers.measure_lag('default'), 0.0)
+
+    def test_sqlite_copy(self):
+        Worker.objects.bulk_create([Worker(name=f'W{i}', aadhar_number=f'{i:012d}') for i in range(3)])
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'replica.sqlite3')
+        routers.copy_sqlite('default', path)
+        with contextlib.closing(sqlite3.connect(path)) as replica:
+            self.assertEqual(replica.execute('SELECT COUNT(*) FROM worker').fetchone()[0], Worker.objects.count())
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class SqliteProfileTests(TestCase):
+    """ Connections run the concurrency profile; a write still locked out is a 503 """
+
+    def test_connections_use_the_profile(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+            cursor.execute('PRAGMA temp_store')
+            self.assertEqual(cursor.fetchone()[0], 2)  # MEMORY
+        # Only write transactions take the lock at BEGIN
+        self.assertIsNone(connection.transaction_mode)
+        self.assertIn(sqlite.lock_monitor, connection.execute_wrappers)
+
+    def test_locked_write_answers_503(self):
+        seed_rows(1, 'l')
+        task = Task.objects.get()
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('locked', password='x', role='manager'))
+        with mock.patch.object(Task, 'save', side_effect=OperationalError('database is locked')):
+            response = client.put(f'/tasks/{task.pk}/', {
+                'name': 'Moved', 'resource': task.resource_id, 'quantity_used': 2, 'worker': task.worker_id,
+                'project': task.project_id, 'supervisor': task.supervisor_id,
+                'start_date': '2025-01-01', 'end_date': '2025-01-05', 'description': '-',
+            }, format='json')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+
+class WriteTransactionTests(TransactionTestCase):
+    """ Write transactions begin IMMEDIATE; everything else stays deferred """
+
+    def test_begin_modes(self):
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                Worker.objects.count()
+            with sqlite.write_transaction():
+                Worker.objects.count()
+                # Nested: a savepoint, no second BEGIN
+                with sqlite.write_transaction():
+                    Worker.objects.count()
+            with override_settings(CMS_SQLITE_IMMEDIATE_WRITES=False), sqlite.write_transaction():
+                Worker.objects.count()
+        begins = [query['sql'] for query in queries if query['sql'].startswith('BEGIN')]
+        self.assertEqual(begins, ['BEGIN', 'BEGIN IMMEDIATE', 'BEGIN'])
+        self.assertIsNone(connection.transaction_mode)
+
+
+@override_settings(CMS_SQLITE_LOCK_RETRIES=2, CMS_SQLITE_LOCK_BACKOFF=0)
+class LockRetryTests(SimpleTestCase):
+    """ Writes locked out by another process are retried from the top of their transaction """
+
+    def test_retries_until_the_lock_is_free(self):
+        func = mock.Mock(side_effect=[OperationalError('database is locked'), OperationalError('database is locked'), 'done'])
+        retries = sqlite.lock_retries.value
+        self.assertEqual(sqlite.retry_on_lock(func)(), 'done')
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(sqlite.lock_retries.value - retries, 2)
+
+    def test_gives_up_after_the_retries(self):
+        func = mock.Mock(side_effect=OperationalError('database is locked'))
+        gave_up = sqlite.lock_gave_up.value
+        with self.assertRaises(OperationalError):
+            sqlite.retry_on_lock(func)()
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(sqlite.lock_gave_up.value - gave_up, 1)
+
+    def test_other_errors_and_inner_transactions_are_not_retried(self):
+        func = mock.Mock(side_effect=OperationalError('no such table: task'))
+        with self.assertRaises(OperationalError):
+            sqlite.retry_on_lock(func)()
+        self.assertEqual(func.call_count, 1)
+
+        func = mock.Mock(side_effect=OperationalError('database is locked'))
+        with mock.patch.object(connection, 'in_atomic_block', True), self.assertRaises(OperationalError):
+            sqlite.retry_on_lock(func)()
+        self.assertEqual(func.call_count, 1)
+
+    def test_processes_writing_one_file(self):
+        out = io.StringIO()
+        call_command('stress_sqlite', processes=3, tasks=15, stdout=out)
+        self.assertIn('failed 0', out.getvalue())
+        self.assertIn('gave up 0', out.getvalue())
+
+
+class KeysetPaginationTests(AuthenticatedAPITestCase):
+    """ Cursors page both ways in a total order, reject tampering, and counts are opt-in """
+
+    def setUp(self):
+        super().setUp()
+        seed_rows(1, 'k')
+        task = Task.objects.get()
+        # Three tasks on each day, so the ordering key repeats
+        for i in range(8):
+            day = datetime.date(2025, 3, 1 + i % 3)
+            Task.objects.create(
+                name=f'T{i}', resource=task.resource, quantity_used=1, worker=task.worker, project=task.project,
+                supervisor=task.supervisor, start_date=day, end_date=day, description='-',
+            )
+        self.expected = list(Task.objects.order_by('start_date', 'id').values_list('id', flat=True))
+
+    def page(self, url, params=None):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_next_and_previous_cursors(self):
+        pages, data = [], self.page('/tasks/', {'ordering': 'start_date', 'page_size': 2, 'fields': 'id'})
+        self.assertIsNone(data['previous'])
+        while True:
+            pages.append([row['id'] for row in data['results']])
+            if not data['next']:
+                break
+            data = self.page(data['next'])
+        self.assertEqual([pk for page in pages for pk in page], self.expected)
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 2, 1])
+
+        # And back again from the last page
+        back = []
+        while data['previous']:
+            data = self.page(data['previous'])
+            back.insert(0, [row['id'] for row in data['results']])
+        self.assertEqual(back, pages[:-1])
+        self.assertIsNone(data['previous'])
+
+    def test_duplicate_keys_keep_a_stable_order(self):
+        descending = list(Task.objects.order_by('-start_date', '-id').values_list('id', flat=True))
+        ids, url, params = [], '/tasks/', {'ordering': '-start_date', 'page_size': 3, 'fields': 'id'}
+        while url:
+            data = self.page(url, params)
+            ids += [row['id'] for row in data['results']]
+            url, params = data['next'], None
+        self.assertEqual(ids, descending)
+
+    def test_tampered_cursors_are_rejected(self):
+        paginator = pagination.KeysetPagination()
+        cursors = [
+            'not base64!',
+            base64.urlsafe_b64encode(b'{"x": 1}').decode(),
+            paginator.encode_cursor([1], reverse=False),  # one key short
+            paginator.encode_cursor(['not a date', 1], reverse=False),
+            paginator.encode_cursor(['2025-03-01', 'one'], reverse=False),
+            paginator.encode_cursor([['2025-03-01'], 1], reverse=False),
+        ]
+        for cursor in cursors:
+            response = self.client.get('/tasks/', {'ordering': 'start_date', 'cursor': cursor})
+            self.assertEqual(response.status_code, 400, cursor)
+            self.assertIn('cursor', response.json())
+
+    def test_counts(self):
+        data = self.page('/tasks/', {'page_size': 2})
+        self.assertNotIn('count', data)
+
+        data = self.page('/tasks/', {'page_size': 2, 'count': 'exact'})
+        self.assertEqual((data['count'], data['count_is_estimate']), (9, False))
+        self.assertNotIn('count=', data['next'])
+
+        # Unfiltered: the table's highest rowid, an upper bound
+        Task.objects.filter(pk=self.expected[-1]).delete()
+        data = self.page('/tasks/', {'page_size': 2, 'count': 'approx'})
+        self.assertEqual((data['count'], data['count_is_estimate']), (9, True))
+
+        # Filtered: counted up to the cap
+        params = {'start_date_after': '2025-03-01', 'count': 'approx'}
+        data = self.page('/tasks/', params)
+        self.assertEqual((data['count'], data['count_is_estimate']), (7, False))
+        with mock.patch.object(pagination.KeysetPagination, 'approximate_count_cap', 5):
+            data = self.page('/tasks/', params)
+        self.assertEqual((data['count'], data['count_is_estimate']), (5, True))
+
+
+class ListFilterTests(AuthenticatedAPITestCase):
+    """ Task, document and media lists filter and order on indexed columns """
+
+    def setUp(self):
+        super().setUp()
+        seed_rows(2, 'q')
+        self.task = Task.objects.order_by('id').first()
+        for day in (3, 9, 6):
+            Task.objects.create(
+                name=f'Day {day}', resource=self.task.resource, quantity_used=1, worker=self.task.worker,
+                project=self.task.project, supervisor=self.task.supervisor,
+                start_date=datetime.date(2025, 2, day), end_date=datetime.date(2025, 2, day + 1), description='-',
+            )
+        Document.objects.filter(title='Blueprint q1').update(document_type='contract', created_at=timezone.now() - datetime.timedelta(days=10))
+
+    def names(self, response):
+        self.assertEqual(response.status_code, 200, response.content)
+        return [row['name'] for row in response.json()['results']]
+
+    def test_task_filters(self):
+        response = self.client.get('/tasks/', {'project': self.task.project_id, 'fields': 'name'})
+        self.assertEqual(self.names(response), ['Task q0', 'Day 3', 'Day 9', 'Day 6'])
+        response = self.client.get('/tasks/', {'start_date_after': '2025-02-04', 'start_date_before': '2025-02-09', 'fields': 'name'})
+        self.assertEqual(self.names(response), ['Day 9', 'Day 6'])
+        response = self.client.get('/tasks/', {'worker': self.task.worker_id, 'end_date_before': '2025-02-05', 'fields': 'name'})
+        self.assertEqual(self.names(response), ['Task q0', 'Day 3'])
+
+    def test_ordering_is_whitelisted_and_paged_by_keyset(self):
+        names = []
+        url, params = '/tasks/', {'project': self.task.project_id, 'ordering': '-start_date', 'page_size': 2, 'fields': 'name'}
+        while url:
+            response = self.client.get(url, params)
+            names += self.names(response)
+            url, params = response.json()['next'], None
+        self.assertEqual(names, ['Day 9', 'Day 6', 'Day 3', 'Task q0'])
+
+        response = self.client.get('/tasks/', {'ordering': 'description'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('ordering', response.json())
+
+    def test_invalid_filter_values_are_rejected(self):
+        response = self.client.get('/tasks/', {'project': 'abc', 'start_date_after': '2025-13-01'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()), {'project', 'start_date_after'})
+        self.assertEqual(self.client.get('/documents/', {'type': 'poem'}).status_code, 400)
+
+    def test_document_and_media_filters(self):
+        response = self.client.get('/documents/', {'type': 'contract'})
+        self.assertEqual([row['title'] for row in response.json()['results']], ['Blueprint q1'])
+        today = timezone.localdate().isoformat()
+        response = self.client.get('/documents/', {'created_after': today, 'created_before': today})
+        self.assertEqual([row['title'] for row in response.json()['results']], ['Blueprint q0'])
+        response = self.client.get('/media/', {'project': self.task.project_id, 'created_before': today})
+        self.assertEqual(len(response.json()['results']), 1)
+
+    def assert_index_plans(self, url, table, filters, orderings):
+        """ Every combination of `filters` under every ordering is answered from an index """
+        for size in range(1, len(filters) + 1):
+            for combination in itertools.combinations(filters, size):
+                for ordering in orderings:
+                    params = {key: value for group in combination for key, value in group.items()}
+                    params['ordering'] = ordering
+                    with CaptureQueriesContext(connection) as queries:
+                        response = self.client.get(url, params)
+                    self.assertEqual(response.status_code, 200)
+                    statements = [query['sql'] for query in queries if f'FROM "{table}"' in query['sql'] and ' WHERE ' in query['sql']]
+                    self.assertEqual(len(statements), 2, params)  # the ETag aggregate and the page
+                    for sql in statements:
+                        with connection.cursor() as cursor:
+                            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                            plan = [row[-1] for row in cursor.fetchall()]
+                        self.assertTrue(any(step.startswith(f'SEARCH {table} USING ') for step in plan), (params, plan))
+
+    def test_every_filter_combination_has_an_index_plan(self):
+        task = self.task
+        self.assert_index_plans('/tasks/', Task._meta.db_table, [
+            {'project': task.project_id},
+            {'supervisor': task.supervisor_id},
+            {'worker': task.worker_id},
+            {'resource': task.resource_id},
+            {'start_date_after': '2025-01-01', 'start_date_before': '2025-03-01'},
+            {'end_date_after': '2025-01-01'},
+        ], ['id', '-start_date', 'end_date'])
+        self.assert_index_plans('/documents/', Document._meta.db_table, [
+            {'project': task.project_id},
+            {'type': 'blueprint'},
+            {'created_after': '2025-01-01', 'created_before': '2030-01-01'},
+        ], ['-created_at', 'id'])
+        self.assert_index_plans('/media/', Media._meta.db_table, [
+            {'project': task.project_id},
+            {'created_after': '2025-01-01'},
+        ], ['-created_at', 'id'])
+
+
+class SearchTests(AuthenticatedAPITestCase):
+    """ /search/ ranks tasks, documents and media from an index kept in step with every write """
+
+    def setUp(self):
+        super().setUp()
+        seed_rows(2, 's')
+        self.first, self.second = Project.objects.order_by('id')
+        seeded = Task.objects.get(name='Task s0')
+        self.task = Task.objects.create(
+            name='Rebar inspection', resource=seeded.resource, quantity_used=1, project=self.first, supervisor=seeded.supervisor,
+            start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 2), description='East wing slab rebar checked',
+        )
+        self.document = Document.objects.create(
+            project=self.second, title='Rebar schedule, east wing', document_type='inspection_report', file='documents/east.pdf',
+        )
+
+    def search(self, **params):
+        response = self.client.get('/search/', params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return [(hit['kind'], hit['id']) for hit in response.json()['results']]
+
+    def test_ranked_and_filtered(self):
+        # Title matches outrank body matches
+        self.assertEqual(self.search(q='rebar inspection'), [('task', self.task.pk), ('document', self.document.pk)])
+        self.assertEqual(self.search(q='east wing'), [('document', self.document.pk), ('task', self.task.pk)])
+        self.assertEqual(self.search(q='rebar inspection', project=self.second.pk), [('document', self.document.pk)])
+        self.assertEqual({kind for kind, _ in self.search(q='footing', type='media')}, {'media'})
+        self.assertEqual({kind for kind, _ in self.search(q='footing')}, {'task', 'media'})
+        # Stemmed, and the last word matches as a prefix
+        self.assertEqual(self.search(q='inspections slab'), [('task', self.task.pk)])
+        self.assertEqual(self.search(q='sched'), [('document', self.document.pk)])
+
+    def test_index_follows_writes(self):
+        self.task.description = 'North wing columns'
+        self.task.save()
+        self.assertEqual(self.search(q='slab'), [])
+        self.assertEqual(self.search(q='columns'), [('task', self.task.pk)])
+
+        with contextlib.suppress(RuntimeError), transaction.atomic():
+            Task.objects.filter(pk=self.task.pk).get().delete()
+            raise RuntimeError
+        self.assertEqual(self.search(q='columns'), [('task', self.task.pk)])
+
+        project = self.first.pk
+        self.first.delete()  # cascades to its tasks and media
+        self.assertEqual(self.search(q='columns'), [])
+        self.assertEqual(self.search(q='footing', project=project), [])
+
+    def test_bulk_created_tasks_are_indexed(self):
+        task = self.task
+        response = self.client.post('/tasks/bulk/', [{
+            'name': 'Scaffold check', 'resource': task.resource_id, 'quantity_used': 1, 'project': task.project_id,
+            'supervisor': task.supervisor_id, 'start_date': '2025-01-01', 'end_date': '2025-01-02', 'description': 'Tower crane',
+        }], format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.search(q='crane'), [('task', response.json()['results'][0]['id'])])
+
+    def test_queries_read_the_inverted_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.search(q='rebar', project=self.first.pk)
+        sql = next(query['sql'] for query in queries if search.TABLE in query['sql'])
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            plan = [row[-1] for row in cursor.fetchall()]
+        self.assertTrue(any(step.startswith(f'SCAN {search.TABLE} VIRTUAL TABLE INDEX') for step in plan), plan)
+
+    def test_rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {search.TABLE}')
+        self.assertEqual(self.search(q='rebar'), [])
+        out = io.StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertEqual(out.getvalue().strip(), f'Indexed {Task.objects.count() + Document.objects.count() + Media.objects.count()} object(s).')
+        self.assertEqual(self.search(q='rebar inspection'), [('task', self.task.pk), ('document', self.document.pk)])
+
+    @override_settings(CMS_SEARCH_BACKEND='appcms.search.DatabaseBackend')
+    def test_database_backend(self):
+        self.assertEqual(self.search(q='rebar inspection'), [('task', self.task.pk), ('document', self.document.pk)])
+        self.assertEqual(self.search(q='rebar', project=self.second.pk), [('document', self.document.pk)])
+
+    def test_backends_implement_every_method(self):
+        class Partial(search.SearchBackend):
+            def search(self, words, project=None, kinds=None, limit=20, offset=0):
+                return []
+
+        with self.assertRaises(TypeError):
+            Partial()
+        search.FTS5Backend()
+        search.DatabaseBackend()
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get('/search/').status_code, 400)
+        self.assertEqual(self.client.get('/search/', {'q': '!!'}).status_code, 400)
+        self.assertEqual(self.client.get('/search/', {'q': 'rebar', 'type': 'worker'}).status_code, 400)
+        self.assertEqual(self.client.get('/search/', {'q': 'rebar', 'limit': 'x'}).status_code, 400)
+
+
+class ProjectSummaryTests(AuthenticatedAPITestCase):
+    """ ProjectSummary rows are adjusted with every write and always match a rebuild from the tables """
+
+    def setUp(self):
+        super().setUp()
+        seed_rows(2, 'ps')
+        self.first, self.second = Project.objects.order_by('id')
+        self.task = Task.objects.get(project=self.first)
+        self.worker = self.task.worker
+        self.worker.is_working = True
+        self.worker.save()
+        self.tools = Resource.objects.create(name='Mixer', quantity=10, resource_type=Resource.EQUIPMENT)
+
+    def summary(self, project):
+        response = self.client.get(f'/projects/{project.pk}/summary/')
+        self.assertEqual(response.status_code, 200, response.content)
+        body = response.json()
+        del body['updated_at']
+        return body
+
+    def assertMatchesRebuild(self):
+        stored = [self.summary(project) for project in (self.first, self.second)]
+        summaries.rebuild()
+        self.assertEqual(stored, [self.summary(project) for project in (self.first, self.second)])
+
+    def test_rebuild_counts_and_replaces_in_one_write_transaction(self):
+        queries, opened = [], []
+        write_transaction = sqlite.write_transaction
+
+        @contextlib.contextmanager
+        def recorded_transaction(*args, **kwargs):
+            with write_transaction(*args, **kwargs):
+                opened.append(True)
+                yield
+                opened.pop()
+
+        def record(execute, sql, params, many, context):
+            queries.append((sql.split()[0], bool(opened)))
+            return execute(sql, params, many, context)
+
+        with mock.patch.object(sqlite, 'write_transaction', recorded_transaction), connection.execute_wrapper(record):
+            summaries.rebuild([self.first.pk])
+        self.assertIn(('DELETE', True), queries)
+        statements = [query for query in queries if query[0] in ('SELECT', 'INSERT', 'UPDATE', 'DELETE')]
+        self.assertEqual([query for query in statements if not query[1]], [])
+
+    def test_counts(self):
+        self.assertEqual(self.summary(self.first), {
+            'project': self.first.pk, 'task_count': 1,
+            'quantity_used': {'material': 1, 'equipment': 0, 'labor': 0},
+            'media_count': 1, 'document_count': 1, 'active_workers': 1,
+        })
+        self.assertEqual(self.summary(self.second)['active_workers'], 0)
+
+    def test_incremental_updates_match_rebuild(self):
+        # A second task for the same worker doesn't count the worker twice
+        extra = Task.objects.create(
+            name='Mix', resource=self.tools, quantity_used=3, worker=self.worker, project=self.first, supervisor=self.task.supervisor,
+            start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 2), description='-',
+        )
+        summary = self.summary(self.first)
+        self.assertEqual((summary['task_count'], summary['quantity_used']['equipment'], summary['active_workers']), (2, 3, 1))
+        self.assertMatchesRebuild()
+
+        # Moves between projects, resources and workers
+        extra.project, extra.quantity_used = self.second, 4
+        extra.save()
+        self.task.worker = None
+        self.task.save()
+        document = Document.objects.get(project=self.first)
+        document.project = self.second
+        document.save()
+        Media.objects.get(project=self.second).delete()
+        self.assertEqual(self.summary(self.first)['active_workers'], 0)
+        self.assertEqual(self.summary(self.second)['active_workers'], 1)
+        self.assertMatchesRebuild()
+
+        # The worker stops working, the mixer becomes labor, the worker leaves
+        self.worker.is_working = False
+        self.worker.save()
+        self.assertEqual(self.summary(self.second)['active_workers'], 0)
+        self.tools.resource_type = Resource.LABOR
+        self.tools.save()
+        self.assertEqual(self.summary(self.second)['quantity_used']['labor'], 4)
+        self.worker.is_working = True
+        self.worker.save()
+        self.worker.delete()
+        self.assertMatchesRebuild()
+
+        extra.delete()
+        self.assertMatchesRebuild()
+
+    def test_rolled_back_writes_leave_the_summary_alone(self):
+        before = self.summary(self.first)
+        with contextlib.suppress(RuntimeError), transaction.atomic():
+            self.task.delete()
+            raise RuntimeError
+        self.assertEqual(self.summary(self.first), before)
+
+    def test_bulk_created_tasks_are_counted(self):
+        response = self.client.post('/tasks/bulk/', [{
+            'name': f'Bulk {i}', 'resource': self.tools.pk, 'quantity_used': 2, 'worker': self.worker.pk, 'project': self.first.pk,
+            'supervisor': self.task.supervisor_id, 'start_date': '2025-01-01', 'end_date': '2025-01-02', 'description': '-',
+        } for i in range(3)], format='json')
+        self.assertEqual(response.status_code, 201)
+        summary = self.summary(self.first)
+        self.assertEqual((summary['task_count'], summary['quantity_used']['equipment'], summary['active_workers']), (4, 6, 1))
+        self.assertMatchesRebuild()
+
+    def test_summary_is_one_lookup(self):
+        Task.objects.bulk_create([
+            Task(name=f'Seeded {i}', resource=self.tools, quantity_used=0, project=self.first, supervisor=self.task.supervisor,
+                 start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 2), description='-')
+            for i in range(50)
+        ])
+        with CaptureQueriesContext(connection) as queries:
+            self.summary(self.first)
+        self.assertEqual([query['sql'] for query in queries if 'appcms_task' in query['sql']], [])
+        self.assertEqual(len(queries), 1)
+
+    def test_missing_summary_and_rebuild_command(self):
+        project = self.first.pk
+        ProjectSummary.objects.filter(project_id=project).delete()
+        self.assertEqual(self.summary(self.first)['task_count'], 1)
+        self.assertEqual(self.client.get('/projects/999999/summary/').status_code, 404)
+
+        ProjectSummary.objects.update(task_count=0)
+        out = io.StringIO()
+        call_command('rebuild_project_summaries', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Rebuilt 2 project summary(ies).')
+        self.assertEqual(self.summary(self.first)['task_count'], 1)
+
+        self.first.delete()
+        self.assertFalse(ProjectSummary.objects.filter(project_id=project).exists())
+
+
+class ForecastTests(AuthenticatedAPITestCase):
+    """ /resources/forecast/ spreads task usage over task days and projects stock-outs """
+
+    def setUp(self):
+        object_cache.clear()
+        super().setUp()
+        self.today = timezone.localdate()
+        self.supervisor = Supervisor.objects.create(user=User.objects.create_user('fsup', password='x', role='supervisor'))
+        self.project = Project.objects.create(
+            name='Forecast', location='Site', budget=1000, timeline=datetime.date(2025, 1, 1), supervisor=self.supervisor,
+        )
+        self.cement = Resource.objects.create(name='Cement', quantity=100)
+        self.steel = Resource.objects.create(name='Steel', quantity=100)
+        # 1/day over the whole 28-day window, 1/day over its last week and on into the next,
+        # and one finished before the window
+        self.task(self.cement, 28, -27, 0)
+        self.task(self.cement, 14, -6, 7)
+        self.task(self.cement, 5, -40, -30)
+
+    def task(self, resource, quantity, start, end):
+        return Task.objects.create(
+            name='Pour', resource=resource, quantity_used=quantity, project=self.project, supervisor=self.supervisor,
+            start_date=self.today + datetime.timedelta(days=start), end_date=self.today + datetime.timedelta(days=end),
+            description='-',
+        )
+
+    def forecast(self, **params):
+        response = self.client.get('/resources/forecast/', params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_burn_rates_and_stockout(self):
+        body = self.forecast()
+        self.assertEqual((body['as_of'], body['window'], body['recent']), (self.today.isoformat(), 28, 7))
+        cement, steel = body['results']
+        self.assertEqual(cement, {
+            'id': self.cement.pk, 'name': 'Cement', 'resource_type': 'material', 'balance': 53,
+            'burn_rate': 1.25, 'recent_burn_rate': 2.0, 'days_left': 42.4,
+            'stockout_date': (self.today + datetime.timedelta(days=42)).isoformat(),
+        })
+        self.assertEqual((steel['id'], steel['burn_rate'], steel['days_left'], steel['stockout_date']), (self.steel.pk, 0.0, None, None))
+
+        cement = self.forecast(window=7, recent=7)['results'][0]
+        self.assertEqual((cement['burn_rate'], cement['recent_burn_rate']), (2.0, 2.0))
+
+    def test_matches_a_per_task_loop(self):
+        rng = np.random.default_rng(7)
+        resource_ids = np.array([3, 5, 8], dtype=np.int64)
+        first_day = datetime.date(2025, 3, 1)
+        origin = forecast.epoch_day(first_day)
+        starts = origin + rng.integers(-20, 40, 500)
+        usage = forecast.Usage(rng.choice([3, 5, 8, 9], 500), rng.integers(0, 50, 500), starts, starts + rng.integers(0, 15, 500))
+
+        expected = np.zeros((3, 30))
+        for resource_id, quantity, start, end in zip(*(column.tolist() for column in usage)):
+            if resource_id not in resource_ids:
+                continue
+            for day in range(max(start, origin), min(end, origin + 29) + 1):
+                expected[list(resource_ids).index(resource_id), day - origin] += quantity / (end - start + 1)
+        np.testing.assert_allclose(forecast.daily_consumption(usage, resource_ids, first_day, 30), expected)
+
+    def test_cached_until_tasks_or_stock_change(self):
+        computed = lambda: metrics.snapshot()['forecast.computed']['count']
+        before = computed()
+        self.forecast()
+        self.forecast()
+        self.assertEqual(computed(), before + 1)
+
+        self.task(self.steel, 7, -6, 0)
+        self.assertEqual(self.forecast()['results'][1]['burn_rate'], 0.25)
+        self.assertEqual(computed(), before + 2)
+
+        # A stock change alone moves the projection: 3 left at 0.25/day
+        self.steel.reduce_quantity(90)
+        steel = self.forecast()['results'][0]
+        self.assertEqual((steel['id'], steel['balance'], steel['days_left']), (self.steel.pk, 3, 12.0))
+        self.assertEqual(computed(), before + 3)
+
+    def test_bad_parameters(self):
+        for params in ({'window': 'x'}, {'window': 0}, {'window': 400}, {'window': 7, 'recent': 14}):
+            self.assertEqual(self.client.get('/resources/forecast/', params).status_code, 400, params)
+
+
+class WorkerAvailabilityTests(AuthenticatedAPITestCase):
+    """ Day bitmaps follow task writes; /workers/available/ and /tasks/<pk>/assign/ read them """
+
+    def setUp(self):
+        super().setUp()
+        self.supervisor = Supervisor.objects.create(user=User.objects.create_user('asup', password='x', role='supervisor'))
+        self.project = Project.objects.create(
+            name='Availability', location='Site', budget=1000, timeline=datetime.date(2025, 1, 1), supervisor=self.supervisor,
+        )
+        self.resource = Resource.objects.create(name='Sand', quantity=1000)
+        self.ann, self.bob, self.cyd = (
+            Worker.objects.create(name=name, aadhar_number=f'{i:012d}', is_working=True)
+            for i, name in enumerate(('Ann', 'Bob', 'Cyd'), 1)
+        )
+        self.ann_task = self.task(self.ann, '2025-01-03', '2025-01-10')
+        self.task(self.bob, '2025-01-08', '2025-01-12')
+
+    def task(self, worker, start, end):
+        return Task.objects.create(
+            name='Dig', resource=self.resource, quantity_used=1, worker=worker, project=self.project, supervisor=self.supervisor,
+            start_date=start, end_date=end, description='-',
+        )
+
+    def available(self, start, end, **params):
+        response = self.client.get('/workers/available/', {'start': start, 'end': end, **params})
+        self.assertEqual(response.status_code, 200, response.content)
+        return [(worker['name'], worker['booked_days']) for worker in response.json()['results']]
+
+    def stored(self):
+        return {(row.worker_id, row.year): bytes(row.busy) for row in WorkerAvailability.objects.all()}
+
+    def test_bitmaps(self):
+        self.assertEqual(availability.span_mask(2025, datetime.date(2025, 1, 3), datetime.date(2025, 1, 4)), 0b1100)
+        self.assertEqual(availability.span_mask(2025, datetime.date(2024, 12, 1), datetime.date(2025, 1, 1)), 1)
+        self.assertEqual(availability.span_mask(2024, datetime.date(2024, 12, 31), datetime.date(2025, 1, 1)), 1 << 365)
+        self.assertEqual(availability.span_mask(2026, datetime.date(2024, 1, 1), datetime.date(2025, 1, 1)), 0)
+
+    def test_free_workers(self):
+        self.assertEqual(self.available('2025-01-03', '2025-01-07'), [('Cyd', 0), ('Bob', 5)])
+        self.assertEqual(self.available('2025-01-11', '2025-01-20'), [('Cyd', 0), ('Ann', 8)])
+        self.assertEqual(self.available('2025-01-01', '2025-12-31', limit=1), [('Cyd', 0)])
+        # Least booked first, counting the days booked in every year the range touches
+        self.assertEqual(self.available('2024-12-01', '2025-01-02'), [('Cyd', 0), ('Bob', 5), ('Ann', 8)])
+
+    def test_bitmaps_follow_task_writes(self):
+        # Moved into the next year and across it, handed over, then deleted
+        self.ann_task.start_date, self.ann_task.end_date = datetime.date(2025, 12, 30), datetime.date(2026, 1, 2)
+        self.ann_task.save()
+        self.assertEqual(self.available('2025-01-03', '2025-01-07'), [('Cyd', 0), ('Ann', 2), ('Bob', 5)])
+        self.assertEqual(self.available('2026-01-02', '2026-01-05'), [('Bob', 0), ('Cyd', 0)])
+        self.ann_task.worker = self.cyd
+        self.ann_task.save()
+        self.assertEqual(self.available('2025-12-31', '2025-12-31'), [('Ann', 0), ('Bob', 5)])
+        self.ann_task.delete()
+        self.assertEqual(self.available('2025-12-31', '2025-12-31'), [('Ann', 0), ('Cyd', 0), ('Bob', 5)])
+
+        incremental = self.stored()
+        out = io.StringIO()
+        call_command('rebuild_worker_availability', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Rebuilt 1 worker-year bitmap(s).')
+        self.assertEqual(self.stored(), incremental)
+
+        # A deleted worker's tasks are unassigned and its bitmaps go with it
+        self.bob.delete()
+        self.assertEqual(self.stored(), {})
+
+    def test_bulk_created_tasks_are_booked(self):
+        response = self.client.post('/tasks/bulk/', [{
+            'name': 'Bulk', 'resource': self.resource.pk, 'quantity_used': 1, 'worker': self.cyd.pk, 'project': self.project.pk,
+            'supervisor': self.supervisor.pk, 'start_date': '2025-01-01', 'end_date': '2025-01-31', 'description': '-',
+        }], format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.available('2025-01-20', '2025-01-21'), [('Bob', 5), ('Ann', 8)])
+
+    def test_assign(self):
+        task = self.task(None, '2025-01-09', '2025-01-09')
+        # Ann and Bob are booked that day; Cyd is the only one free
+        response = self.client.post(f'/tasks/{task.pk}/assign/', {}, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['worker'], self.cyd.pk)
+
+        # Booked elsewhere: refused; the task's own days don't count against its worker
+        response = self.client.post(f'/tasks/{task.pk}/assign/', {'worker': self.ann.pk}, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('booked', response.json()['error'])
+        response = self.client.post(f'/tasks/{task.pk}/assign/', {'worker': self.cyd.pk}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+        other = self.task(None, '2025-01-09', '2025-01-10')
+        response = self.client.post(f'/tasks/{other.pk}/assign/', {}, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['error'], 'No worker is free from 2025-01-09 to 2025-01-10.')
+        self.assertEqual(self.client.post(f'/tasks/{other.pk}/assign/', {'worker': 999999}, format='json').status_code, 400)
+        self.assertEqual(self.client.post(f'/tasks/{other.pk}/assign/', {'worker': 'x'}, format='json').status_code, 400)
+
+    def test_workers_not_working_are_not_offered(self):
+        task = self.task(None, '2025-01-09', '2025-01-09')
+        dee = Worker.objects.create(name='Dee', aadhar_number='000000000004')
+        self.assertEqual(self.available('2025-01-09', '2025-01-09'), [('Cyd', 0)])
+
+        Worker.objects.filter(pk=self.cyd.pk).update(is_working=False)
+        self.assertEqual(self.available('2025-01-09', '2025-01-09'), [])
+        response = self.client.post(f'/tasks/{task.pk}/assign/', {}, format='json')
+        self.assertEqual(response.status_code, 409)
+        response = self.client.post(f'/tasks/{task.pk}/assign/', {'worker': dee.pk}, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['error'], f'Worker {dee.pk} is not working.')
+        task.refresh_from_db()
+        self.assertIsNone(task.worker_id)
+
+    def test_bad_ranges(self):
+        for params in ({}, {'start': '2025-01-05'}, {'start': '2025-02-30', 'end': '2025-03-01'},
+                       {'start': '2025-01-05', 'end': '2025-01-01'}, {'start': '2025-01-01', 'end': '2025-01-02', 'limit': 0}):
+            self.assertEqual(self.client.get('/workers/available/', params).status_code, 400, params)
@@ -0,0 +1,124 @@
+"""
+Chunk storage for resumable Media uploads.
+
+A client starts an upload with the file's size and a chunk size, PUTs each
+chunk at its offset (in any order, in parallel, and again after a dropped
+connection), then finalizes. Each chunk is streamed from the request straight
+into its own file under `settings.CMS_UPLOAD_TEMP_DIR`, hashed as it goes and
+checked against the client's SHA-256, so nothing larger than one read buffer
+is ever held in memory and parallel chunks never write to the same file.
+Finalize concatenates the chunk files in offset order into an
+`AssembledFile`, which storages move into place instead of copying.
+"""
+import hashlib
+import os
+import shutil
+import uuid
+
+from django.conf import settings
+from django.core.files import File
+
+READ_SIZE = 64 * 1024
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_UPLOAD_SIZE = 5 * 1024 ** 3
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi')
+
+
+class ChunkError(ValueError):
+    """ Raised when a chunk doesn't match what the upload expects """
+
+
+class AssembledFile(File):
+    """
+    The assembled file on disk, with its SHA-256 and size. Like Django's
+    TemporaryUploadedFile it has a temporary_file_path(), so storages move it
+    into place rather than copying it.
+    """
+
+    def __init__(self, path, name, sha256, size):
+        super().__init__(open(path, 'rb'), name)
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def max_upload_size():
+    return getattr(settings, 'CMS_MAX_UPLOAD_SIZE', DEFAULT_MAX_UPLOAD_SIZE)
+
+
+def upload_dir(upload_id):
+    return os.path.join(settings.CMS_UPLOAD_TEMP_DIR, str(upload_id))
+
+
+def chunk_path(upload_id, offset):
+    return os.path.join(upload_dir(upload_id), f'{offset}.part')
+
+
+def write_chunk(upload, offset, stream, sha256):
+    """
+    Stream one chunk from `stream` to disk and return its length.
+
+    The chunk is written to a private temporary file and only moved into
+    place once its length and digest check out, so a retried or concurrent
+    PUT of the same offset never leaves a torn chunk behind.
+    """
+    if offset not in upload.offsets:
+        raise ChunkError(f"Offset must be a multiple of {upload.chunk_size} below {upload.size}.")
+    expected = upload.chunk_length(offset)
+
+    os.makedirs(upload_dir(upload.id), exist_ok=True)
+    target = chunk_path(upload.id, offset)
+    partial = f'{target}.{uuid.uuid4().hex}'
+    digest = hashlib.sha256()
+    length = 0
+    try:
+        with open(partial, 'wb') as out:
+            while True:
+                block = stream.read(READ_SIZE)
+                if not block:
+                    break
+                length += len(block)
+                if length > expected:
+                    raise ChunkError(f"Chunk at offset {offset} must be {expected} bytes.")
+                digest.update(block)
+                out.write(block)
+        if length != expected:
+            raise ChunkError(f"Chunk at offset {offset} must be {expected} bytes, got {length}.")
+        if digest.hexdigest() != sha256.lower():
+            raise ChunkError(f"Checksum mismatch for chunk at offset {offset}.")
+        os.replace(partial, target)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return length
+
+
+def assemble(upload):
+    """ Concatenate the chunks into one file and return it as an AssembledFile, verifying `upload.sha256` if set """
+    path = os.path.join(upload_dir(upload.id), f'assembled.{uuid.uuid4().hex}')
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'wb') as out:
+        for offset in upload.offsets:
+            with open(chunk_path(upload.id, offset), 'rb') as chunk:
+                while True:
+                    block = chunk.read(READ_SIZE)
+                    if not block:
+                        break
+                    digest.update(block)
+                    out.write(block)
+                    size += len(block)
+
+    if upload.sha256 and digest.hexdigest() != upload.sha256.lower():
+        os.remove(path)
+        raise ChunkError("Checksum mismatch for the assembled file.")
+    return AssembledFile(path, upload.filename, digest.hexdigest(), size)
+
+
+def discard(upload_id):
+    """ Remove everything stored for an upload """
+    shutil.rmtree(upload_dir(upload_id), ignore_errors=True)
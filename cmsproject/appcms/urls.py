@@ -1,5 +1,6 @@
 from django.urls import path
-from .views import ManagerRegisterView, SupervisorRegisterView, ManagerProfileView, DocumentViewSet, CustomAuthToken, ProjectViewSet, TaskViewSet, ResourceViewSet, WorkerViewSet, MediaViewSet
+from .views import ManagerRegisterView, SupervisorRegisterView, BulkRegisterView, ManagerProfileView, DocumentViewSet, CustomAuthToken, MetricsView, SearchView, SyncView, ProjectViewSet, TaskViewSet, ResourceViewSet, WorkerViewSet, MediaViewSet, MediaUploadViewSet, FileView
+from .async_views import LIST_VIEWSETS, AsyncListView, AsyncManagerProfileView, AsyncMediaUploadView, AsyncDocumentUploadView
 from django.conf import settings
 from django.conf.urls.static import static
 
@@ -7,30 +8,59 @@ urlpatterns = [
     # Register endpoints
     path('register/manager/', ManagerRegisterView.as_view(), name='manager-register'),
     path('register/supervisor/', SupervisorRegisterView.as_view(), name='supervisor-register'),
+    path('register/bulk/', BulkRegisterView.as_view(), name='bulk-register'),
     path('login/', CustomAuthToken.as_view(), name='login'),
     path('profile/', ManagerProfileView.as_view(), name='manager-profile'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    path('sync/', SyncView.as_view(), name='sync'),
+    path('search/', SearchView.as_view(), name='search'),
 
     # Projects endpoints
     path('projects/', ProjectViewSet.as_view({'get': 'list', 'post': 'create'}), name='project-list'),
     path('projects/<int:pk>/', ProjectViewSet.as_view({'get': 'retrieve', 'put': 'update', 'delete': 'destroy'}), name='project-detail'),
+    path('projects/<int:pk>/summary/', ProjectViewSet.as_view({'get': 'summary'}), name='project-summary'),
 
     # Tasks endpoints
     path('tasks/', TaskViewSet.as_view({'get': 'list', 'post': 'create'}), name='task-list'),
+    path('tasks/bulk/', TaskViewSet.as_view({'post': 'bulk'}), name='task-bulk'),
     path('tasks/<int:pk>/', TaskViewSet.as_view({'get': 'retrieve', 'put': 'update', 'delete': 'destroy'}), name='task-detail'),
+    path('tasks/<int:pk>/assign/', TaskViewSet.as_view({'post': 'assign'}), name='task-assign'),
 
     # Resources endpoints
     path('resources/', ResourceViewSet.as_view({'get': 'list', 'post': 'create'}), name='resource-list'),
+    path('resources/forecast/', ResourceViewSet.as_view({'get': 'forecast'}), name='resource-forecast'),
     path('resources/<int:pk>/', ResourceViewSet.as_view({'get': 'retrieve', 'put': 'update', 'delete': 'destroy'}), name='resource-detail'),
+    path('resources/<int:pk>/reduce/', ResourceViewSet.as_view({'post': 'reduce'}), name='resource-reduce'),
+    path('resources/<int:pk>/restore/', ResourceViewSet.as_view({'post': 'restore'}), name='resource-restore'),
+    path('resources/<int:pk>/balance/', ResourceViewSet.as_view({'get': 'balance'}), name='resource-balance'),
 
     # Workers endpoints
     path('workers/', WorkerViewSet.as_view({'get': 'list', 'post': 'create'}), name='worker-list'),
+    path('workers/import/', WorkerViewSet.as_view({'post': 'import_file'}), name='worker-import'),
+    path('workers/available/', WorkerViewSet.as_view({'get': 'available'}), name='worker-available'),
     path('workers/<int:pk>/', WorkerViewSet.as_view({'get': 'retrieve', 'put': 'update', 'delete': 'destroy'}), name='worker-detail'),
 
     # Documents endpoints
     path('documents/', DocumentViewSet.as_view({'get': 'list', 'post': 'create'}), name='document-list'),
 
+    # Media endpoints
+    path('media/', MediaViewSet.as_view({'get': 'list'}), name='media-list'),
     # Media upload endpoint (Custom action)
     path('media/upload/', MediaViewSet.as_view({'post': 'upload_media'}), name='upload-media'),
+    # Resumable chunked uploads
+    path('media/uploads/', MediaUploadViewSet.as_view({'post': 'create'}), name='media-upload-list'),
+    path('media/uploads/<uuid:pk>/', MediaUploadViewSet.as_view({'get': 'retrieve', 'delete': 'destroy'}), name='media-upload-detail'),
+    path('media/uploads/<uuid:pk>/chunks/<int:offset>/', MediaUploadViewSet.as_view({'put': 'chunk'}), name='media-upload-chunk'),
+    path('media/uploads/<uuid:pk>/finalize/', MediaUploadViewSet.as_view({'post': 'finalize'}), name='media-upload-finalize'),
+
+    # Uploaded files, with Range support and permission checks
+    path('files/<str:kind>/<int:pk>/<str:field>/', FileView.as_view(), name='file'),
+
+    # Native async versions of the I/O-heavy endpoints, for ASGI deployments
+    *[path(f'async/{name}/', AsyncListView.as_view(viewset_class=viewset), name=f'async-{name}-list') for name, viewset in LIST_VIEWSETS.items()],
+    path('async/profile/', AsyncManagerProfileView.as_view(), name='async-manager-profile'),
+    path('async/media/upload/', AsyncMediaUploadView.as_view(), name='async-upload-media'),
+    path('async/documents/upload/', AsyncDocumentUploadView.as_view(), name='async-upload-document'),
 ]
 
 # Serve static files during development if DEBUG is True
@@ -2,17 +2,206 @@ from rest_framework import generics, viewsets, permissions, status
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 from rest_framework.authtoken.views import ObtainAuthToken
-from .models import Manager, Supervisor, Project, Task, User, Resource, Worker, Document, Media
-from .serializers import ManagerSerializer, SupervisorSerializer, UserSerializer, ProjectSerializer, TaskSerializer, ResourceSerializer, WorkerSerializer, DocumentSerializer, MediaSerializer
+from .models import ChangeLog, Manager, Supervisor, Project, ProjectSummary, Task, User, Resource, ResourceMovement, Worker, Document, Media, MediaUpload, MediaUploadChunk
+from .serializers import ManagerSerializer, SupervisorSerializer, UserSerializer, ProjectSerializer, TaskSerializer, ResourceSerializer, WorkerSerializer, DocumentSerializer, MediaSerializer, MediaUploadSerializer, requested_fields
 from django.db import IntegrityError, transaction
+from django.db.models import Count, Max, Prefetch
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import http_date
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.exceptions import ValidationError, NotFound
 from rest_framework.decorators import action
 from .permissions import IsManager  # Custom permission for Manager access only
+from .authentication import get_principal
+from .cache import object_cache
+from . import availability, derivatives, files, filters, forecast, inventory, metrics, onboarding, search, sqlite, summaries, sync, uploads, worker_import
+import hashlib
+import io
 import logging
 # Setup logging
 logger = logging.getLogger(__name__)
 
+
+# Conditional GET mixin
+class ConditionalGetMixin:
+    """
+    ETag / Last-Modified on list and retrieve. Validators come from a single
+    aggregate over `updated_at` rather than from the rendered body, so an
+    If-None-Match or If-Modified-Since hit is answered with a 304 before the
+    page is loaded or serialized. Lists fold in the row count so deletions
+    change the ETag; expanded relations fold in their own tables' state.
+    """
+
+    def list(self, request, *args, **kwargs):
+        # A deletion doesn't move max(updated_at), so lists are validated by ETag only
+        return self._conditional(request, self.list_validators(request), None, super().list, *args, **kwargs)
+
+    def list_validators(self, request):
+        queryset = self.filter_queryset(self.queryset.all()).order_by()
+        state = queryset.aggregate(last=Max('updated_at'), count=Count('pk'))
+        validators = [state['count'], state['last'], *self.get_list_validators(queryset)]
+        return validators + self._expanded_validators(request)
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = self.kwargs[self.lookup_url_kwarg or self.lookup_field]
+        last = self.queryset.filter(**{self.lookup_field: pk}).values_list('updated_at', flat=True).first()
+        if last is None:
+            # Let the normal path produce the 404
+            return super().retrieve(request, *args, **kwargs)
+        last = max([last, *self.get_object_validators(pk)])
+        validators = [pk, last, *self._expanded_validators(request)]
+        return self._conditional(request, validators, last, super().retrieve, *args, **kwargs)
+
+    def get_list_validators(self, queryset):
+        """ Extra state the list depends on that `updated_at` doesn't capture """
+        return []
+
+    def get_object_validators(self, pk):
+        """ Extra modification times for one object that `updated_at` doesn't capture """
+        return []
+
+    def _expanded_validators(self, request):
+        _, _, expand = requested_fields(request)
+        validators = []
+        for name in sorted(expand & getattr(self, 'expand_related', {}).keys()):
+            related = self.queryset.model._meta.get_field(name).related_model
+            field = 'updated_at' if any(f.name == 'updated_at' for f in related._meta.concrete_fields) else 'pk'
+            state = related._default_manager.aggregate(last=Max(field), count=Count('pk'))
+            validators += [name, state['count'], state['last']]
+        return validators
+
+    def _conditional(self, request, validators, last_modified, handler, *args, **kwargs):
+        etag = validators_etag(request, validators)
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is not None:
+            return response
+        return set_validators(handler(request, *args, **kwargs), etag, timestamp)
+
+
+def validators_etag(request, validators):
+    """ Weak ETag over `validators`, for the representation this request asks for """
+    # Representation varies with the query string (fields, cursor, ...) and the negotiated format
+    key = repr([request.get_full_path(), request.META.get('HTTP_ACCEPT', ''), *validators])
+    return f'W/"{hashlib.md5(key.encode()).hexdigest()}"'
+
+
+def set_validators(response, etag, timestamp=None):
+    if response.status_code == status.HTTP_200_OK:
+        response['ETag'] = etag
+        if timestamp is not None:
+            response['Last-Modified'] = http_date(timestamp)
+        # Clients may keep the body but must revalidate before reusing it
+        response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# Cached read mixin
+class CachedReadMixin:
+    """
+    Serves retrieve and list through the read-through object cache. Requests
+    that expand relations bypass it, since those read other tables.
+    `cache_queryset` is what an object is loaded from on a miss.
+    """
+    cache_queryset = None
+
+    def _use_cache(self):
+        _, _, expand = requested_fields(self.request)
+        return self.request.method in ('GET', 'HEAD') and not expand
+
+    def get_object(self):
+        if not self._use_cache():
+            return super().get_object()
+
+        pk = str(self.kwargs[self.lookup_url_kwarg or self.lookup_field])
+        queryset = self.cache_queryset if self.cache_queryset is not None else self.queryset
+
+        def load():
+            return get_object_or_404(queryset.all(), **{self.lookup_field: pk})
+
+        obj = object_cache.get_object(queryset.model, pk, load)
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    def list(self, request, *args, **kwargs):
+        if not self._use_cache():
+            return super().list(request, *args, **kwargs)
+
+        def load():
+            return super(CachedReadMixin, self).list(request, *args, **kwargs).data
+
+        return Response(object_cache.get_list(self.queryset.model, request.build_absolute_uri(), load))
+
+
+# Sparse fieldset mixin
+class SparseFieldsetMixin:
+    """
+    Shapes a viewset's queryset to what the request renders (see
+    DynamicFieldsMixin): columns that weren't asked for are deferred, and
+    relations are only loaded when they are expanded. `expand_related` maps an
+    expandable relation to a select_related path, or to a Prefetch when the
+    nested serializer needs more than a join. `field_columns` lists the
+    columns behind rendered fields that aren't columns themselves.
+    """
+    expand_related = {}
+    field_columns = {}
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        only, exclude, expand = requested_fields(self.request)
+        expand = expand & self.expand_related.keys()
+
+        for name in sorted(expand):
+            lookup = self.expand_related[name]
+            if isinstance(lookup, Prefetch):
+                queryset = queryset.prefetch_related(lookup)
+            else:
+                queryset = queryset.select_related(lookup)
+
+        model = queryset.model
+        columns = {field.name for field in model._meta.concrete_fields}
+        # Always load the primary key, the pagination key and anything being expanded
+        required = {model._meta.pk.name} | expand
+        required |= {term.lstrip('-') for term in filters.keyset_ordering(self) or ()}
+        for name, needs in self.field_columns.items():
+            if (only is None or name in only) and name not in exclude:
+                required |= set(needs)
+
+        if only is not None:
+            queryset = queryset.only(*((only & columns) | required))
+        elif exclude & columns:
+            queryset = queryset.defer(*((exclude & columns) - required))
+        return queryset
+
+
+def overloaded_response(error):
+    """ 503 telling the client when to retry, for registrations turned away by the hashing pool """
+    response = Response({"error": str(error)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = str(onboarding.RETRY_AFTER)
+    return response
+
+
+def busy_response():
+    """ 503 for a write that kept finding the database locked """
+    response = Response({"error": "The database is busy; please retry."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = '1'
+    return response
+
+
+class LockRetryMixin:
+    """ Answers 503 rather than 500 when a write is still locked out after sqlite.retry_on_lock's retries """
+
+    def handle_exception(self, exc):
+        if sqlite.is_lock_error(exc):
+            return busy_response()
+        return super().handle_exception(exc)
+
+
 # Manager Registration View
 class ManagerRegisterView(generics.CreateAPIView):
     queryset = Manager.objects.all()
@@ -56,6 +245,8 @@ class ManagerRegisterView(generics.CreateAPIView):
             return Response({
                 "error": "User or manager profile could not be created due to integrity issues."
             }, status=status.HTTP_400_BAD_REQUEST)
+        except onboarding.Overloaded as e:
+            return overloaded_response(e)
 
 
 # Supervisor Registration View
@@ -69,8 +260,11 @@ class SupervisorRegisterView(generics.CreateAPIView):
         # Validate user data
         user_serializer = UserSerializer(data=user_data)
         user_serializer.is_valid(raise_exception=True)
-        user = user_serializer.save()  # Create the user
-        
+        try:
+            user = user_serializer.save()  # Create the user
+        except onboarding.Overloaded as e:
+            return overloaded_response(e)
+
         # Create the supervisor profile
         supervisor = Supervisor.objects.create(user=user)
 
@@ -84,6 +278,50 @@ class SupervisorRegisterView(generics.CreateAPIView):
         }, status=status.HTTP_201_CREATED)
 
 
+# Bulk Registration View
+class BulkRegisterView(generics.GenericAPIView):
+    permission_classes = [IsAuthenticated, IsManager]
+
+    def post(self, request):
+        """
+        Register a batch of managers and supervisors, each with a token.
+
+        Accepts either a list of users or {"mode": ..., "users": [...]}; each
+        user has username, password and role, and managers also need
+        department and phone_number. In 'atomic' mode (the default) nothing
+        is created unless every user is valid; in 'partial' mode the valid
+        ones are created and the rest reported.
+        """
+        payload = request.data
+        mode = request.query_params.get('mode', 'atomic')
+        if isinstance(payload, dict):
+            mode = payload.get('mode', mode)
+            payload = payload.get('users')
+
+        if mode not in ('atomic', 'partial'):
+            return Response({"error": "Mode must be 'atomic' or 'partial'."}, status=status.HTTP_400_BAD_REQUEST)
+        if not isinstance(payload, list) or not payload:
+            return Response({"error": "A non-empty list of users is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            results, created = onboarding.onboard(payload, mode)
+        except onboarding.Overloaded as e:
+            return overloaded_response(e)
+        except IntegrityError:
+            # A username was taken between the check and the insert
+            return Response({"error": "Some usernames were registered meanwhile; please retry."}, status=status.HTTP_409_CONFLICT)
+
+        for index, result in enumerate(results):
+            if result is None:
+                # Valid entry held back because another entry in the atomic batch failed
+                results[index] = {"index": index, "status": "skipped"}
+        return Response({
+            "created": sum(1 for result in results if result['status'] == 'created'),
+            "failed": sum(1 for result in results if result['status'] == 'error'),
+            "results": results,
+        }, status=status.HTTP_201_CREATED if created else status.HTTP_400_BAD_REQUEST)
+
+
 # Custom Auth Token View
 class CustomAuthToken(ObtainAuthToken):
     def post(self, request, *args, **kwargs):
@@ -96,9 +334,10 @@ class CustomAuthToken(ObtainAuthToken):
 
 
 # Project Viewset
-class ProjectViewSet(viewsets.ModelViewSet):
+class ProjectViewSet(ConditionalGetMixin, CachedReadMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = Project.objects.all()
     serializer_class = ProjectSerializer
+    expand_related = {'supervisor': 'supervisor'}
 
     def perform_create(self, serializer):
         supervisor_id = self.request.data.get('supervisor')
@@ -109,24 +348,59 @@ class ProjectViewSet(viewsets.ModelViewSet):
         # Ensure the supervisor is set correctly in the project instance
         serializer.save(supervisor=supervisor)
 
+    @action(detail=True, methods=['get'])
+    def summary(self, request, pk=None):
+        """ Dashboard totals from the project's ProjectSummary row, kept current by appcms.summaries """
+        summary = ProjectSummary.objects.filter(project_id=pk).first()
+        if summary is None:
+            # No row yet (a project saved without signals): count it now
+            self.get_object()
+            summaries.rebuild([pk])
+            summary = ProjectSummary.objects.get(project_id=pk)
+        return self._conditional(request, [pk, summary.updated_at], summary.updated_at, lambda request: Response({
+            "project": summary.project_id,
+            "task_count": summary.task_count,
+            "quantity_used": {resource_type: getattr(summary, field) for resource_type, field in summaries.USED_FIELDS.items()},
+            "media_count": summary.media_count,
+            "document_count": summary.document_count,
+            "active_workers": summary.active_workers,
+            "updated_at": summary.updated_at,
+        }))
+
 # Resource Viewset
-class ResourceViewSet(viewsets.ModelViewSet):
+class ResourceViewSet(LockRetryMixin, ConditionalGetMixin, CachedReadMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = Resource.objects.all()
     serializer_class = ResourceSerializer
+    cache_queryset = Resource.objects.with_balance()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        # The live balance is a subquery; skip it when quantity isn't rendered
+        only, exclude, _ = requested_fields(self.request)
+        if 'quantity' in exclude or (only is not None and 'quantity' not in only):
+            return queryset
+        return queryset.with_balance()
+
+    # Stock changes are ledger inserts that leave the resource row alone
+    def get_list_validators(self, queryset):
+        return [ResourceMovement.objects.aggregate(last=Max('id'))['last']]
+
+    def get_object_validators(self, pk):
+        last = ResourceMovement.objects.filter(resource_id=pk).aggregate(last=Max('created_at'))['last']
+        return [last] if last else []
 
     @action(detail=True, methods=['post'])
     def reduce(self, request, pk=None):
         resource = self.get_object()
-        amount = request.data.get('amount')
-        
-        if not amount:
-            return Response({"error": "Amount is required"}, status=status.HTTP_400_BAD_REQUEST)
+        amount, error = self._get_amount(request)
+        if error:
+            return error
 
         try:
             resource.reduce_quantity(amount)
             return Response({
                 "message": "Quantity reduced successfully",
-                "quantity": resource.quantity
+                "quantity": resource.balance
             }, status=status.HTTP_200_OK)
         
         except ValueError as e:
@@ -135,24 +409,69 @@ class ResourceViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['post'])
     def restore(self, request, pk=None):
         resource = self.get_object()
-        amount = request.data.get('amount')
-        
-        if not amount:
-            return Response({"error": "Amount is required"}, status=status.HTTP_400_BAD_REQUEST)
+        amount, error = self._get_amount(request)
+        if error:
+            return error
 
         try:
             resource.restore_quantity(amount)
             return Response({
                 "message": "Quantity restored successfully",
-                "quantity": resource.quantity
+                "quantity": resource.balance
             }, status=status.HTTP_200_OK)
         
         except ValueError as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=True, methods=['get'])
+    def balance(self, request, pk=None):
+        """ Live balance, or the balance at ?at=<ISO datetime> from the ledger """
+        resource = self.get_object()
+        at = request.query_params.get('at')
+        if not at:
+            return Response({"id": resource.id, "quantity": resource.balance})
+
+        when = parse_datetime(at)
+        if when is None:
+            return Response({"error": "'at' must be an ISO 8601 datetime."}, status=status.HTTP_400_BAD_REQUEST)
+        if timezone.is_naive(when):
+            when = timezone.make_aware(when)
+
+        quantity = inventory.balance_at(resource.id, when)
+        if quantity is None:
+            return Response({"error": "No ledger history for this resource at that time."}, status=status.HTTP_404_NOT_FOUND)
+        return Response({"id": resource.id, "quantity": quantity, "at": when})
+
+    @action(detail=False, methods=['get'])
+    def forecast(self, request):
+        """ Burn rates and projected stock-out dates for every resource; ?window= and ?recent= in days """
+        try:
+            window = int(request.query_params.get('window', forecast.window_days()))
+            recent = int(request.query_params.get('recent', forecast.recent_days()))
+        except ValueError:
+            return Response({"error": "window and recent must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= recent <= window <= forecast.MAX_WINDOW_DAYS:
+            return Response(
+                {"error": f"Need 1 <= recent <= window <= {forecast.MAX_WINDOW_DAYS} days."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(forecast.forecast(window=window, recent=recent))
+
+    def _get_amount(self, request):
+        amount = request.data.get('amount')
+        if not amount:
+            return None, Response({"error": "Amount is required"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            amount = int(amount)
+        except (TypeError, ValueError):
+            amount = 0
+        if amount <= 0:
+            return None, Response({"error": "Amount must be a positive integer"}, status=status.HTTP_400_BAD_REQUEST)
+        return amount, None
+
 
 # Worker Viewset
-class WorkerViewSet(viewsets.ModelViewSet):
+class WorkerViewSet(ConditionalGetMixin, CachedReadMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = Worker.objects.all()
     serializer_class = WorkerSerializer
     permission_classes = [IsAuthenticated]  # Only authenticated users can access the API
@@ -178,72 +497,310 @@ class WorkerViewSet(viewsets.ModelViewSet):
         # If the validation passes, proceed with normal creation
         return super().create(request, *args, **kwargs)
 
+    @action(detail=False, methods=['get'])
+    def available(self, request):
+        """ Working workers free on every day from ?start= to ?end= (dates), least booked first; ?limit= up to 100 """
+        try:
+            start = parse_date(request.query_params.get('start', ''))
+            end = parse_date(request.query_params.get('end', ''))
+            limit = int(request.query_params.get('limit', 20))
+        except ValueError:
+            start = end = None
+        if start is None or end is None:
+            return Response({"error": "start and end must be dates (YYYY-MM-DD), limit an integer."}, status=status.HTTP_400_BAD_REQUEST)
+        if end < start or limit < 1:
+            return Response({"error": "end can't be before start, and limit must be positive."}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({"start": start, "end": end, "results": availability.free_workers(start, end, limit=limit)})
+
+    @action(detail=False, methods=['post'])
+    def import_file(self, request):
+        """
+        Create workers from a CSV (text/csv) or NDJSON (application/x-ndjson)
+        request body. The body is read as a stream, never buffered whole.
+
+        ?mode=partial (the default) creates every valid row, committing a
+        chunk at a time; ?mode=atomic creates nothing unless every row is
+        valid. Either way the response lists each rejected row with its
+        errors.
+        """
+        mode = request.query_params.get('mode', 'partial')
+        if mode not in ('atomic', 'partial'):
+            return Response({"error": "Mode must be 'atomic' or 'partial'."}, status=status.HTTP_400_BAD_REQUEST)
+        fmt = worker_import.FORMATS.get(request.content_type.split(';')[0].strip().lower())
+        if fmt is None:
+            return Response(
+                {"error": "Send the file as text/csv or application/x-ndjson."},
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            )
+
+        try:
+            report = worker_import.import_workers(worker_import.read_rows(request.stream or io.BytesIO(), fmt), mode)
+        except worker_import.ImportFileError as e:
+            # Partial mode keeps the chunks committed before the error
+            return Response({"error": str(e), "created": e.report['created'] if e.report else 0}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(report, status=status.HTTP_201_CREATED if report['created'] else status.HTTP_400_BAD_REQUEST)
+
 # Task Viewset
-class TaskViewSet(viewsets.ModelViewSet):
+class TaskViewSet(LockRetryMixin, ConditionalGetMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = Task.objects.all()
     serializer_class = TaskSerializer
+    filter_fields = {
+        'project': 'project',
+        'supervisor': 'supervisor',
+        'worker': 'worker',
+        'resource': 'resource',
+        **filters.date_range('start_date'),
+        **filters.date_range('end_date'),
+    }
+    ordering_fields = ('id', 'start_date', 'end_date')
+    expand_related = {
+        # The nested resource reports its live balance, so fetch it annotated
+        'resource': Prefetch('resource', queryset=Resource.objects.with_balance()),
+        'worker': 'worker',
+        'project': 'project',
+        'supervisor': 'supervisor',
+    }
+    field_columns = {'image_thumb': ('image', 'image_variants'), 'image_medium': ('image', 'image_variants')}
 
-    def perform_create(self, serializer):
-        resource = serializer.validated_data.get('resource')
-        quantity_used = serializer.validated_data.get('quantity_used')
+    # An expanded resource reports its live balance, which changes without touching any row
+    def get_list_validators(self, queryset):
+        if 'resource' in requested_fields(self.request)[2]:
+            return [ResourceMovement.objects.aggregate(last=Max('id'))['last']]
+        return []
 
-        # Ensure that the resource has enough quantity
-        if resource.quantity < quantity_used:
-            raise ValidationError(f"Insufficient quantity for resource {resource.name}. Available: {resource.quantity}")
+    def get_object_validators(self, pk):
+        if 'resource' in requested_fields(self.request)[2]:
+            last = ResourceMovement.objects.order_by('-id').values_list('created_at', flat=True).first()
+            return [last] if last else []
+        return []
 
-        # Use a transaction to lock the resource and ensure atomicity
-        with transaction.atomic():
+    # Stock is taken, adjusted and given back by Task.save()/delete() through the
+    # inventory engine; the hooks only turn its errors into API errors, and
+    # start the transaction again if SQLite's write lock timed out.
+    @action(detail=True, methods=['post'])
+    @sqlite.retry_on_lock
+    def assign(self, request, pk=None):
+        """ Assign {"worker": <id>} to the task if free for its days, or with no worker given, the least booked free one """
+        task = self.get_object()
+        worker = request.data.get('worker')
+        if worker in (None, ''):
+            worker = None
+        else:
             try:
-                resource = Resource.objects.select_for_update().get(id=resource.id)
-            except Resource.DoesNotExist:
-                raise ValidationError(f"Resource {resource.name} does not exist.")
-            
-            if resource.quantity < quantity_used:
-                raise ValidationError(f"Insufficient quantity for resource {resource.name}. Available: {resource.quantity}")
-
-            resource.quantity -= quantity_used
-            resource.save()
+                worker = int(worker)
+            except (TypeError, ValueError):
+                return Response({"error": "worker must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            task = availability.assign(task.pk, worker)
+        except Worker.DoesNotExist as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+        return Response(self.get_serializer(task).data)
 
+    @sqlite.retry_on_lock
+    def perform_create(self, serializer):
+        try:
             serializer.save()
+        except (ValueError, Resource.DoesNotExist) as e:
+            raise ValidationError(str(e))
 
+    @sqlite.retry_on_lock
     def perform_update(self, serializer):
-        resource = serializer.validated_data.get('resource')
-        quantity_used = serializer.validated_data.get('quantity_used')
+        try:
+            serializer.save()
+        except (ValueError, Resource.DoesNotExist) as e:
+            raise ValidationError(str(e))
 
-        if resource and quantity_used is not None:
-            old_quantity_used = serializer.instance.quantity_used if serializer.instance else 0
+    @sqlite.retry_on_lock
+    def perform_destroy(self, instance):
+        try:
+            instance.delete()
+        except (ValueError, Resource.DoesNotExist) as e:
+            raise ValidationError(str(e))
 
-            if quantity_used != old_quantity_used:
-                if resource.quantity < quantity_used:
-                    raise ValidationError(f"Insufficient quantity for resource {resource.name}. Available: {resource.quantity}")
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        Create a batch of tasks in one request.
 
-                with transaction.atomic():
-                    try:
-                        resource = Resource.objects.select_for_update().get(id=resource.id)
-                    except Resource.DoesNotExist:
-                        raise ValidationError(f"Resource {resource.name} does not exist.")
+        Accepts either a list of tasks or {"mode": ..., "tasks": [...]}. In
+        'atomic' mode (the default) nothing is created unless every task is
+        valid and every resource can cover its share of the batch; in
+        'partial' mode the tasks that fit are created and the rest reported.
+        Each affected resource is locked once, in id order.
+        """
+        payload = request.data
+        mode = request.query_params.get('mode', 'atomic')
+        if isinstance(payload, dict):
+            mode = payload.get('mode', mode)
+            payload = payload.get('tasks')
 
-                    if quantity_used > old_quantity_used:
-                        resource.quantity -= (quantity_used - old_quantity_used)
-                    else:
-                        resource.quantity += (old_quantity_used - quantity_used)
-                    resource.save()
+        if mode not in ('atomic', 'partial'):
+            return Response({"error": "Mode must be 'atomic' or 'partial'."}, status=status.HTTP_400_BAD_REQUEST)
+        if not isinstance(payload, list) or not payload:
+            return Response({"error": "A non-empty list of tasks is required."}, status=status.HTTP_400_BAD_REQUEST)
 
-        serializer.save()
+        # Validate every item up front
+        results = [None] * len(payload)
+        valid = []
+        for index, item in enumerate(payload):
+            serializer = self.get_serializer(data=item)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+            else:
+                results[index] = {"index": index, "status": "error", "errors": serializer.errors}
 
-    def perform_destroy(self, instance):
-        if instance.resource:
-            resource = instance.resource
-            with transaction.atomic():
-                try:
-                    resource = Resource.objects.select_for_update().get(id=resource.id)
-                except Resource.DoesNotExist:
-                    raise ValidationError(f"Resource {resource.name} does not exist.")
-                
-                resource.quantity += instance.quantity_used
-                resource.save()
+        if mode == 'atomic' and len(valid) < len(payload):
+            return self._bulk_response(results, created=False)
+
+        try:
+            accepted, tasks = self._bulk_transaction(valid, results, mode)
+        except inventory.InsufficientQuantity as e:
+            # Stock moved underneath us on a backend where select_for_update is a no-op
+            return Response({"error": f"{e} Stock changed during the batch; please retry."}, status=status.HTTP_409_CONFLICT)
+
+        for (index, _), task in zip(accepted, tasks):
+            results[index] = {"index": index, "status": "created", "id": task.id}
+
+        return self._bulk_response(results, created=bool(tasks))
+
+    @sqlite.retry_on_lock
+    def _bulk_transaction(self, valid, results, mode):
+        with sqlite.write_transaction():
+            return self._bulk_insert(valid, results, mode)
+
+    def _bulk_insert(self, valid, results, mode):
+        """ Lock, allocate and insert the valid items; returns (accepted, created tasks) """
+        # Lock each affected resource once, in a fixed order to avoid deadlocks
+        resource_ids = sorted({data['resource'].id for _, data in valid})
+        resources = {
+            resource.id: resource
+            for resource in Resource.objects.with_balance().select_for_update().filter(id__in=resource_ids).order_by('id')
+        }
+
+        accepted = []
+        totals = {}
+        for index, data in valid:
+            resource = resources.get(data['resource'].id)
+            if resource is None:
+                results[index] = {"index": index, "status": "error", "errors": {"resource": ["Resource does not exist."]}}
+                continue
+
+            total = totals.get(resource.id, 0) + data['quantity_used']
+            if total > resource.balance:
+                results[index] = {
+                    "index": index,
+                    "status": "error",
+                    "errors": {"quantity_used": [
+                        f"Insufficient quantity for resource {resource.name}. Available: {resource.balance - totals.get(resource.id, 0)}"
+                    ]},
+                }
+                continue
+
+            totals[resource.id] = total
+            accepted.append((index, data))
+
+        if mode == 'atomic' and len(accepted) < len(valid):
+            return [], []
+
+        # bulk_create bypasses Task.save(), so the stock is recorded here instead:
+        # one guarded ledger write per resource, with a movement per task
+        tasks = Task.objects.bulk_create([Task(**data) for _, data in accepted])
+        ChangeLog.record(Task, [task.id for task in tasks])
+        search.index(Task, tasks)
+        summaries.tasks_changed([(None, summaries.task_state(task)) for task in tasks])
+        availability.tasks_changed([(None, availability.booking(task)) for task in tasks])
+        movements = {}
+        for task in tasks:
+            movements.setdefault(task.resource_id, []).append((-task.quantity_used, ResourceMovement.TASK, task.id))
+        for resource_id in sorted(movements):
+            inventory.record(resource_id, movements[resource_id], expected=resources[resource_id].balance)
+        return accepted, tasks
+
+    def _bulk_response(self, results, created):
+        for index, result in enumerate(results):
+            if result is None:
+                # Valid item held back because another item in the atomic batch failed
+                results[index] = {"index": index, "status": "skipped"}
+
+        return Response({
+            "created": sum(1 for result in results if result['status'] == 'created'),
+            "failed": sum(1 for result in results if result['status'] == 'error'),
+            "results": results,
+        }, status=status.HTTP_201_CREATED if created else status.HTTP_400_BAD_REQUEST)
 
-        instance.delete()
+
+# Metrics View
+class MetricsView(generics.GenericAPIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        return Response(metrics.snapshot())
+
+
+# Search View
+class SearchView(generics.GenericAPIView):
+    """
+    Ranked full-text search over task names and descriptions, document titles
+    and media descriptions: ?q=<words>, optionally &project=<id> and
+    &type=task,document,media; paged with &limit= (up to 100) and &offset=.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        query = request.query_params.get('q', '')
+        if not search.terms(query):
+            return Response({"error": "A search query (q) is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        kinds = {kind.strip() for kind in request.query_params.get('type', '').split(',') if kind.strip()}
+        if kinds - search.KINDS.keys():
+            return Response(
+                {"error": f"Type must be one of: {', '.join(search.KINDS)}."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            project = request.query_params.get('project')
+            project = int(project) if project else None
+            limit = int(request.query_params.get('limit', 20))
+            offset = int(request.query_params.get('offset', 0))
+        except ValueError:
+            return Response({"error": "project, limit and offset must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1 or offset < 0:
+            return Response({"error": "limit must be positive and offset not negative."}, status=status.HTTP_400_BAD_REQUEST)
+
+        limit = min(limit, search.MAX_LIMIT)
+        results = search.search(query, project=project, kinds=kinds, limit=limit, offset=offset)
+        return Response({"query": query, "results": results, "has_more": len(results) == limit})
+
+
+# Sync View
+class SyncView(generics.GenericAPIView):
+    """
+    Everything created, updated or deleted since ?since=<watermark>, plus the
+    watermark to send next time. Follow up while has_more is true. A watermark
+    older than the retained log gets 410 with the watermark to resync from.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        try:
+            since = int(request.query_params.get('since', 0))
+            limit = int(request.query_params.get('limit', sync.DEFAULT_LIMIT))
+        except ValueError:
+            return Response({"error": "'since' and 'limit' must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+        if since < 0 or limit <= 0:
+            return Response({"error": "'since' must be >= 0 and 'limit' positive."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            return Response(sync.changes_since(
+                since, min(limit, sync.MAX_LIMIT), context={'request': request}, principal=get_principal(request),
+            ))
+        except sync.ResyncRequired as e:
+            return Response(
+                {"error": f"{e} Reload everything, then sync from the watermark given.", "resync": True, "watermark": e.watermark},
+                status=status.HTTP_410_GONE,
+            )
 
 
 # Manager Profile View
@@ -253,30 +810,35 @@ class ManagerProfileView(generics.RetrieveAPIView):
 
     def get(self, request):
         user = request.user
-        
-        try:
-            manager = user.manager_profile
-        except Manager.DoesNotExist:
+        principal = get_principal(request)
+
+        manager = Manager.objects.filter(pk=principal.manager_id).first() if principal.manager_id else None
+        if manager is None:
             return Response({"error": "Manager profile not found."}, status=status.HTTP_404_NOT_FOUND)
 
         return Response({
             "username": user.username,
-            "role": user.role,
+            "role": principal.role,
             "department": manager.department,
             "phone_number": manager.phone_number
         })
 
 
 # Document Viewset
-class DocumentViewSet(viewsets.ModelViewSet):
+class DocumentViewSet(ConditionalGetMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = Document.objects.all()
     serializer_class = DocumentSerializer
     permission_classes = [IsAuthenticated]
+    keyset_ordering = ('-created_at', '-id')  # Newest first
+    filter_fields = {'project': 'project', 'type': 'document_type', **filters.date_range('created_at', 'created')}
+    ordering_fields = ('id', 'created_at')
+    expand_related = {'project': 'project'}
 
     @action(detail=False, methods=['post'], permission_classes=[IsAuthenticated])
     def upload_document(self, request):
+        principal = get_principal(request)
         # Check if the user is a manager
-        if request.user.role != 'manager':
+        if principal.role != 'manager':
             return Response({"detail": "You must be a manager to upload documents."}, status=403)
 
         # Retrieve the project ID from the request
@@ -293,7 +855,7 @@ class DocumentViewSet(viewsets.ModelViewSet):
             return Response({"detail": "Project not found."}, status=404)
 
         # If supervisor is the user, return error
-        if project.supervisor == request.user:
+        if principal.supervisor_id is not None and project.supervisor_id == principal.supervisor_id:
             return Response({"detail": "Supervisors cannot upload documents for this project."}, status=400)
 
         # Proceed with file upload logic (e.g., saving file to database or storage)
@@ -311,10 +873,15 @@ class DocumentViewSet(viewsets.ModelViewSet):
 
 # Media Viewset
 
-class MediaViewSet(viewsets.ModelViewSet):
+class MediaViewSet(ConditionalGetMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = Media.objects.all()
     serializer_class = MediaSerializer
     permission_classes = [IsAuthenticated]
+    keyset_ordering = ('-created_at', '-id')  # Newest first
+    filter_fields = {'project': 'project', **filters.date_range('created_at', 'created')}
+    ordering_fields = ('id', 'created_at')
+    expand_related = {'project': 'project', 'supervisor': 'supervisor', 'manager': 'manager'}
+    field_columns = {'image_thumb': ('image', 'image_variants'), 'image_medium': ('image', 'image_variants')}
 
     @action(detail=False, methods=['post'], permission_classes=[IsAuthenticated])
     def upload_media(self, request):
@@ -359,3 +926,160 @@ class MediaViewSet(viewsets.ModelViewSet):
             "message": "Media uploaded successfully.",
             "media_id": media.id
         }, status=status.HTTP_201_CREATED)
+
+
+
+# Media Upload Viewset
+class MediaUploadViewSet(viewsets.GenericViewSet):
+    """
+    Resumable chunked video uploads:
+
+        POST   /media/uploads/                         start (filename, size, chunk_size, project, ...)
+        PUT    /media/uploads/<id>/chunks/<offset>/    one chunk as the raw body, with X-Chunk-SHA256
+        GET    /media/uploads/<id>/                    received and missing offsets, to resume
+        POST   /media/uploads/<id>/finalize/           assemble the chunks into a Media video
+        DELETE /media/uploads/<id>/                    abandon
+
+    Chunks may be sent in any order and in parallel.
+    """
+    serializer_class = MediaUploadSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return MediaUpload.objects.filter(uploaded_by=self.request.user).prefetch_related('chunks')
+
+    def create(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save(uploaded_by=request.user)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def retrieve(self, request, pk=None):
+        return Response(self.get_serializer(self.get_object()).data)
+
+    def destroy(self, request, pk=None):
+        upload = self.get_object()
+        upload.delete()
+        uploads.discard(upload.pk)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    def chunk(self, request, pk=None, offset=None):
+        upload = self.get_object()
+        if upload.media_id:
+            return Response({"error": "Upload is already finalized."}, status=status.HTTP_409_CONFLICT)
+        sha256 = request.headers.get('X-Chunk-SHA256')
+        if not sha256:
+            return Response({"error": "X-Chunk-SHA256 header is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Read the raw body as a stream; request.data would buffer it
+        try:
+            size = uploads.write_chunk(upload, offset, request.stream or io.BytesIO(), sha256)
+        except uploads.ChunkError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        MediaUploadChunk.objects.update_or_create(
+            upload=upload, offset=offset, defaults={'size': size, 'sha256': sha256.lower()}
+        )
+        return Response({"offset": offset, "size": size}, status=status.HTTP_200_OK)
+
+    def finalize(self, request, pk=None):
+        upload = self.get_object()
+        if upload.media_id:
+            return self.finalized(upload)
+
+        missing = self.get_serializer(upload).data['missing']
+        if missing:
+            return Response({"error": "Some chunks are missing.", "missing": missing}, status=status.HTTP_409_CONFLICT)
+
+        # Assemble and store the file outside any transaction: it can take a
+        # while, and the storage moves the assembled file into place
+        media = Media(
+            project_id=upload.project_id,
+            supervisor_id=upload.supervisor_id,
+            manager_id=upload.manager_id,
+            description=upload.description,
+        )
+        field = Media._meta.get_field('video')
+        try:
+            with uploads.assemble(upload) as assembled:
+                name = field.storage.save(field.generate_filename(media, upload.filename), assembled, max_length=field.max_length)
+        except uploads.ChunkError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except FileNotFoundError:
+            # A concurrent finalize won and removed the chunks
+            upload.refresh_from_db()
+            if upload.media_id is None:
+                raise
+            return self.finalized(upload)
+        media.video.name = name
+
+        with transaction.atomic():
+            media.save()
+            # Claim the upload: of two concurrent finalize calls only one updates it
+            claimed = MediaUpload.objects.filter(pk=upload.pk, media__isnull=True).update(media=media, updated_at=timezone.now())
+            if not claimed:
+                transaction.set_rollback(True)
+        if not claimed:
+            # Shared blobs are left to gc_blobs; other storages delete the file
+            field.storage.delete(name)
+            upload.refresh_from_db()
+            return self.finalized(upload)
+        uploads.discard(upload.pk)
+
+        return Response({
+            "message": "Media uploaded successfully.",
+            "media_id": media.pk
+        }, status=status.HTTP_201_CREATED)
+
+    def finalized(self, upload):
+        return Response({"message": "Upload already finalized.", "media_id": upload.media_id}, status=status.HTTP_200_OK)
+
+
+# File View
+class FileView(generics.GenericAPIView):
+    """
+    GET /files/<kind>/<pk>/<field>/ serves one uploaded file with Range support
+    (see appcms.files), to whoever the kind's viewset would show the row to.
+    Images take ?variant=thumb|medium for a derivative; ?download=1 asks the
+    browser to save rather than display.
+    """
+    sources = {
+        'documents': (DocumentViewSet, ('file',)),
+        'media': (MediaViewSet, ('image', 'video')),
+        'tasks': (TaskViewSet, ('image',)),
+    }
+
+    def get_source(self):
+        try:
+            viewset, fields = self.sources[self.kwargs['kind']]
+        except KeyError:
+            raise NotFound("Unknown file kind.")
+        if self.kwargs['field'] not in fields:
+            raise NotFound("Unknown file field.")
+        return viewset
+
+    def get_permissions(self):
+        return [permission() for permission in self.get_source().permission_classes]
+
+    def get(self, request, kind, pk, field):
+        viewset = self.get_source()
+        model = viewset.queryset.model
+        columns = [field] + (['image_variants'] if field == 'image' else [])
+        instance = get_object_or_404(model.objects.only(*columns), pk=pk)
+        self.check_object_permissions(request, instance)
+
+        field_file = getattr(instance, field)
+        if not field_file:
+            raise NotFound("No file uploaded.")
+        name = field_file.name
+        variant = request.query_params.get('variant')
+        if variant:
+            variants = instance.image_variants if field == 'image' else {}
+            if variant not in derivatives.SIZES or variants.get('source') != name or variant not in variants:
+                raise NotFound("Variant not available.")
+            name = variants[variant]
+
+        try:
+            return files.serve(request, field_file.storage, name, download=request.query_params.get('download') in ('1', 'true'))
+        except FileNotFoundError:
+            raise Http404("File not found.")
@@ -0,0 +1,276 @@
+"""
+Bulk Worker import from CSV or NDJSON.
+
+Rows are read from a stream and handled a chunk at a time, so a large file
+is never held in memory. Each chunk is validated in Python, checked against
+the file so far for repeated Aadhaar numbers, checked against the database
+with `IN` queries on the unique Aadhaar index, and inserted with
+`bulk_create`. Every rejected row is reported with its row number.
+
+No transaction stays open while the file is read. In partial mode each
+chunk is written in a short transaction of its own. In atomic mode the
+valid rows are staged in a temporary file until the whole file has been
+read, and are written in one transaction only if no row was rejected.
+
+CSV files need a header row naming at least `name` and `aadhar_number`
+(`is_working` is optional); NDJSON files hold one JSON object per line.
+"""
+import codecs
+import csv
+import json
+import re
+import tempfile
+
+from django.db import IntegrityError, transaction
+
+from . import sqlite
+from .cache import object_cache
+from .models import ChangeLog, Worker
+
+CHUNK_ROWS = 1000
+# Values per IN (...) query and rows per INSERT; below SQLite's oldest variable limit
+BATCH_SIZE = 500
+READ_SIZE = 64 * 1024
+# Bulk inserts tried before falling back to one row at a time
+INSERT_ATTEMPTS = 2
+# Staged rows kept in memory before spilling to disk, in bytes
+STAGING_MEMORY = 8 * 1024 * 1024
+AADHAR_RE = re.compile(r'^\d{12}$')
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 't'}
+FALSE_VALUES = {'', '0', 'false', 'no', 'n', 'f'}
+NAME_MAX_LENGTH = Worker._meta.get_field('name').max_length
+
+FORMATS = {
+    'text/csv': 'csv',
+    'application/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'application/json-seq': 'ndjson',
+}
+
+
+class ImportFileError(ValueError):
+    """
+    Raised when the file as a whole can't be read. `report` holds what was
+    imported before the error (partial mode commits chunk by chunk).
+    """
+    report = None
+
+
+def iter_lines(stream):
+    """ Decoded lines (with their endings) from a binary stream, read a block at a time """
+    decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='strict')
+    pending = ''
+    try:
+        while True:
+            block = stream.read(READ_SIZE)
+            text = decoder.decode(block or b'', final=not block)
+            *lines, pending = (pending + text).split('\n')
+            for line in lines:
+                yield line + '\n'
+            if not block:
+                break
+    except UnicodeDecodeError:
+        raise ImportFileError("File must be UTF-8 encoded.")
+    if pending:
+        yield pending
+
+
+def read_rows(stream, fmt):
+    """ (row number, dict) for every record in the stream """
+    lines = iter_lines(stream)
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        if reader.fieldnames is None or not {'name', 'aadhar_number'} <= {f.strip() for f in reader.fieldnames}:
+            raise ImportFileError("CSV needs a header row with 'name' and 'aadhar_number'.")
+        for number, row in enumerate(reader, 1):
+            yield number, {key.strip(): value for key, value in row.items() if key}
+    elif fmt == 'ndjson':
+        number = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            number += 1
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield number, row if isinstance(row, dict) else None
+    else:
+        raise ImportFileError("Format must be 'csv' or 'ndjson'.")
+
+
+def import_workers(rows, mode='partial'):
+    """
+    Import `rows` ((row number, dict) pairs) and return a report:
+    {"created", "failed", "errors": [{"row", "errors"}, ...]}.
+
+    In 'partial' mode every valid row is created; in 'atomic' mode nothing is
+    created unless every row is valid.
+    """
+    report = {'created': 0, 'failed': 0, 'errors': []}
+    seen = set()
+    created = 0
+
+    with tempfile.SpooledTemporaryFile(max_size=STAGING_MEMORY, mode='w+') as staging:
+        try:
+            for chunk in _chunks(rows):
+                candidates = _drop_existing(_validate(chunk, seen, report), report)
+                if mode == 'atomic':
+                    for number, worker in candidates:
+                        staging.write(json.dumps([number, worker.name, worker.aadhar_number, worker.is_working]) + '\n')
+                else:
+                    created += _write(candidates, report)
+        except ImportFileError as e:
+            e.report = _finish(report, created)
+            raise
+
+        if mode == 'atomic' and not report['failed']:
+            staging.seek(0)
+            created = _write_staged(staging, report)
+    return _finish(report, created)
+
+
+def _chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK_ROWS:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _finish(report, created):
+    report['created'] = created
+    report['errors'].sort(key=lambda error: error['row'])
+    return report
+
+
+def _validate(chunk, seen, report):
+    """ (row number, Worker) for the chunk's valid rows; the others are rejected """
+    candidates = []
+    for number, row in chunk:
+        worker, errors = _build(row)
+        if not errors and worker.aadhar_number in seen:
+            errors = {'aadhar_number': ["Duplicate of an earlier row in this file."]}
+        if errors:
+            _reject(report, number, errors)
+            continue
+        seen.add(worker.aadhar_number)
+        candidates.append((number, worker))
+    return candidates
+
+
+def _write(candidates, report):
+    """ Create one chunk's workers in a transaction of its own; returns how many were created """
+    with sqlite.write_transaction():
+        created_ids = _insert(candidates, report)
+        _created(created_ids)
+    return len(created_ids)
+
+
+def _write_staged(staging, report):
+    """ Create the staged workers in one transaction, or none if any is taken meanwhile; returns how many were created """
+    with sqlite.write_transaction():
+        created_ids = []
+        for chunk in _chunks(json.loads(line) for line in staging):
+            candidates = [
+                (number, Worker(name=name, aadhar_number=aadhar_number, is_working=is_working))
+                for number, name, aadhar_number, is_working in chunk
+            ]
+            created_ids += _insert(candidates, report)
+        if report['failed']:
+            transaction.set_rollback(True)
+            return 0
+        _created(created_ids)
+    return len(created_ids)
+
+
+def _created(ids):
+    # bulk_create sends no signals, so do what the Worker receivers would
+    ChangeLog.record(Worker, ids)
+    if ids:
+        object_cache.invalidate(Worker)
+
+
+def _insert(candidates, report):
+    """
+    Insert the candidates whose numbers aren't taken and return their ids;
+    the others are rejected. Each attempt runs in a savepoint of its own, so
+    a number inserted by someone else since we looked only costs a retry. If
+    the bulk attempts all conflict, rows go in one at a time.
+    """
+    for _ in range(INSERT_ATTEMPTS):
+        candidates = _drop_existing(candidates, report)
+        workers = [worker for _, worker in candidates]
+        for worker in workers:
+            worker.pk = None
+        try:
+            with transaction.atomic():
+                return [worker.pk for worker in Worker.objects.bulk_create(workers, batch_size=BATCH_SIZE)]
+        except IntegrityError:
+            continue
+
+    created_ids = []
+    for number, worker in candidates:
+        worker.pk = None
+        try:
+            with transaction.atomic():
+                Worker.objects.bulk_create([worker])
+        except IntegrityError:
+            _reject(report, number, {'aadhar_number': ["A worker with this Aadhar number already exists."]})
+        else:
+            created_ids.append(worker.pk)
+    return created_ids
+
+
+def _drop_existing(candidates, report):
+    numbers = [worker.aadhar_number for _, worker in candidates]
+    existing = set()
+    for start in range(0, len(numbers), BATCH_SIZE):
+        existing.update(
+            Worker.objects.filter(aadhar_number__in=numbers[start:start + BATCH_SIZE]).values_list('aadhar_number', flat=True)
+        )
+    kept = []
+    for number, worker in candidates:
+        if worker.aadhar_number in existing:
+            _reject(report, number, {'aadhar_number': ["A worker with this Aadhar number already exists."]})
+        else:
+            kept.append((number, worker))
+    return kept
+
+
+def _build(row):
+    """ (Worker, None) for a valid row, or (None, {field: [messages]}) """
+    if row is None:
+        return None, {'non_field_errors': ["Row is not a JSON object."]}
+    errors = {}
+    name = str(row.get('name') or '').strip()
+    aadhar_number = str(row.get('aadhar_number') or '').strip()
+    is_working = row.get('is_working', False)
+
+    if not name:
+        errors['name'] = ["This field is required."]
+    elif len(name) > NAME_MAX_LENGTH:
+        errors['name'] = [f"Ensure this field has no more than {NAME_MAX_LENGTH} characters."]
+    if not AADHAR_RE.match(aadhar_number):
+        errors['aadhar_number'] = ["Aadhar number must be exactly 12 digits."]
+    if not isinstance(is_working, bool):
+        value = str(is_working if is_working is not None else '').strip().lower()
+        if value in TRUE_VALUES:
+            is_working = True
+        elif value in FALSE_VALUES:
+            is_working = False
+        else:
+            errors['is_working'] = ["Must be a boolean."]
+
+    if errors:
+        return None, errors
+    return Worker(name=name, aadhar_number=aadhar_number, is_working=is_working), None
+
+
+def _reject(report, number, errors):
+    report['failed'] += 1
+    report['errors'].append({'row': number, 'errors': errors})
@@ -17,6 +17,20 @@ import os
 BASE_DIR = Path(__file__).resolve().parent.parent
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Chunks of resumable uploads wait here until they are finalized
+CMS_UPLOAD_TEMP_DIR = os.path.join(MEDIA_ROOT, 'uploads', 'tmp')
+CMS_MAX_UPLOAD_SIZE = 5 * 1024 ** 3  # bytes
+# Store uploads once per distinct content under blobs/ (see appcms.storage)
+CMS_CONTENT_ADDRESSED_UPLOADS = True
+# /files/ hands file bodies to the front-end server: None, 'x-accel' (nginx) or 'x-sendfile'
+CMS_FILE_OFFLOAD = None
+CMS_FILE_OFFLOAD_PREFIX = '/protected-media/'  # nginx `internal` location aliased to MEDIA_ROOT
+# Processes that render image thumbnails; 0 renders them inline after commit
+CMS_DERIVATIVE_WORKERS = 2
+# Processes that hash new users' passwords (None: one per core; 0 hashes inline),
+# and how many passwords may wait before registrations get a 503
+CMS_HASH_WORKERS = None
+CMS_HASH_MAX_PENDING = 32
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.1/howto/deployment/checklist/
@@ -49,6 +63,8 @@ MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    # Keeps a client's reads on the primary just after it writes (see appcms/routers.py)
+    'appcms.routers.ReplicaStickinessMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -83,8 +99,67 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # High-concurrency SQLite profile (see appcms/sqlite.py): write
+        # transactions wait up to `timeout` seconds for the write lock.
+        'OPTIONS': {
+            'timeout': 5,
+        },
     }
 }
+# Connection pragmas default to appcms.sqlite.DEFAULT_PRAGMAS; CMS_SQLITE_PRAGMAS replaces them.
+# Write transactions start with BEGIN IMMEDIATE unless CMS_SQLITE_IMMEDIATE_WRITES is False.
+# Retries of a write that timed out on the lock, backing off from this many seconds
+CMS_SQLITE_LOCK_RETRIES = 3
+CMS_SQLITE_LOCK_BACKOFF = 0.05
+
+# Read replicas for the appcms models (see appcms/routers.py): aliases in
+# DATABASES, skipped while more than CMS_REPLICA_MAX_LAG seconds behind.
+DATABASE_ROUTERS = ['appcms.routers.ReplicaRouter']
+CMS_READ_REPLICAS = []
+CMS_REPLICA_STICKY_SECONDS = 5
+CMS_REPLICA_MAX_LAG = 10  # seconds
+CMS_REPLICA_CHECK_SECONDS = 2
+
+# Local SQLite replicas, refreshed from db.sqlite3 by `manage.py sync_replicas`
+for n in range(1, int(os.environ.get('CMS_SQLITE_REPLICAS', 0)) + 1):
+    DATABASES[f'replica{n}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'db.replica{n}.sqlite3',
+        'TEST': {'MIRROR': 'default'},
+    }
+    CMS_READ_REPLICAS.append(f'replica{n}')
+
+
+# Cache
+# The object cache keeps a small LRU in each process in front of this shared
+# tier; a file-based cache is shared by every worker process on the host.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / '.cache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+}
+CMS_OBJECT_CACHE = 'default'
+CMS_OBJECT_CACHE_TIMEOUT = 300  # seconds
+CMS_OBJECT_CACHE_LOCAL_ENTRIES = 1024
+
+# Full-text search (see appcms/search.py): SQLite FTS5, or DatabaseBackend's LIKE scans elsewhere
+CMS_SEARCH_BACKEND = 'appcms.search.FTS5Backend'
+
+# Resource forecasts (see appcms/forecast.py): trailing days averaged for the burn rate and the recent rate
+CMS_FORECAST_WINDOW_DAYS = 28
+CMS_FORECAST_RECENT_DAYS = 7
+
+# Authenticated tokens kept per process, and for how long (seconds) without a database check
+CMS_AUTH_CACHE_ENTRIES = 4096
+CMS_AUTH_CACHE_TTL = 60
+
+# /sync/ holds back changes this recent, so a write that commits late can't fall behind a watermark
+CMS_SYNC_SETTLE_SECONDS = 2
+# prune_changelog drops sync log rows older than this; devices further behind have to resync
+CMS_SYNC_RETENTION_DAYS = 30
 
 
 # Password validation
@@ -129,7 +204,16 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        # TokenAuthentication with an in-process token -> user cache
+        'appcms.authentication.CachedTokenAuthentication',
+    ),
+    # Keyset pagination on every list endpoint; clients may pass ?page_size= up to 500
+    'DEFAULT_PAGINATION_CLASS': 'appcms.pagination.KeysetPagination',
+    'PAGE_SIZE': 50,
+    # ?<filter>= from a viewset's filter_fields, and ?ordering= from its ordering_fields
+    'DEFAULT_FILTER_BACKENDS': (
+        'appcms.filters.FieldFilterBackend',
+        'appcms.filters.KeysetOrderingFilter',
     ),
 }
  